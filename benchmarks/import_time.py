@@ -0,0 +1,68 @@
+#!/usr/bin/env python2.7
+"""Startup time of json2run: importing the package (generation only, or everything) and
+running j2r -a print-cll, each in a fresh interpreter. Prints the results as JSON."""
+
+from argparse import ArgumentParser
+import subprocess
+import tempfile
+import json
+import time
+import sys
+import os
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+expression = { "type": "and", "descendants": [
+    { "type": "discrete", "name": "a", "values": [1, 2, 3] },
+    { "type": "discrete", "name": "b", "values": { "min": 0, "max": 100, "step": 5 } }
+]}
+
+def elapsed(command, repetitions):
+    """Wall-clock times of running a command, repetitions times."""
+
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = root + os.pathsep + environment.get("PYTHONPATH", "")
+
+    times = []
+    with open(os.devnull, "w") as null:
+        for i in range(repetitions):
+            start = time.time()
+            subprocess.check_call(command, stdout = null, env = environment)
+            times.append(time.time() - start)
+    return times
+
+def summary(times):
+    """Min, median and max of a list of times."""
+
+    times = sorted(times)
+    return { "min": times[0], "median": times[len(times) / 2], "max": times[-1], "runs": len(times) }
+
+def main():
+
+    parser = ArgumentParser(description = "Measure the startup time of json2run.")
+    parser.add_argument("--repetitions", "-r", type = int, default = 20, help = "runs of each command")
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix = ".json", delete = False) as f:
+        json.dump(expression, f)
+
+    try:
+        commands = {
+            "interpreter": [sys.executable, "-c", "pass"],
+            "import_generation": [sys.executable, "-c", "from json2run import ParameterExpression"],
+            "import_all": [sys.executable, "-c", "from json2run import *; Batch, Race, Experiment, Campaign"],
+            "print_cll": [sys.executable, os.path.join(root, "j2r"), "-a", "print-cll", "-i", f.name]
+        }
+
+        # warm up (compiled modules, file system cache)
+        for c in commands.values():
+            elapsed(c, 1)
+
+        results = { name: summary(elapsed(commands[name], args.repetitions)) for name in commands }
+    finally:
+        os.remove(f.name)
+
+    print json.dumps({ "benchmark": "import_time", "python": sys.version.split()[0], "results": results }, indent = 4, sort_keys = True)
+
+if __name__ == "__main__":
+    main()
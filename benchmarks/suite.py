@@ -0,0 +1,287 @@
+#!/usr/bin/env python2.7
+"""Benchmarks of json2run: generation of configurations, experiments run per second (with a
+no-op executable), database writes and race pruning. Prints the results as JSON (or writes
+them to --output), --compare reports the changes with respect to previous results."""
+
+from argparse import ArgumentParser
+import logging as log
+import subprocess
+import datetime
+import tempfile
+import shutil
+import random
+import json
+import time
+import sys
+import os
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from json2run import *
+from json2run.parameter import Parameter
+from json2run.raceresults import RaceResults
+from json2run.strategy import RaceStrategy
+import numpy
+
+def discrete(name, values):
+    return { "type": "discrete", "name": name, "values": values }
+
+def continuous(name, low, high):
+    return { "type": "continuous", "name": name, "values": { "min": low, "max": high } }
+
+def deep(depth, values):
+    """A chain of and nodes, each one with a discrete parameter and the next node."""
+
+    node = discrete("p%d" % depth, range(values))
+    for d in range(depth - 1, 0, -1):
+        node = { "type": "and", "descendants": [discrete("p%d" % d, range(values)), node] }
+    return node
+
+expressions = {
+    "wide_and": { "type": "and", "descendants": [discrete("p%d" % i, range(5)) for i in range(6)] },
+    "deep_and": deep(8, 3),
+    "wide_or": { "type": "or", "descendants": [discrete("p%d" % i, range(20)) for i in range(500)] },
+    "hammersley": { "type": "and", "descendants": [continuous("x%d" % i, 0.0, 10.0) for i in range(6)],
+        "postprocessors": [{ "type": "hammersley", "points": 10000 }] },
+    "expression": { "type": "and", "descendants": [discrete("a", range(50)), discrete("b", range(1, 50))],
+        "postprocessors": [{ "type": "expression", "match": "a|b", "result": "c", "expression": "a.value * 2 + b.value" }] }
+}
+"""Expressions whose configurations are generated, by shape of the tree."""
+
+def timed(function, repetitions):
+    """Run a function repetitions times, return its result and the times of each run."""
+
+    times = []
+    for i in range(repetitions):
+        start = time.time()
+        result = function()
+        times.append(time.time() - start)
+    return result, times
+
+def summary(times, items = None):
+    """Min, median and max of a list of times, and items per second (at the median)."""
+
+    times = sorted(times)
+    result = { "min": times[0], "median": times[len(times) / 2], "max": times[-1], "runs": len(times) }
+    if items is not None:
+        result["items"] = items
+        result["per_second"] = items / result["median"] if result["median"] else None
+    return result
+
+def generation(args):
+    """Configurations generated per second, for each expression."""
+
+    def generate(expression):
+        generator = ParameterExpression.from_obj(expression)
+        count = 0
+        while generator.has_more():
+            generator.next()
+            count += 1
+        return count
+
+    results = {}
+    for name in sorted(expressions):
+        count, times = timed(lambda: generate(expressions[name]), args.repetitions)
+        results[name] = summary(times, count)
+    return results
+
+def connect(url):
+    """Connect to the benchmark database."""
+    Persistent.connect(host = "", port = 0, user = "", passw = "", database = "", url = url)
+
+def batch(name, expression, executable = "true"):
+    return Batch(name = name, generator = ParameterExpression.from_obj(expression), executable = executable,
+        repetitions = 1, prefix = "--", separator = " ")
+
+def runner(args):
+    """Experiments run per second with a no-op executable, by number of parallel threads."""
+
+    # the parameters are commented out, the command just prints empty stats
+    executable = "echo '{}' #"
+
+    results = {}
+    for threads in args.threads:
+        def run():
+            b = batch("runner-%d" % threads, { "type": "and", "descendants": [discrete("a", range(args.experiments))] }, executable)
+            b.run({ "use": False, "cmd": "" }, threads, False)
+            return b["done"]
+        done, times = timed(run, args.repetitions)
+        results["threads_%d" % threads] = summary(times, done)
+    return results
+
+def database(args):
+    """Experiments inserted, looked up (as when resuming a batch) and counted on their batch per second."""
+
+    parameters = [[Parameter("a", i), Parameter("b", "value"), Parameter("repetition", 0)] for i in range(args.writes)]
+
+    def insert():
+        b = batch("database", discrete("a", range(args.writes)))
+        experiments = []
+        for p in parameters:
+            e = Experiment(b, b["executable"], p)
+            e["stats"] = { "cost": random.random() }
+            e.save()
+            experiments.append(e)
+        return b, experiments
+
+    def lookup(experiments):
+        return sum(1 for e in experiments if e.on_batch())
+
+    def count(b, experiments):
+        b.initialize_counters(len(experiments))
+        for e in experiments:
+            b.count_experiment(e)
+            b.save()
+        return len(experiments)
+
+    (b, experiments), insert_times = timed(insert, args.repetitions)
+    found, lookup_times = timed(lambda: lookup(experiments), args.repetitions)
+    counted, count_times = timed(lambda: count(b, experiments), args.repetitions)
+
+    return {
+        "insert": summary(insert_times, len(experiments)),
+        "lookup": summary(lookup_times, found),
+        "count": summary(count_times, counted)
+    }
+
+def pruning(args):
+    """Time spent in prune_inferiors by synthetic races of configurations x instances, for each strategy."""
+
+    def race(strategy, configurations, instances):
+
+        r = Race(name = "pruning", generator = ParameterExpression.from_obj(discrete("a", range(configurations))), executable = "true",
+            repetitions = 1, initial_block = 5, instance_parameter = "instance", performance_parameter = "cost", seed = 0,
+            prefix = "--", separator = " ", strategy = strategy)
+        r.alpha = 0.05
+        r.strategy = RaceStrategy.from_race(r)
+        r.racing = range(configurations)
+        r.results = RaceResults(configurations, instances)
+
+        # configurations are increasingly worse, with noise of the same magnitude as the spread
+        generator = numpy.random.RandomState(0)
+        quality = numpy.linspace(0.0, 1.0, configurations)
+
+        elapsed = 0.0
+        iterations = 0
+        for i in range(instances):
+            if len(r.racing) <= 1:
+                break
+            noise = generator.normal(0.0, 1.0, configurations)
+            for c in r.racing:
+                r.results.record(c, i, quality[c] + noise[c])
+            r.iterations_completed = i
+            start = time.time()
+            r.prune_inferiors()
+            elapsed += time.time() - start
+            iterations += 1
+
+        return { "seconds": elapsed, "iterations": iterations, "survivors": len(r.racing) }
+
+    results = {}
+    for strategy in ["frace", "halving"]:
+        for (configurations, instances) in args.races:
+
+            # warm up (the first pruning imports SciPy)
+            race(strategy, configurations, instances)
+
+            runs = [race(strategy, configurations, instances) for i in range(args.repetitions)]
+            result = summary([run["seconds"] for run in runs], runs[0]["iterations"])
+            result["survivors"] = runs[0]["survivors"]
+            results["%s_%dx%d" % (strategy, configurations, instances)] = result
+    return results
+
+benchmarks = {
+    "generation": generation,
+    "runner": runner,
+    "database": database,
+    "pruning": pruning
+}
+"""Benchmarks, by name."""
+
+def revision():
+    """Git revision of the benchmarked code (None if unknown)."""
+
+    try:
+        with open(os.devnull, "w") as null:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = root, stderr = null).strip()
+    except Exception:
+        return None
+
+def compare(previous, current):
+    """Print the change in median time of each result, with respect to previous results."""
+
+    print >> sys.stderr, "%-40s %12s %12s %8s" % ("Benchmark", "Before (s)", "After (s)", "Change")
+    for name in sorted(current["results"]):
+        for case in sorted(current["results"][name]):
+            try:
+                before = previous["results"][name][case]["median"]
+            except KeyError:
+                continue
+            after = current["results"][name][case]["median"]
+            change = "%+.1f%%" % (100.0 * (after - before) / before) if before else "-"
+            print >> sys.stderr, "%-40s %12.4f %12.4f %8s" % ("%s.%s" % (name, case), before, after, change)
+
+def numbers(text):
+    """Parse a comma separated list of numbers."""
+    return [int(n) for n in text.split(",")]
+
+def sizes(text):
+    """Parse a list of configurations x instances, e.g. 100x50,1000x20."""
+    return [tuple(int(n) for n in size.split("x")) for size in text.split(",")]
+
+def main():
+
+    parser = ArgumentParser(description = "Benchmark json2run.")
+    parser.add_argument("benchmarks", nargs = "*", help = "benchmarks to run, among %s (default: all)" % ", ".join(sorted(benchmarks)))
+    parser.add_argument("--repetitions", "-r", type = int, default = 3, help = "runs of each benchmark")
+    parser.add_argument("--database", "-db", default = None, help = "database URL (default: a temporary SQLite database)")
+    parser.add_argument("--threads", "-t", type = numbers, default = [1, 4], help = "parallel threads of the runner benchmark (comma separated)")
+    parser.add_argument("--experiments", "-e", type = int, default = 50, help = "experiments run by the runner benchmark")
+    parser.add_argument("--writes", "-w", type = int, default = 2000, help = "experiments written by the database benchmark")
+    parser.add_argument("--races", type = sizes, default = sizes("100x50,1000x20"), help = "configurations x instances of the pruning benchmark")
+    parser.add_argument("--output", "-o", default = None, help = "file to write the results to (default: standard output)")
+    parser.add_argument("--compare", "-c", default = None, help = "previous results to compare with")
+    args = parser.parse_args()
+
+    log.basicConfig(level = log.WARNING)
+
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error("unknown benchmark %s" % name)
+    selected = args.benchmarks or sorted(benchmarks)
+
+    # a temporary database, unless one is given
+    directory = tempfile.mkdtemp()
+    try:
+        connect(args.database or "sqlite:///%s" % os.path.join(directory, "benchmark.db"))
+        results = {}
+        for name in selected:
+            print >> sys.stderr, "Running %s ..." % name
+            results[name] = benchmarks[name](args)
+        Persistent.disconnect()
+    finally:
+        shutil.rmtree(directory)
+
+    output = {
+        "benchmark": "suite",
+        "revision": revision(),
+        "date": datetime.datetime.utcnow().isoformat(),
+        "python": sys.version.split()[0],
+        "numpy": numpy.__version__,
+        "results": results
+    }
+
+    text = json.dumps(output, indent = 4, sort_keys = True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print text
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+if __name__ == "__main__":
+    main()
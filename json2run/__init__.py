@@ -1,7 +1,35 @@
 from parameterexpression import *
 from postprocessor import *
-from batch import *
-from persistent import *
-from experiment import *
+from types import ModuleType
+import importlib
+import sys
 
-__all__ = ["ParameterList", "ParameterExpression", "Persistent", "Batch", "Race", "Experiment"]
+__all__ = ["ParameterList", "ParameterExpression", "Persistent", "Batch", "Race", "Experiment", "Campaign", "PersistenceError"]
+
+lazy = {
+    "Persistent": "persistent",
+    "PersistenceError": "persistent",
+    "Batch": "batch",
+    "Race": "batch",
+    "Experiment": "experiment",
+    "Campaign": "campaign"
+}
+"""Classes whose modules (and their dependencies, e.g. pymongo, NumPy, SciPy) are imported on first use."""
+
+class Package(ModuleType):
+    """The json2run package, imports the module of a lazy class when it's first accessed, so
+    that generating parameters doesn't pay for the database and the statistics."""
+
+    def __getattr__(self, name):
+        if name not in lazy:
+            raise AttributeError(name)
+        value = getattr(importlib.import_module("json2run.%s" % lazy[name]), name)
+        setattr(self, name, value)
+        return value
+
+package = Package(__name__, __doc__)
+package.__dict__.update(sys.modules[__name__].__dict__)
+
+# keep the original module alive, its globals would be cleared otherwise
+package.module = sys.modules[__name__]
+sys.modules[__name__] = package
@@ -0,0 +1,171 @@
+import os
+import re
+import ctypes
+import ctypes.util
+import logging as log
+
+CPU_SETSIZE = 1024
+"""Number of CPUs representable in a cpu_set_t (glibc default)."""
+
+class CPUSet(ctypes.Structure):
+    """Mirror of the glibc cpu_set_t bitmask."""
+    _fields_ = [("bits", ctypes.c_ulong * (CPU_SETSIZE // (8 * ctypes.sizeof(ctypes.c_ulong))))]
+
+def parse_cpu_list(text):
+    """Parses a kernel CPU list (e.g. "0-3,8,10-11") into a list of integers."""
+
+    cpus = []
+    for chunk in text.strip().split(","):
+        if not chunk:
+            continue
+        if "-" in chunk:
+            first, last = chunk.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(chunk))
+    return cpus
+
+def read_cpu_list(path):
+    """Reads a CPU list from sysfs, returns an empty list if not available."""
+    try:
+        with open(path, "r") as f:
+            return parse_cpu_list(f.read())
+    except (IOError, OSError, ValueError):
+        return []
+
+def allowed_cpus():
+    """CPUs this process is allowed to run on."""
+
+    # cgroups/taskset restrictions are reflected in our own status
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("Cpus_allowed_list:"):
+                    return parse_cpu_list(line.split(":")[1])
+    except (IOError, OSError, ValueError):
+        pass
+
+    cpus = read_cpu_list("/sys/devices/system/cpu/online")
+    return cpus or range(os.sysconf("SC_NPROCESSORS_ONLN"))
+
+def numa_nodes():
+    """Map each NUMA node to the list of allowed CPUs it hosts."""
+
+    allowed = set(allowed_cpus())
+    nodes = {}
+    base = "/sys/devices/system/node"
+
+    if os.path.isdir(base):
+        for entry in os.listdir(base):
+            match = re.match(r"node(\d+)$", entry)
+            if match:
+                cpus = [c for c in read_cpu_list(os.path.join(base, entry, "cpulist")) if c in allowed]
+                if cpus:
+                    nodes[int(match.group(1))] = cpus
+
+    # no NUMA information, consider the machine as a single node
+    if not nodes:
+        nodes[0] = sorted(allowed)
+
+    return nodes
+
+def physical_order(cpus):
+    """Sort CPUs so that the first hardware thread of each core comes first, siblings last."""
+
+    def sibling_rank(cpu):
+        siblings = read_cpu_list("/sys/devices/system/cpu/cpu%d/topology/thread_siblings_list" % cpu)
+        return siblings.index(cpu) if cpu in siblings else 0
+
+    return sorted(cpus, key = lambda c: (sibling_rank(c), c))
+
+def cpu_slots(mode, slots, cpus_per_slot = 1):
+    """Assign a fixed CPU set to each runner slot.
+
+    With mode "core" each slot gets cpus_per_slot CPUs, never crossing a NUMA node
+    and preferring distinct physical cores; with mode "numa" each slot gets a whole
+    NUMA node (round robin). Returns None if no pinning is required."""
+
+    if mode in [None, "none"]:
+        return None
+
+    nodes = numa_nodes()
+
+    if mode == "numa":
+        ids = sorted(nodes.keys())
+        return [nodes[ids[s % len(ids)]] for s in range(slots)]
+
+    if mode == "core":
+
+        # carve same-node chunks, so that a slot never spans two sockets
+        chunks = []
+        for n in sorted(nodes.keys()):
+            cpus = physical_order(nodes[n])
+            for i in range(0, len(cpus) - cpus_per_slot + 1, cpus_per_slot):
+                chunks.append(sorted(cpus[i:i+cpus_per_slot]))
+
+        if not chunks:
+            raise ValueError("Not enough CPUs to assign %d CPUs to each slot." % cpus_per_slot)
+
+        # interleave nodes, so that lightly loaded runs spread across sockets
+        by_node = {}
+        for chunk in chunks:
+            by_node.setdefault(node_of(chunk[0], nodes), []).append(chunk)
+        interleaved = []
+        while any(by_node.values()):
+            for n in sorted(by_node.keys()):
+                if by_node[n]:
+                    interleaved.append(by_node[n].pop(0))
+
+        if slots > len(interleaved):
+            log.warning("More slots (%d) than CPU sets (%d), some slots will share CPUs." % (slots, len(interleaved)))
+
+        return [interleaved[s % len(interleaved)] for s in range(slots)]
+
+    raise ValueError("Unrecognized affinity mode \"%s\"" % mode)
+
+def node_of(cpu, nodes):
+    """Get NUMA node hosting a CPU."""
+    for n in nodes:
+        if cpu in nodes[n]:
+            return n
+    return 0
+
+_LIBC = None
+
+def _libc():
+    """Load the C library once (never from a freshly forked child)."""
+    global _LIBC
+    if _LIBC is None:
+        _LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    return _LIBC
+
+def set_affinity(cpus, pid = 0):
+    """Pin a process (default: the calling one) to a set of CPUs through sched_setaffinity."""
+
+    # Python 3.3+ exposes the system call directly
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(pid, cpus)
+        return
+
+    mask = CPUSet()
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    for cpu in cpus:
+        mask.bits[cpu // bits] |= 1 << (cpu % bits)
+
+    if _libc().sched_setaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+def pinner(cpus):
+    """Returns a function which pins the calling process to cpus (for use as Popen's preexec_fn)."""
+
+    if not cpus:
+        return None
+
+    if not hasattr(os, "sched_setaffinity"):
+        _libc()
+
+    def _pin():
+        set_affinity(cpus)
+
+    return _pin
@@ -0,0 +1,265 @@
+from persistent import *
+from storage import fingerprint
+from bson import json_util
+import zipfile
+import tempfile
+import shutil
+from threading import Lock
+import sqlite3
+import os
+
+directory = os.path.expanduser("~/.json2run/archive")
+"""Directory of the archives and of their index."""
+
+version = 2
+"""Version of the archive format (1: a member per column, 2: a member per block of rows of a column)."""
+
+block = 1024
+"""Rows of each member of a column (so that a few rows are read without decompressing whole columns)."""
+
+missing = object()
+"""Value of a column in a row where the field is missing."""
+
+def columns_of(document):
+    """Column names and values of a document, parameters and stats have a column each."""
+
+    for field in document:
+        if field in ("parameters", "stats") and isinstance(document[field], dict):
+            for key in document[field]:
+                yield ("%s.%s" % (field, key), document[field][key])
+        else:
+            yield (field, document[field])
+
+class Archive(object):
+    """An immutable, compressed archive of the experiments of a batch: a zip file with a
+    schema and one column per field, in blocks of rows (one line of extended JSON per
+    experiment, empty if the field is missing). Only the blocks which are needed are read."""
+
+    def __init__(self, path):
+        """Open an archive."""
+
+        self.path = path
+        self.zip = zipfile.ZipFile(path, "r")
+        self.schema = json_util.loads(self.zip.read("schema.json"))
+        self.block = self.schema["block"] if "block" in self.schema else max(1, self.rows)
+        self.loaded = {}
+        self.sync = Lock()
+
+    @property
+    def rows(self):
+        return self.schema["rows"]
+
+    def values(self, name, b):
+        """Values of a block of a column (missing where the field is missing)."""
+
+        with self.sync:
+            if (name, b) not in self.loaded:
+                member = "columns/%s/%d" % (name, b) if "block" in self.schema else "columns/%s" % name
+                lines = self.zip.read(member).split("\n")[:min(self.block, self.rows - b * self.block)]
+                self.loaded[(name, b)] = [json_util.loads(l) if l else missing for l in lines]
+            return self.loaded[(name, b)]
+
+    def column(self, name):
+        """Values of a column (missing where the field is missing)."""
+
+        values = []
+        for b in xrange((self.rows + self.block - 1) // self.block):
+            values.extend(self.values(name, b))
+        return values
+
+    def selected(self, fields = None):
+        """Columns needed for a projection (list of possibly dotted fields), all if None."""
+
+        if fields is None:
+            return list(self.schema["columns"])
+
+        selected = ["_id"]
+        for f in fields:
+            for c in self.schema["columns"]:
+                if (c == f or c.startswith(f + ".")) and c not in selected:
+                    selected.append(c)
+        return selected
+
+    def documents(self, fields = None, rows = None):
+        """Rebuild the experiments (restricted to some fields, and some rows)."""
+
+        names = self.selected(fields)
+        current = None
+        for i in (rows if rows is not None else xrange(self.rows)):
+
+            # blocks of the row
+            b, offset = divmod(i, self.block)
+            if b != current:
+                current = b
+                columns = [(c, self.values(c, b)) for c in names]
+
+            document = {}
+            for name, values in columns:
+                if values[offset] is missing:
+                    continue
+                if name.startswith("parameters.") or name.startswith("stats."):
+                    field, key = name.split(".", 1)
+                    document.setdefault(field, {})[key] = values[offset]
+                else:
+                    document[name] = values[offset]
+            yield document
+
+    def close(self):
+        self.zip.close()
+
+archives = {}
+"""Archives opened by this process."""
+
+opening = Lock()
+
+def open_archive(path):
+    """Open an archive (once per process)."""
+
+    with opening:
+        if path not in archives:
+            archives[path] = Archive(path)
+        return archives[path]
+
+indices = {}
+"""Connections to the index of each directory (opened once per process)."""
+
+indexing = Lock()
+"""Serializes the use of the connections to the indices (shared by threads)."""
+
+def index():
+    """Open (create) the index of the archived experiments, by fingerprint, once per process
+    (to be used with indexing held). The index is shared by the databases whose batches are
+    archived in the directory, each entry records the database of its batch (see
+    Persistent.location)."""
+
+    path = os.path.join(directory, "index.db")
+    if path in indices:
+        return indices[path]
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    connection = sqlite3.connect(path, check_same_thread = False)
+    connection.execute("CREATE TABLE IF NOT EXISTS experiments (fingerprint TEXT, executable TEXT, batch TEXT, archive TEXT, row INTEGER, copy INTEGER, database TEXT)")
+    connection.execute("CREATE INDEX IF NOT EXISTS experiments_fingerprint ON experiments (fingerprint)")
+
+    # indices written by older versions have no database (their entries are never reused)
+    if "database" not in [c[1] for c in connection.execute("PRAGMA table_info(experiments)")]:
+        connection.execute("ALTER TABLE experiments ADD COLUMN database TEXT")
+    indices[path] = connection
+    return connection
+
+def write(batch, experiments):
+    """Write the experiments of a batch to a new archive (and the index), return its path and
+    the number of archived experiments."""
+
+    database = Persistent.location()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # one temporary file per column, filled row by row
+    work = tempfile.mkdtemp(dir = directory)
+    try:
+        files = {}
+        entries = []
+        rows = 0
+        for e in experiments:
+            for name, value in columns_of(e):
+                if name not in files:
+                    files[name] = open(os.path.join(work, "%d" % len(files)), "w")
+                    files[name].write("\n" * rows)
+                files[name].write(json_util.dumps(value))
+            rows += 1
+            for f in files.itervalues():
+                f.write("\n")
+
+            key = e["fingerprint"] if "fingerprint" in e else fingerprint(e["parameters"])
+            entries.append((key, e.get("executable"), str(batch["_id"]), rows - 1, 1 if e.get("copy") else 0))
+
+        path = os.path.join(directory, "%s.zip" % batch["_id"])
+        archive = zipfile.ZipFile(path + ".tmp", "w", zipfile.ZIP_DEFLATED, True)
+        names = sorted(files)
+        for name in names:
+            files[name].close()
+            with open(files[name].name, "r") as f:
+                lines, b = [], 0
+                for line in f:
+                    lines.append(line)
+                    if len(lines) == block:
+                        archive.writestr("columns/%s/%d" % (name, b), "".join(lines))
+                        lines, b = [], b + 1
+                if lines:
+                    archive.writestr("columns/%s/%d" % (name, b), "".join(lines))
+        archive.writestr("schema.json", json_util.dumps({ "version": version, "batch": batch, "database": database, "rows": rows, "block": block, "columns": names }))
+        archive.close()
+        os.rename(path + ".tmp", path)
+
+    finally:
+        shutil.rmtree(work)
+
+    with indexing:
+        connection = index()
+        connection.execute("DELETE FROM experiments WHERE batch = ? AND database = ?", (str(batch["_id"]), database))
+        connection.executemany("INSERT INTO experiments VALUES (?, ?, ?, ?, ?, ?, ?)", [(k, x, b, path, r, c, database) for (k, x, b, r, c) in entries])
+        connection.commit()
+
+    return path, rows
+
+def remove(batch):
+    """Remove the archive of a batch (document) and its entries in the index."""
+
+    path = batch["archived"]["path"]
+    if os.path.exists(path):
+        os.remove(path)
+    if os.path.exists(os.path.join(directory, "index.db")):
+        with indexing:
+            connection = index()
+            connection.execute("DELETE FROM experiments WHERE batch = ? AND database = ?", (str(batch["_id"]), Persistent.location()))
+            connection.commit()
+
+def experiments(batch, fields = None):
+    """Experiments of an archived batch (document), restricted to some fields."""
+    return open_archive(batch["archived"]["path"]).documents(fields)
+
+class Similar(object):
+    """Experiments similar to a given one, from the database first, then from the archives
+    (as a cursor, supports count and next)."""
+
+    def __init__(self, cursor, entries):
+        self.cursor = cursor
+        self.entries = entries
+        self.position = 0
+
+    def count(self):
+        return self.cursor.count() + len(self.entries)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+
+        try:
+            return self.cursor.next()
+        except StopIteration:
+            pass
+
+        if self.position >= len(self.entries):
+            raise StopIteration
+
+        path, row = self.entries[self.position]
+        self.position += 1
+        return open_archive(path).documents(None, [row]).next()
+
+def similar(cursor, parameters, executable, batch_id):
+    """Extend a cursor on similar experiments with the archived ones (of the current database,
+    not copies, out of the batch)."""
+
+    if not os.path.exists(os.path.join(directory, "index.db")):
+        return cursor
+
+    with indexing:
+        entries = index().execute("SELECT archive, row FROM experiments WHERE fingerprint = ? AND executable = ? AND batch != ? AND copy = 0 AND database = ? ORDER BY archive, row",
+            (fingerprint(parameters), executable, str(batch_id), Persistent.location())).fetchall()
+
+    # archives which were removed are ignored
+    entries = [(p, r) for (p, r) in entries if os.path.exists(p)]
+    return Similar(cursor, entries) if entries else cursor
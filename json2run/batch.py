@@ -1,15 +1,24 @@
-from persistent import Persistent
+from persistent import Persistent, PersistenceError
 import sys
 from bson.objectid import ObjectId
-from json2run import *
 from parameterexpression import *
 from threading import *
 from multiprocessing import cpu_count
 from experiment import *
-from Queue import Queue
+from pool import *
+from machine import hardware
+from progress import Throughput, remaining
+from profiler import Profiler
+from metrics import Metrics
+import profiler
+import metrics
+import events
 import datetime, time
 from time import sleep
-from scipy.stats import rankdata, chi2, t as tstudent, wilcoxon
+from raceresults import RaceResults, average_ranks
+from strategy import RaceStrategy
+from configurationspace import ConfigurationSpace
+import numpy
 from math import *
 import logging as log
 import random
@@ -47,8 +56,13 @@ class Batch(Persistent):
 
         self.interrupted = False
         self.initialized = False
-        self.running = []
-        self.enqueued = []
+        self.running = set()
+        self.enqueued = set()
+        self.profiler = Profiler()
+        self.metrics = Metrics()
+
+        # current time (virtual, when simulated)
+        self.clock = datetime.datetime.utcnow
 
     def update_generator(self, pex):
 
@@ -68,12 +82,53 @@ class Batch(Persistent):
 
     def completion(self, greedy = False):
         """Reports completion level of a batch."""
+
+        if "total" in self:
+            return (float(self["done"]) / self["total"]) * 100.0 if self["total"] else 100.0
         return (float(Experiment.get({ "batch": self["_id"] }).count()) / (self.generator.count() * float(self["repetitions"]))) * 100.0
 
     def missing(self):
         """Reports the number of missing experiments."""
+
+        if "total" in self:
+            return self["total"] - self["done"]
         return(self.generator.count() * float(self["repetitions"]) - Experiment.get({ "batch": self["_id"] }).count())
 
+    def initialize_counters(self, total):
+        """Initialize progress counters, experiments already on the batch are counted once per run."""
+
+        self["total"] = total
+        self["done"] = Experiment.get({ "batch": self.get_id() }).count()
+        self["failed"] = self["failed"] if "failed" in self else 0
+        self["sum_duration"] = self["sum_duration"] if "sum_duration" in self else 0.0
+        self.throughput = Throughput()
+
+    def count_experiment(self, experiment):
+        """Update progress counters with a finished (or failed) experiment, they're written
+        atomically ($inc) on the next save."""
+
+        if experiment.existing:
+            return
+
+        if experiment.interrupted:
+            if not experiment.cancelled and not self.interrupted:
+                self.increment("failed")
+            return
+
+        self.increment("done")
+        self.metrics.last_completion = time.time()
+        if "date_stopped" in experiment:
+            self["last_experiment"] = experiment["date_stopped"]
+
+        # throughput and durations only account for experiments actually run
+        if "duration_seconds" in experiment and not experiment["copy"]:
+            self.increment("sum_duration", experiment["duration_seconds"])
+            self.metrics.durations.observe(experiment["duration_seconds"])
+            self.throughput.record()
+            rate = self.throughput.rate()
+            if rate:
+                self["throughput"] = rate
+
     def load(self, obj):
         """Load database object and reconstitutes batch, to be used together with Batch(False)."""
         super(Batch, self).load(obj)
@@ -87,10 +142,15 @@ class Batch(Persistent):
 
         self.generator = ParameterExpression.from_string(self["generator"])
 
-    def run(self, slurm = {"use": False}, thread_n = cpu_count(), greedy = False):
-        """Runs a whole batch of experiment, possibly skipping experiment which have been already run on this or other batches."""
+    def run(self, slurm = {"use": False}, thread_n = cpu_count(), greedy = False, affinity = {"mode": "none", "cpus": 1}, pool = None):
+        """Runs a whole batch of experiment, possibly skipping experiment which have been already run on this or other batches.
+        If a pool is given, experiments are run by its workers (shared with other batches), otherwise by a pool of thread_n workers."""
 
-        self.experiment_q = ExperimentQueue(thread_n)
+        # spawn thread_n-sized thread pool (unless shared) so that we start running straight away
+        if not pool:
+            log.info("Initializing workers ...")
+            pool = ExperimentPool(thread_n, slurm, affinity)
+        self.experiment_q = pool.queue(thread_n, self["weight"] if "weight" in self else 1.0)
 
         # initialize once
         if not self.initialized:
@@ -101,15 +161,14 @@ class Batch(Persistent):
         self["threads"] = thread_n
         self["slurm_use"] = slurm["use"]
         self["slurm_cmd"] = slurm["cmd"]
+        self["affinity"] = affinity["mode"]
+        self["hardware"] = hardware()
+        self.initialize_counters(self.generator.count())
+        self.profiler = Profiler(self["profile"] if "profile" in self else None)
+        metrics.register(self)
+        events.emit("batch_started", self, type = self.type(), threads = thread_n, total = self["total"])
         self.save()
 
-        # spawn thread_n-sized thread pool so that we start running straight away
-        log.info("Initializing workers ...")
-        for ti in range(thread_n):
-            t = ExperimentRunner(self)
-            t.setDaemon(True)
-            t.start()
-
         try:
 
             # populate experiment queue (skip existing)
@@ -121,28 +180,35 @@ class Batch(Persistent):
             while self.generator.has_more() and not self.interrupted:
 
                 generated_count += 1
-                e = Experiment(self, self["executable"], self.generator.next())
+                with self.profiler.phase("generate"):
+                    e = Experiment(self, self["executable"], self.generator.next())
                 executable = e.executable
                 parameters = ParameterExpression.format(None, e.parameters, self["separator"], self["prefix"])
 
                 # if experiment is already on batch, just skip
-                if e.on_batch():
+                with self.profiler.phase("on_batch"):
+                    on_batch = e.on_batch()
+                if on_batch:
                     log.info("Skipping (%d/%d) %s %s" % (generated_count, total_count, executable, parameters))
+                    events.emit("skipped", self, e)
                     continue
 
                 # consider experiments in whole database
                 if greedy:
 
                     # look for similar experiments
-                    similar = e.get_similar()
+                    with self.profiler.phase("similar"):
+                        similar = e.get_similar()
+                        count = similar.count()
                     repetition = e["parameters"]["repetition"]
 
                     # handle repetitions
-                    if repetition >= similar.count():
+                    if repetition >= count:
 
                         # run experiment anyway (don't have enough repetitions)
                         e.set_incremental(generated_count, total_count)
-                        self.enqueued.append(e)
+                        self.enqueued.add(e)
+                        events.emit("enqueued", self, e)
                         self.experiment_q.put(e)
 
                     else:
@@ -154,19 +220,23 @@ class Batch(Persistent):
                         e.load(similar.next())
                         n = e.copy_to(self, repetition)
                         n.save()
+                        self.count_experiment(n)
                         self.save()
                         log.info("Copying (%d/%d) %s %s" % (generated_count, total_count, executable, parameters))
+                        events.emit("copied", self, e, source = str(e["batch"]))
                 else:
 
                     # run experiment normally
                     e.set_incremental(generated_count, total_count)
-                    self.enqueued.append(e)
+                    self.enqueued.add(e)
+                    events.emit("enqueued", self, e)
                     self.experiment_q.put(e)
 
-            # wait for experiments to finish
-            while self.running or self.experiment_q.qsize():
+            # wait for experiments to finish (dequeued ones included)
+            while True:
                 try:
                     self.experiment_q.join_with_timeout(1)
+                    break
                 except NotFinished:
                     continue
 
@@ -174,12 +244,14 @@ class Batch(Persistent):
             if not self.interrupted:
                 self["date_stopped"] = datetime.datetime.utcnow()
 
-            self.save()
+            self.save(Persistent.durable)
+            events.emit("batch_stopped", self, interrupted = self.interrupted, done = self["done"], failed = self["failed"])
 
         except KeyboardInterrupt:
 
             log.info("\nStopping experiments ...")
             self.interrupted = True
+            events.emit("batch_stopped", self, interrupted = True, done = self["done"], failed = self["failed"])
 
             # kill all enqueued and running processes
             map(lambda x: x.kill(), self.enqueued)
@@ -192,15 +264,34 @@ class Batch(Persistent):
     def experiment_started(self, experiment):
         """Add experiment to the list of running ones."""
         self.start_lock.acquire()
-        self.enqueued.remove(experiment)
-        self.running.append(experiment)
+        self.enqueued.discard(experiment)
+        self.running.add(experiment)
         self.start_lock.release()
 
     def experiment_finished(self, experiment):
-        """Remove experiment from the list of running ones."""
+        """Remove experiment from the list of running ones, update progress."""
         self.finish_lock.acquire()
-        self.running.remove(experiment)
+        self.running.discard(experiment)
+        self.count_experiment(experiment)
         self.finish_lock.release()
+        self.save()
+
+    def save(self, write_concern = None):
+        """Save batch, progress updates which fail are reported and written with the next save.
+        Durable saves also store the profile of the phases (if profiling)."""
+
+        if write_concern and profiler.enabled:
+            self["profile"] = self.profiler.document()
+
+        try:
+            super(Batch, self).save(write_concern)
+        except PersistenceError as e:
+            if write_concern:
+                raise
+            log.error("Failed saving progress of batch %s: %s" % (self["name"], e))
+
+    write_concern = { "w": 0 }
+    """Progress updates are fire-and-forget (final saves are durable)."""
 
     @classmethod
     def collection(cls):
@@ -226,6 +317,10 @@ class Race(Batch):
             if missing:
                 raise ValueError
 
+            # optional parameters
+            self["strategy"] = kwargs["strategy"] if "strategy" in kwargs else "frace"
+            self["eta"] = kwargs["eta"] if "eta" in kwargs else 2
+
             # initialize generator, dates
             self.generator = self["generator"]
             self["generator"] = str(self.generator)
@@ -236,33 +331,22 @@ class Race(Batch):
         # initialize generator
         self.generator = ParameterExpression.from_string(self["generator"])
 
-        # intitialize set of instances and configurations
-        instances = set()
-        self.configurations = set()
-
-        # separate instances from configurations
-        log.info("Generating all %d experiments" % self.generator.count())
-        while self.generator.has_more():
-            n = ParameterList(self.generator.next())
-
-            # get value of instance parameter
-            inst = n[self["instance_parameter"]]
-            instances.add(inst.value)
-
-            # rest of the experiment is a configuration
-            n.remove(inst)
-            self.configurations.add(n)
+        # separate instances from configurations (structurally, if possible)
+        factored = ConfigurationSpace.factor(self.generator, self["instance_parameter"])
+        if factored:
+            instances, self.configurations = factored
+        else:
+            log.info("Generating all %d experiments (this might take a while)" % self.generator.count())
+            instances, self.configurations = ConfigurationSpace.enumerate(self.generator, self["instance_parameter"])
 
-        # set -> list
-        instances = list(instances)
-        self.configurations = list(self.configurations)
+        # remove duplicates, fix order (before shuffling)
+        instances = sorted(set(instances))
 
         log.info("Race has %d configurations, %d instances (%d experiments for each configuration)." % (len(self.configurations), len(instances), len(instances) * int(self["repetitions"])))
 
-        # seed, shuffle instances
+        # seed, shuffle instances (with a private generator, batches of a campaign run concurrently)
         log.info("Shuffling instances with seed %d" % int(self["seed"]))
-        random.seed(int(self["seed"]))
-        random.shuffle(instances)
+        random.Random(int(self["seed"])).shuffle(instances)
 
         # copy of instances for use in race
         self.instances = list(instances)
@@ -297,9 +381,12 @@ class Race(Batch):
     def racing(self):
         """Return number of racing, total configurations."""
 
+        if "configurations_racing" in self:
+            return (self["configurations_racing"], self["configurations_total"])
+
         racing = 0
         total = 0
-        for c in json.loads(self["configurations"]):
+        for c in Race.survival_of(self.inner):
             if c["sum_of_ranks"] != None:
                 racing += 1
             total += 1
@@ -310,6 +397,8 @@ class Race(Batch):
         """Compute estimated number of missing experiments."""
 
         (racing, total) = self.racing()
+        if "total" in self:
+            return remaining(self.inner)
         return (self.generator.count() * int(self["repetitions"]) / total - self["iterations_completed"]) * racing
 
     def load(self, obj):
@@ -332,403 +421,518 @@ class Race(Batch):
         self.update_generator(pex)
         self.initialize_experiments()
 
-    def run(self, slurm = {"use": False}, thread_n = cpu_count(), greedy = False, alpha = 0.05):
-        """Runs a race of configurations, by constantly pruning inferior configurations."""
+    def run(self, slurm = {"use": False}, thread_n = cpu_count(), greedy = False, alpha = 0.05, affinity = {"mode": "none", "cpus": 1}, lookahead = 1, budget = 0, pool = None):
+        """Runs a race of configurations, by constantly pruning inferior configurations. Experiments
+        of up to lookahead instances past the current one are speculatively started for the racing
+        configurations, to keep the slots busy at iteration boundaries. If budget is not zero, no
+        more than budget experiments are run (or reused), those of a resumed race included. If a pool is given, experiments are run
+        by its workers (shared with other batches)."""
 
-        log.info("Initializing experiments (this might take a while)")
+        log.info("Initializing experiments")
 
-        self.experiment_q = ExperimentQueue(thread_n)
+        # spawn thread_n-sized thread pool (unless shared)
+        if not pool:
+            pool = ExperimentPool(thread_n, slurm, affinity)
+        self.experiment_q = pool.queue(thread_n, self["weight"] if "weight" in self else 1.0)
 
         # initialize once
         if not self.initialized:
             self.initialize_experiments()
 
-        log.info("Running with %d parallel threads, alpha = %f and %s." % (thread_n, alpha, ("greedy" if greedy else "non greedy")))
+        log.info("Running with %d parallel threads, alpha = %f, look-ahead of %d instances, %s strategy and %s." % (thread_n, alpha, lookahead, self["strategy"] if "strategy" in self else "frace", ("greedy" if greedy else "non greedy")))
 
         self.greedy = greedy
         self.alpha = alpha
+        self.lookahead = lookahead
+        self.iteration_closed = Condition(self.finish_lock)
 
-        # initialize data structures for configurations
-        self.racing = range(0,len(self.configurations))
+        # initialize survival data (iterations completed and sum of ranks, none if pruned or never raced)
+        self.survived = numpy.zeros(len(self.configurations), dtype = int)
+        self.survival_sor = numpy.empty(len(self.configurations))
+        self.survival_sor.fill(numpy.nan)
+        self.racing = []
 
-        # initialize configurations dictionary (for logging)
-        self.configurations_dict = [ { p.name: p.value for p in conf } for conf in self.configurations ]
+        # survival data is written once, then only for configurations whose state changed
+        self.changed = set()
+        self["configurations"] = self.survival()
 
-        for i in range(len(self.configurations_dict)):
-            self.configurations_dict[i]["iterations_completed"] = 0
-            self.configurations_dict[i]["sum_of_ranks"] = float("inf")
+        # racing strategy
+        self.strategy = RaceStrategy.from_race(self)
+        self.budget = budget
+        self.exhausted = False
 
-        log.info("Racing configurations: %s" % self.racing)
-
-        # instantiate empty arrays for each configuration
-        self.experiments = { conf_index: [] for conf_index in range(0, len(self.configurations)) }
+        # experiments already used by a resumed race (those on the batch, at least) count toward the budget
+        self.spent = 0
+        if "_id" in self:
+            self.spent = max(self["experiments_used"] if "experiments_used" in self else 0, Experiment.get({ "batch": self["_id"] }).count())
 
         # batch info (for logging)
         self.iterations_completed = 0
         self["iterations_completed"] = self.iterations_completed
         self["threads"] = thread_n
-        self["configurations"] = json.dumps(self.configurations_dict)
+        self["lookahead"] = lookahead
+        self["budget"] = budget
         self["slurm_use"] = slurm["use"]
         self["slurm_cmd"] = slurm["cmd"]
-        self.save()
-
-        # spawn thread_n-sized thread pool
-        for ti in range(thread_n):
-            t = ExperimentRunner(self)
-            t.setDaemon(True)
-            t.start()
-
-        # keep track of what we have already run, for each iteration
-        self.executed = []
-        self.iteration = []
-
-        # experiments started for each configuration (for killing)
-        self.started = { ParameterList(c): [] for c in self.configurations }
+        self["affinity"] = affinity["mode"]
+        self["hardware"] = hardware()
+        self["configurations_total"] = len(self.configurations)
+        self.initialize_counters(len(self.configurations) * self.inst_generator.count())
+        self.profiler = Profiler(self["profile"] if "profile" in self else None)
+        metrics.register(self)
+        events.emit("batch_started", self, type = self.type(), threads = thread_n, total = self["total"], configurations = len(self.configurations))
+
+        # experiments started for each configuration (for killing), and durations of the finished ones
+        self.started = {}
+        self.duration_sum = 0.0
+        self.duration_count = 0
 
         # start generating experiments
         try:
 
-            current_inst = None
-            started_iteration = -1
+            # race each bracket of configurations, keep the best survivor of each one (with its
+            # performance and survival data)
+            winners = []
+            survivors = set()
+            for configurations in self.strategy.brackets(self):
 
-            # enqueued experiments, experiments on database, missing experiments
-            enqueued = []
-            on_db = []
-            missing = []
+                self.race(configurations, greedy)
+                survivors.update(self.racing)
+                if self.racing:
+                    sum_of_ranks = self.results.sum_of_ranks
+                    best = min(self.racing, key = lambda c: (sum_of_ranks[c], c))
+                    winners.append((best, self.results.performance(best).copy(), self.survived[best], self.survival_sor[best]))
 
-            # if there are more racing configurations and instances
-            while (len(self.racing) > 1 and self.inst_generator.has_more()):
+                if self.interrupted or self.exhausted:
+                    break
 
-                # if there are no experiments to run
-                if not missing:
+            # a single winner among those of the brackets
+            if self.strategy.single_winner and winners:
+                best = self.best([(c, p) for (c, p, survived, sor) in winners])
+                survived, sor = [(w[2], w[3]) for w in winners if w[0] == best][0]
 
-                    # increment iteration
-                    current_inst = ParameterList(self.inst_generator.next())
-                    started_iteration += 1
+                # the others are no longer winners, the winner keeps the data of its bracket
+                for c in survivors:
+                    self.survival_sor[c] = numpy.nan
+                self.survived[best] = survived
+                self.survival_sor[best] = sor
+                self.changed.update(survivors)
+                self.changed.add(best)
 
-                    # initialize executed experiments for this instance
-                    self.iteration.append(current_inst)
-                    self.executed.append([])
+                self.racing = [best]
+                self["configurations_racing"] = 1
 
-                    # enqueued experiments, experiments on db
-                    enqueued = []
-                    on_db = []
+            # final save
+            if not self.interrupted:
+                self["date_stopped"] = datetime.datetime.utcnow()
 
-                    # print current instance
-                    log.info("Iteration: %s" % current_inst)
-                    
-                    # recompute missing (with new race information, sorted by sum of ranks)
-                    missing = filter(lambda x: x not in enqueued+on_db, [ParameterList(self.configurations[c]) for c in self.racing])
+            self.update_survival()
+            self["experiments_used"] = self.spent
+            self.save(Persistent.durable)
+            events.emit("batch_stopped", self, interrupted = self.interrupted, done = self["done"], failed = self["failed"])
 
+        except KeyboardInterrupt:
 
-                # sort racing by sum of ranks (low sum of ranks are run first)
-                racing = list(self.racing)
-                racing.sort(key = lambda c: self.configurations_dict[c]["sum_of_ranks"])
- 
- 	        # if there are no missing experiments for this iteration, move on
-                if not missing:
-                    continue
+            log.info("\nStopping experiments ...")
+            self.interrupted = True
+            events.emit("batch_stopped", self, interrupted = True, done = self["done"], failed = self["failed"])
 
-                # otherwise get first missing experiment
-                configuration = missing.pop(0)
+            # kill all running processes
+            map(lambda x: x.kill(), self.enqueued)
+            map(lambda x: x.kill(), self.running)
 
-                # instantiate experiment object
-                parameters = list(configuration)
-                parameters.extend(current_inst)
-                executable = self["executable"]
-                e = Experiment(self, executable, parameters, started_iteration)
+    def race(self, configurations, greedy):
+        """Race a set of configurations, from the first instance, until a single one (or none of
+        the instances) is left or the budget of experiments is exhausted."""
 
-                # generate parameter expression (for logging purposes)
-                parameters = ParameterExpression.format(None, e.parameters, self["separator"], self["prefix"])
+        # initialize data structures for configurations
+        self.finish_lock.acquire()
+        self.racing = list(configurations)
+        self.racing_set = set(self.racing)
+        self.survived[self.racing] = 0
+        self.survival_sor[self.racing] = float("inf")
+        self.changed.update(self.racing)
 
-                # if experiment already on batch, skip it
-                if e.on_batch():
-                    log.info("Skipping %s %s" % (executable, parameters))
-                    self.enqueued.append(e)
-                    self.experiment_started(e)
-                    on_db.append(configuration)
-                    self.experiment_finished(e)
-                    continue
+        log.info("Racing %d configurations" % len(self.racing))
 
-                # if greedy, try to get similar experiments from db
-                if greedy:
-                    similar = e.get_similar()
-                    repetition = e["parameters"]["repetition"]
+        # preallocate performance matrix (configurations x iterations)
+        self.results = RaceResults(len(self.configurations), self.inst_generator.count())
+        self.results.restrict(self.racing)
 
-                    # if search is negative, execute current experiment
-                    if repetition >= similar.count():
-                        self.started[configuration].append(e)
-                        self.enqueued.append(e)
-                        enqueued.append(configuration)
-                        self.experiment_q.put(e)
+        # keep track of what we have already run, for each iteration (configuration indices),
+        # and of how many of the racing configurations have completed each iteration
+        self.executed = []
+        self.completed = []
+        self.iteration = []
+        self.iterations_completed = 0
+        self.inst_generator.__init__()
+        self.finish_lock.release()
 
-                    # otherwise copy it from db
-                    else:
-                        for i in range(0, repetition):
-                            similar.next()
-                        e.load(similar.next())
-                        n = e.copy_to(self, repetition)
-                        n.save()
-                        log.info("Copying %s %s" % (executable, parameters))
-                        self.enqueued.append(e)
-                        self.experiment_started(e)
-                        on_db.append(configuration)
-                        self.experiment_finished(e)
+        self["iterations_completed"] = self.iterations_completed
+        self["configurations_racing"] = len(self.racing)
+        self["racing_history"] = [len(self.racing)]
+        self.update_survival()
+        self.save()
 
-                # if not greedy (and experiment not in batch, execute it)
-                else:
-                    self.started[configuration].append(e)
-                    enqueued.append(configuration)
-                    self.enqueued.append(e)
-                    self.experiment_q.put(e)
+        current_inst = None
+        started_iteration = -1
 
-            # wait for experiments to finish
-            while self.running or self.experiment_q.qsize():
-                try:
-                    self.experiment_q.join_with_timeout(1)
-                except NotFinished:
-                    continue
+        # missing experiments (configuration indices) for the current iteration
+        missing = []
 
-            # final save
-            if not self.interrupted:
-                self["date_stopped"] = datetime.datetime.utcnow()
+        # if there are more racing configurations and instances (or experiments of the last instance)
+        while (len(self.racing) > 1 and (missing or self.inst_generator.has_more()) and not self.interrupted):
 
-            self.save()
+            # if there are no experiments to run
+            if not missing:
 
+                # wait for the look-ahead window to move before opening a new iteration
+                if not self.wait_for_window(started_iteration + 1):
+                    break
 
-        except KeyboardInterrupt:
+                # increment iteration
+                current_inst = ParameterList(self.inst_generator.next())
+                started_iteration += 1
 
-            log.info("\nStopping experiments ...")
-            self.interrupted = True
+                # initialize executed experiments for this instance
+                self.finish_lock.acquire()
+                self.iteration.append(current_inst)
+                self.executed.append(set())
+                self.completed.append(0)
 
-            # kill all running processes
-            map(lambda x: x.kill(), self.enqueued)
-            map(lambda x: x.kill(), self.running)
+                # recompute missing with new race information, sorted by sum of ranks (low sum of ranks are run first)
+                missing = sorted(self.racing, key = lambda c: self.results.sum_of_ranks[c], reverse = True)
+                self.finish_lock.release()
 
-    def experiment_started(self, experiment):
-        super(Race, self).experiment_started(experiment)
+                # print current instance
+                log.info("Iteration: %s" % current_inst)
 
-    def experiment_finished(self, experiment):
-        """Handle experiment end, trigger pruning of inferior if needed."""
+            # if there are no missing experiments for this iteration, move on
+            if not missing:
+                continue
 
-        self.finish_lock.acquire()
-        self.running.remove(experiment)
+            # otherwise get first missing experiment (skip those pruned in the meanwhile)
+            index = missing.pop()
+            if index not in self.racing_set:
+                continue
 
-        # if we have interrupted the execution, exit
-        if self.interrupted or experiment.interrupted:
-            if not self.interrupted:
-                log.error("Experiment %s from iteration %d exited with status %d!" % (experiment.parameters, experiment.iteration, experiment.status))
-            self.finish_lock.release()
-            return
+            # instantiate experiment object
+            with self.profiler.phase("generate"):
+                parameters = list(ParameterList(self.configurations[index]))
+                parameters.extend(current_inst)
+                executable = self["executable"]
+                e = Experiment(self, executable, parameters, started_iteration)
+                e.configuration = index
+
+            # generate parameter expression (for logging purposes)
+            parameters = ParameterExpression.format(None, e.parameters, self["separator"], self["prefix"])
+
+            # if experiment already on batch, skip it (but get its performance)
+            with self.profiler.phase("on_batch"):
+                existing = e.find_on_batch({ "stats."+self["performance_parameter"]: 1 })
+            if existing:
+                log.info("Skipping %s %s" % (executable, parameters))
+                events.emit("skipped", self, e)
+                e["stats"] = existing["stats"] if "stats" in existing else {}
+                e.existing = True
+                self.enqueued.add(e)
+                self.experiment_started(e)
+                self.experiment_finished(e)
+                continue
+
+            # stop if the budget of experiments is exhausted (experiments on the batch are already counted)
+            if self.budget and self.spent >= self.budget:
+                log.info("Budget of %d experiments exhausted." % self.budget)
+                self.exhausted = True
+                break
+            self.spent += 1
 
-        # get the experiment's configuration
-        configuration = [p for p in experiment.parameters if p.name != self["instance_parameter"]]
+            # if greedy, try to get similar experiments from db
+            if greedy:
+                with self.profiler.phase("similar"):
+                    similar = e.get_similar()
+                    count = similar.count()
+                repetition = e["parameters"]["repetition"]
 
-        # add terminated experiment to list of executed experiments
-        self.executed[experiment.iteration].append(ParameterList(configuration))
+                # if search is negative, execute current experiment (unless pruned in the meanwhile)
+                if repetition >= count:
+                    if not self.enqueue(index, e):
+                        self.spent -= 1
 
-        for e in range(len(self.executed)):
-           if e >= self.iterations_completed and len(self.executed[e]):
-               print "Iteration %d has %d experiments to go." % (e, len(self.racing) - len(self.executed[e]))
+                # otherwise copy it from db
+                else:
+                    for i in range(0, repetition):
+                        similar.next()
+                    e.load(similar.next())
+                    e["copy"] = True
+                    n = e.copy_to(self, repetition)
+                    n.save()
+                    log.info("Copying %s %s" % (executable, parameters))
+                    events.emit("copied", self, e, source = str(e["batch"]))
+                    self.enqueued.add(e)
+                    self.experiment_started(e)
+                    self.experiment_finished(e)
 
-        # only process current iteration (to be compliant with race)
-        if self.iterations_completed != experiment.iteration:
-            self.finish_lock.release()
-            return
+            # if not greedy (and experiment not in batch, execute it, unless pruned in the meanwhile)
+            elif not self.enqueue(index, e):
+                self.spent -= 1
 
-        # process completed iterations in order
+        # wait for experiments to finish (dequeued ones included)
         while True:
+            try:
+                self.experiment_q.join_with_timeout(1)
+                break
+            except NotFinished:
+                continue
 
-            # gather needed experiments to perform next pruning
-            needed = [ParameterList(self.configurations[c]) for c in self.racing]
-            needed_in_place = set(needed).issubset(set(self.executed[self.iterations_completed]))
+    def enqueue(self, index, experiment):
+        """Enqueue an experiment of a configuration, returns False if the configuration was pruned
+        or the race is over (checked, and the experiment registered, under finish_lock so that
+        cancel can't miss it)."""
 
-            # if all needed experiments are terminated
-            if needed_in_place:
+        self.finish_lock.acquire()
+        try:
+            if index not in self.racing_set or len(self.racing) <= 1:
+                return False
+            self.started.setdefault(index, set()).add(experiment)
+        finally:
+            self.finish_lock.release()
 
-                # also check if we still need to race
-                if len(self.racing) > 1:
+        self.enqueued.add(experiment)
+        events.emit("enqueued", self, experiment)
+        self.experiment_q.put(experiment)
+        return True
 
-                    self.prune_inferiors()
-                    self.iterations_completed += 1
+    def experiment_started(self, experiment):
+        super(Race, self).experiment_started(experiment)
 
-                    # update survival data
-                    for i in range(len(self.configurations_dict)):
-                        self.configurations_dict[i]["sum_of_ranks"] = None
+    def experiment_finished(self, experiment):
+        """Handle experiment end, update progress, trigger pruning of inferior if needed."""
 
-                    for i in range(len(self.racing)):
-                        c = self.racing[i]
-                        self.configurations_dict[c]["iterations_completed"] = self.iterations_completed
-                        self.configurations_dict[c]["sum_of_ranks"] = self.last_sor[i]
+        self.finish_lock.acquire()
+        try:
+            self.running.discard(experiment)
+            self.count_experiment(experiment)
+            self.process_experiment(experiment)
+        finally:
+            self.finish_lock.release()
 
-                    # update counter, just for completion info
-                    self["iterations_completed"] = self.iterations_completed
-                    self["configurations"] = json.dumps(self.configurations_dict)
+        self.save()
 
-                    # save temporary status of race
-                    self.save()
+    def process_experiment(self, experiment):
+        """Record the performance of an experiment, close iterations which are complete (under finish lock)."""
 
-                    # if we're still racing
-                    if len(self.racing) > 1:
+        # experiment is no longer killable
+        if experiment.configuration in self.started:
+            self.started[experiment.configuration].discard(experiment)
 
-                        pass
+        # if we have interrupted the execution, exit
+        if self.interrupted or experiment.interrupted:
+            if not self.interrupted and not experiment.cancelled:
+                log.error("Experiment %s from iteration %d exited with status %d!" % (experiment.parameters, experiment.iteration, experiment.status))
+            return
 
-                        # kill all experiments related to pruned configurations
-                        # pruned = [c for c in self.started if c not in map(lambda x: self.configurations[x], self.racing)]
-                        # for p in pruned:
-                        #    while self.started[p]:
-                        #        e = self.started[p].pop(0)
-                        #        e.kill()
+        # keep track of experiments' duration (to estimate savings of cancellations)
+        if "duration_seconds" in experiment and not experiment["copy"]:
+            self.duration_sum += experiment["duration_seconds"]
+            self.duration_count += 1
 
-                    # if we have already a winner
-                    else:
+        # store performance of the experiment
+        try:
+            self.results.record(experiment.configuration, experiment.iteration, float(experiment["stats"][self["performance_parameter"]]))
+        except (KeyError, TypeError, ValueError):
+            log.error("Experiment %s from iteration %d has no valid '%s' statistic!" % (experiment.parameters, experiment.iteration, self["performance_parameter"]))
+            return
 
-                        # kill all enqueued experiments
-                        for p in self.started:
-                            while self.started[p]:
-                                e = self.started[p].pop(0)
-                                e.kill()
+        # add terminated experiment to the executed ones, count it if it is still racing
+        iteration = experiment.iteration
+        if experiment.configuration not in self.executed[iteration]:
+            self.executed[iteration].add(experiment.configuration)
+            if experiment.configuration in self.racing_set:
+                self.completed[iteration] += 1
 
-                    # avoid trying to prune with an empty iteration
-                    if len(self.executed) <= self.iterations_completed:
-                        break
-                else:
+        if iteration >= self.iterations_completed:
+            log.debug("Iteration %d has %d experiments to go." % (iteration, len(self.racing) - self.completed[iteration]))
 
-                    # kill all enqueued experiments, then break (no more pruning to do)
-                    for p in self.started:
-                        while self.started[p]:
-                            e = self.started[p].pop(0)
-                            e.kill()
-                    break
-            else:
-                break
+        # only process current iteration (to be compliant with race)
+        if self.iterations_completed != iteration:
+            return
 
-        self.finish_lock.release()
+        # process completed iterations in order, as long as all needed experiments are terminated
+        while self.iterations_completed < len(self.executed) and self.completed[self.iterations_completed] == len(self.racing):
 
-    def prune_inferiors(self):
-        """Prune inferior configurations according to Friedman and Wilcoxon tests."""
+            # also check if we still need to race
+            if len(self.racing) > 1:
 
-        # get all experiments of the current configurations
-        for c in self.racing:
+                self.prune_inferiors()
+                self.iterations_completed += 1
+                pruned = self.racing_set.difference(self.racing)
 
-            self.instance = self.iteration[self.iterations_completed]
+                events.emit("iteration_closed", self, iteration = self.iterations_completed - 1, racing = len(self.racing))
+                if pruned:
+                    events.emit("pruned", self, iteration = self.iterations_completed - 1, configurations = sorted(pruned))
 
-            parameters = { "parameters."+p.name: p.value for p in self.configurations[c]+self.instance }
-            parameters = dict(parameters.items() + { "batch": self.get_id() }.items())
+                # update survival data (only for configurations whose state changed)
+                for c in pruned:
+                    self.survival_sor[c] = numpy.nan
 
-            exp = Experiment.get(parameters, { "stats."+self["performance_parameter"]: 1 })
+                self.survived[self.racing] = self.iterations_completed
+                self.survival_sor[self.racing] = self.last_sor
+                self.changed.update(pruned)
+                self.changed.update(self.racing)
 
-            e = None
-            if exp.count():
-                e = exp.next()
-            else:
-                log.error("Failed fetching %s" % parameters)
-                sys.exit(1)
+                # pruned configurations no longer count towards the completion of open iterations
+                self.racing_set = set(self.racing)
+                for c in pruned:
+                    for i in range(self.iterations_completed, len(self.executed)):
+                        if c in self.executed[i]:
+                            self.completed[i] -= 1
 
-            self.experiments[c].append(e["stats"][self["performance_parameter"]])
+                # let the coordinator open the next iteration
+                self.iteration_closed.notify_all()
 
-        # compute ranks
-        conf_rank, inst_rank, sum_of_ranks, ties = self.compute_ranks([self.experiments[c] for c in self.racing])
+                # update counter, just for completion info (and survival rate, for the eta)
+                self["iterations_completed"] = self.iterations_completed
+                self["configurations_racing"] = len(self.racing)
+                self["racing_history"].append(len(self.racing))
+                self.touch("racing_history")
+                self.update_survival()
 
-        # print debug information about sum of ranks
-        for c in self.racing:
-            log.info("%s: %s %s, (sum: %s)" % (c, self.experiments[c], conf_rank[self.racing.index(c)], sum_of_ranks[self.racing.index(c)]))
+                # save temporary status of race
+                self.save()
 
+                # if we're still racing, cancel all experiments related to pruned configurations
+                if len(self.racing) > 1:
+                    self.cancel(pruned)
 
-        # if it's time to prune
-        if self.iterations_completed+1 >= self["initial_block"]:
+                # if we have already a winner, cancel all enqueued experiments
+                else:
+                    self.cancel(self.started.keys())
 
-            n = float(self.iterations_completed+1)
-            k = float(len(self.racing))
+            else:
 
-            log.info("Checking null hypothesis against %d configurations on %d samples ..." % (k, n))
+                # cancel all enqueued experiments, then break (no more pruning to do)
+                self.cancel(self.started.keys())
+                break
 
-            if k > 2:
-                # use friedman
-                log.info("Running Friedman rank sum test")
 
-                # sum of squares of ( sumOfRanks[treatment] - n * ( k + 1 ) / 2.0 ), which is used in various statistics
-                r = sum([ pow(s - n * (k + 1) / 2, 2) for s in sum_of_ranks ])
+    def survival(self):
+        """Survival data of the configurations (parameters, iterations completed and sum of ranks, None if pruned or never raced)."""
 
-                # ties correction
-                ties_correction = sum([sum(map(lambda x: x**3 - x, t)) / (k - 1) for t in ties])
+        survival = []
+        for c in xrange(len(self.configurations)):
+            conf = { p.name: p.value for p in self.configurations[c] }
+            conf["iterations_completed"] = int(self.survived[c])
+            conf["sum_of_ranks"] = None if numpy.isnan(self.survival_sor[c]) else float(self.survival_sor[c])
+            survival.append(conf)
 
-                # default statistic
-                if (n * k * (k+1)) - ties_correction != 0:
-                    statistic = 12 * r / ((n * k * (k+1)) - ties_correction)
-                else:
-                    statistic = float('inf')
+        return survival
 
-                # sum of squared ranks
-                a = sum([sum([pow(j,2) for j in i]) for i in inst_rank])
+    def update_survival(self):
+        """Update survival data of the configurations whose state changed (only those are written on save)."""
 
-                log.info("Statistic: %f" % statistic)
+        for c in self.changed:
+            self.set_path("configurations.%d.iterations_completed" % c, int(self.survived[c]))
+            self.set_path("configurations.%d.sum_of_ranks" % c, None if numpy.isnan(self.survival_sor[c]) else float(self.survival_sor[c]))
+        self.changed = set()
 
-                p_value = 1 - chi2.cdf(statistic, k-1)
+    @staticmethod
+    def survival_of(race):
+        """Survival data of a race document (stored as a JSON string by older versions)."""
 
-                self["p_value"] = p_value
+        configurations = race["configurations"] if "configurations" in race else []
+        if isinstance(configurations, basestring):
+            return json.loads(configurations)
+        return configurations
 
-                log.info("P-value: %f" % p_value)
+    def wait_for_window(self, iteration):
+        """Wait until an iteration falls in the look-ahead window (i.e. it is at most lookahead
+        iterations past the first open one), returns False if the race is over in the meanwhile."""
 
-                if p_value <= self.alpha:
+        self.finish_lock.acquire()
+        try:
+            while iteration > self.iterations_completed + self.lookahead:
 
-                    t_student = tstudent.ppf(1-self.alpha/2, (n-1)*(k-1)) * sqrt(2 * (n * a - sum([ pow(rk,2) for rk in sum_of_ranks ])) / ((n-1) * (k-1)))
-                    best_sum = min(sum_of_ranks)
+                if len(self.racing) <= 1 or self.interrupted:
+                    return False
 
-                    log.info("t: %f" % (t_student))
+                # if nothing is pending the first open iteration can't be closed (failed experiments), move on
+                if not self.experiment_q.unfinished_tasks:
+                    log.error("Iteration %d can't be completed, moving on." % self.iterations_completed)
+                    break
 
-                    for c in self.racing:
-                        log.info("%d: (%f - %f = %f) vs. %f" % (c, sum_of_ranks[self.racing.index(c)], best_sum, abs(sum_of_ranks[self.racing.index(c)] - best_sum), t_student))
+                self.experiment_q.pool.wait(self.iteration_closed, 1)
+        finally:
+            self.finish_lock.release()
 
-                    self.racing = filter(lambda i: abs(sum_of_ranks[self.racing.index(i)] - best_sum) <= t_student, self.racing)
+        return True
 
-            else:
+    def cancel(self, configurations):
+        """Drop queued experiments and kill running ones for a set of configurations, report CPU time saved."""
 
-                # wilcoxon
-                log.info("Running Wilcoxon signed-rank test")
+        now = self.clock()
+        mean = self.duration_sum / self.duration_count if self.duration_count else 0.0
+        queued = 0
+        running = 0
+        saved = 0.0
 
-                if n < 10:
-                    log.info("Sample size too small for Wilcoxon signed-rank test")
-                else:
-                    p_value = wilcoxon(*[self.experiments[c] for c in self.racing])[1]
+        for c in list(configurations):
+            for e in self.started.pop(c, []):
 
-                    self["p_value"] = p_value
+                # running experiments save the rest of their (expected) duration
+                if e in self.running and "date_started" in e:
+                    running += 1
+                    saved += max(0.0, mean - (now - e["date_started"]).total_seconds())
+                else:
+                    queued += 1
+                    saved += mean
 
-                    log.info("P-value: %s" % p_value)
+                e.cancel()
 
-                    if p_value <= self.alpha:
+        if queued or running:
+            self.increment("cpu_seconds_saved", saved)
+            log.info("Cancelled %d queued and %d running experiments of pruned configurations, saving about %.1f CPU-seconds (%.1f so far)." % (queued, running, saved, self["cpu_seconds_saved"]))
 
-                        log.info("Old racing: %s" % (self.racing))
+    def best(self, winners):
+        """The best of the winners of different brackets (configuration and performance), whose
+        sums of ranks can't be compared: rank them on the first iterations, which all of them
+        raced (each bracket starts from the first instance)."""
 
-                        if sum_of_ranks[0] <  sum_of_ranks[1]:
-                            self.racing = [self.racing[0]]
-                        else:
-                            self.racing = [self.racing[1]]
+        raced = [(c, p) for (c, p) in winners if len(p)] or winners[:1]
+        common = min(len(p) for (c, p) in raced)
+        if len(raced) == 1 or not common:
+            return raced[0][0]
 
-        log.info("New racing: %s" % (self.racing))
-        self.last_sor = [sum_of_ranks[self.racing.index(rc)] for rc in self.racing]
-        log.info("Sum of ranks: %s" % ([sum_of_ranks[self.racing.index(rc)] for rc in self.racing]))
+        ranks, ties = average_ranks(numpy.array([p[:common] for (c, p) in raced]))
+        sum_of_ranks = ranks.sum(axis = 1)
+        best = min(range(len(raced)), key = lambda i: (sum_of_ranks[i], raced[i][0]))
 
-    def compute_ranks(self, experiments):
-        """Compute per-configuration ranks."""
+        log.info("Best configuration among the winners of the brackets %s, on the first %d iterations: %d" % ([c for (c, p) in raced], common, raced[best][0]))
+        return raced[best][0]
 
-        # experiments:
-        # conf1: [x,y,z,...]
-        # conf2: [i,j,k,...]
+    def prune_inferiors(self):
+        """Rank the racing configurations on the iteration just completed, prune the inferior ones according to the strategy."""
 
-        inst_first = map(list, zip(*experiments))
-        inst_rank = [list(rankdata(l)) for l in inst_first]
+        # rank racing configurations on the iteration just completed (performance is already in place)
+        self.results.rank(self.iterations_completed)
+        sum_of_ranks = self.results.sum_of_ranks
 
-        # results
-        conf_rank = zip(*inst_rank)
+        # print debug information about sum of ranks
+        if log.getLogger().isEnabledFor(log.DEBUG):
+            for c in self.racing:
+                log.debug("%s: %s (sum: %s)" % (c, self.results.performance(c), sum_of_ranks[c]))
 
-        # compute ties
-        ties = [[len(filter(lambda x: x == t,a)) for t in set(a)] for a in inst_rank]
+        # prune according to the racing strategy
+        with self.profiler.phase("prune"):
+            self.racing = self.strategy.prune(self, self.iterations_completed+1)
 
-        # calculate sum of ranks
-        sum_of_ranks = map(sum, conf_rank)
+        log.info("New racing: %s" % (self.racing if len(self.racing) <= 100 else "%d configurations" % len(self.racing)))
+        self.last_sor = [float(sum_of_ranks[c]) for c in self.racing]
+        if len(self.racing) <= 100:
+            log.info("Sum of ranks: %s" % (self.last_sor))
 
-        return conf_rank, inst_rank, sum_of_ranks, ties
+        # re-rank survivors (only happens if something was pruned)
+        self.results.restrict(self.racing)
 
     def type(self):
         return "race"
@@ -736,22 +940,3 @@ class Race(Batch):
     @classmethod
     def collection(cls):
         return "batches"
-
-
-class ExperimentQueue(Queue):
-    """Specialization of Queue to have timed join"""
-
-    def join_with_timeout(self, timeout):
-        self.all_tasks_done.acquire()
-        try:
-            endtime = time.time() + timeout
-            while self.unfinished_tasks:
-                remaining = endtime - time.time()
-                if remaining <= 0.0:
-                    raise NotFinished
-                self.all_tasks_done.wait(remaining)
-        finally:
-            self.all_tasks_done.release()
-
-class NotFinished(Exception):
-    pass
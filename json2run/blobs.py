@@ -0,0 +1,99 @@
+from persistent import *
+from storage import SQLiteDatabase
+import sqlite3
+import hashlib
+import json
+import zlib
+
+codec = "zlib"
+"""Compression of stored payloads (zlib, or zstd if the zstandard module is installed)."""
+
+threshold = 1 << 16
+"""Size (in bytes, serialized) above which payloads are stored out of the experiment document."""
+
+def compress(data, codec):
+    """Compress a string with a codec."""
+
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    return zlib.compress(data, 6)
+
+def decompress(data, codec):
+    """Decompress a string compressed with a codec."""
+
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+class GridFSBlobs(object):
+    """Blobs stored in GridFS (MongoDB), in the blobs bucket."""
+
+    def __init__(self, database):
+        import gridfs
+        self.fs = gridfs.GridFS(database, "blobs")
+
+    def put(self, key, data):
+        """Store data under a key, unless already there (e.g. stored concurrently)."""
+
+        from pymongo.errors import DuplicateKeyError
+        from gridfs.errors import FileExists
+
+        if self.fs.exists(key):
+            return
+        try:
+            self.fs.put(data, _id = key)
+        except (FileExists, DuplicateKeyError):
+            pass
+
+    def get(self, key):
+        """Data stored under a key."""
+        return self.fs.get(key).read()
+
+class SQLiteBlobs(object):
+    """Blobs stored in a table of a local database."""
+
+    def __init__(self, database):
+        self.database = database
+        database.execute("CREATE TABLE IF NOT EXISTS blobs (key TEXT PRIMARY KEY, data BLOB)")
+        database.commit()
+
+    def put(self, key, data):
+        """Store data under a key, unless already there."""
+        self.database.execute("INSERT OR IGNORE INTO blobs (key, data) VALUES (?, ?)", (key, sqlite3.Binary(data)), True)
+
+    def get(self, key):
+        """Data stored under a key."""
+
+        rows = self.database.query("SELECT data FROM blobs WHERE key = ?", (key,))
+        if not rows:
+            raise KeyError("Missing blob %s" % key)
+        return str(rows[0][0])
+
+stores = {}
+"""Blob store of each database."""
+
+def store():
+    """Blob store of the current database."""
+
+    database = Persistent.database
+    if id(database) not in stores:
+        stores[id(database)] = SQLiteBlobs(database) if isinstance(database, SQLiteDatabase) else GridFSBlobs(database)
+    return stores[id(database)]
+
+def put(value):
+    """Store a (JSON) value compressed, content-addressed (identical values compressed with the
+    same codec are stored once), return its reference."""
+
+    data = json.dumps(value, separators = (",", ":"))
+    key = hashlib.sha1(codec + ":" + data).hexdigest()
+    compressed = compress(data, codec)
+    Persistent.retry(store().put, key, compressed)
+    return { "key": key, "codec": codec, "size": len(data), "stored": len(compressed) }
+
+def get(reference):
+    """Load a value from its reference."""
+
+    data = Persistent.retry(store().get, reference["key"])
+    return json.loads(decompress(data, reference["codec"]))
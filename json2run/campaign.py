@@ -0,0 +1,159 @@
+from batch import *
+from pool import *
+from strategy import reduction
+from threading import Thread
+from multiprocessing import cpu_count
+import json
+import os
+import logging as log
+
+class Campaign(object):
+    """A set of batches and races run together on a single pool of workers, each one getting a
+    share of the pool proportional to its weight. Experiments shared by several batches are run once."""
+
+    def __init__(self, spec, directory = ".", defaults = {}):
+        """Initializes campaign from its (JSON) description, input files are relative to directory,
+        missing settings are taken from defaults."""
+
+        self.spec = spec
+        self.directory = directory
+        self.defaults = defaults
+        self.batches = []
+        self.settings = []
+        self.interrupted = False
+
+    @staticmethod
+    def from_file(path, defaults = {}):
+        """Loads campaign description from a JSON file."""
+
+        with open(path, "r") as f:
+            spec = json.load(f)
+
+        return Campaign(spec, os.path.dirname(os.path.abspath(path)), defaults)
+
+    def setting(self, entry, name, default = None):
+        """Get a setting of a batch, falling back on campaign defaults."""
+
+        if name in entry:
+            return entry[name]
+        if name in self.defaults:
+            return self.defaults[name]
+        return default
+
+    def generator(self, entry):
+        """Parameter expression of a batch (either inline or from an input file)."""
+
+        if "generator" in entry:
+            return ParameterExpression.from_string(json.dumps(entry["generator"]))
+
+        with open(os.path.join(self.directory, entry["input"]), "r") as f:
+            return ParameterExpression.from_string(f.read())
+
+    def initialize(self):
+        """Create the batches of the campaign, resuming unfinished ones and skipping complete ones."""
+
+        # check the settings of all the races before any of them is started
+        for entry in self.spec["batches"]:
+            if self.setting(entry, "type", "batch") == "race" and self.setting(entry, "strategy", "frace") in ["halving", "hyperband"]:
+                reduction(self.setting(entry, "eta", 2))
+
+        for entry in self.spec["batches"]:
+
+            kind = self.setting(entry, "type", "batch")
+            cls = Race if kind == "race" else Batch
+
+            samename = [b for b in cls.get({ "name": entry["name"] })]
+            unfinished = [b for b in samename if b["date_started"] == b["date_stopped"]]
+
+            # resume
+            if unfinished:
+
+                log.info("Resuming unfinished %s %s." % (kind, entry["name"]))
+                batch = cls(False)
+                batch.load(unfinished.pop())
+
+            # skip complete
+            elif samename:
+
+                log.info("A complete batch named %s is already on the database, skipping it." % entry["name"])
+                continue
+
+            # initialize
+            else:
+
+                common = {
+                    "name": entry["name"],
+                    "generator": self.generator(entry),
+                    "executable": self.setting(entry, "executable"),
+                    "repetitions": int(self.setting(entry, "repetitions", 1)),
+                    "prefix": self.setting(entry, "prefix", ParameterExpression.def_prefix),
+                    "separator": self.setting(entry, "separator", ParameterExpression.def_separator)
+                }
+
+                if kind == "race":
+                    batch = Race(initial_block = int(self.setting(entry, "initial_block", 10)),
+                                 instance_parameter = self.setting(entry, "instance_parameter"),
+                                 performance_parameter = self.setting(entry, "performance_parameter"),
+                                 seed = self.setting(entry, "seed", 0),
+                                 strategy = self.setting(entry, "strategy", "frace"),
+                                 eta = self.setting(entry, "eta", 2),
+                                 **common)
+                else:
+                    batch = Batch(**common)
+
+            batch["weight"] = float(self.setting(entry, "weight", 1.0))
+            batch["campaign"] = self.spec["name"] if "name" in self.spec else None
+
+            self.batches.append(batch)
+            self.settings.append(entry)
+
+    def run(self, slurm = {"use": False}, thread_n = cpu_count(), affinity = {"mode": "none", "cpus": 1}):
+        """Run all batches on a shared pool of thread_n workers, until all of them are over."""
+
+        if not self.batches:
+            self.initialize()
+
+        log.info("Running campaign of %d batches on %d parallel threads." % (len(self.batches), thread_n))
+
+        pool = ExperimentPool(thread_n, slurm, affinity)
+
+        threads = []
+        for batch, entry in zip(self.batches, self.settings):
+
+            greedy = self.setting(entry, "greedy", False)
+
+            if batch.type() == "race":
+                arguments = (slurm, thread_n, greedy, self.setting(entry, "alpha", 0.05), affinity, int(self.setting(entry, "lookahead", 1)), int(self.setting(entry, "budget", 0)), pool)
+            else:
+                arguments = (slurm, thread_n, greedy, affinity, pool)
+
+            t = Thread(target = batch.run, args = arguments, name = batch["name"])
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        try:
+
+            # wait with a timeout, so that the main thread can be interrupted
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(1)
+
+        except KeyboardInterrupt:
+
+            log.info("\nStopping experiments ...")
+            self.interrupt()
+
+            # let batches drain their queues and save their state
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(1)
+
+    def interrupt(self):
+        """Interrupt all batches, kill enqueued and running experiments."""
+
+        self.interrupted = True
+        for batch in self.batches:
+            batch.interrupted = True
+            map(lambda x: x.kill(), list(batch.enqueued))
+            map(lambda x: x.kill(), list(batch.running))
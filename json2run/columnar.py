@@ -0,0 +1,313 @@
+from persistent import *
+from experiment import Experiment
+from storage import settled
+from bson.objectid import ObjectId
+import numpy
+import json
+import os
+import logging as log
+
+dtypes = { "int": "int64", "float": "float64", "categorical": "int32" }
+"""Storage type of each kind of column (categorical columns store codes, -1 if missing)."""
+
+def kind(value):
+    """Kind of column needed to store a value (None if missing)."""
+
+    if value is None:
+        return None
+    if isinstance(value, (bool, int, long)):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    return "categorical"
+
+def widest(kinds):
+    """Kind of column able to store values of all the given kinds."""
+
+    if "categorical" in kinds:
+        return "categorical"
+    if "float" in kinds:
+        return "float"
+    return "int"
+
+class Column(object):
+    """A typed column, stored as a raw binary file (memory-mapped when read)."""
+
+    def __init__(self, directory, spec):
+        """Initializes column from its schema entry."""
+
+        self.directory = directory
+        self.name = spec["name"]
+        self.kind = spec["kind"]
+        self.file = spec["file"]
+        self.categories = spec["categories"] if "categories" in spec else []
+        self.codes = { c: i for i, c in enumerate(self.categories) }
+
+    def spec(self):
+        """Schema entry of the column."""
+
+        spec = { "name": self.name, "kind": self.kind, "dtype": dtypes[self.kind], "file": self.file }
+        if self.kind == "categorical":
+            spec["categories"] = self.categories
+        return spec
+
+    def path(self):
+        return os.path.join(self.directory, self.file)
+
+    def read(self, rows):
+        """Memory-mapped content of the column."""
+
+        if not rows:
+            return numpy.empty(0, dtype = dtypes[self.kind])
+        return numpy.memmap(self.path(), dtype = dtypes[self.kind], mode = "r", shape = (rows,))
+
+    def decode(self, rows):
+        """Values of the column (categories instead of codes, None if missing)."""
+
+        data = self.read(rows)
+        if self.kind != "categorical":
+            return data
+
+        categories = numpy.array(self.categories + [None], dtype = object)
+        return categories[data]
+
+    def encode(self, values):
+        """Typed array of a list of values (with this column's kind)."""
+
+        if self.kind == "int":
+            return numpy.array(values, dtype = "int64")
+
+        if self.kind == "float":
+            return numpy.array([numpy.nan if v is None else v for v in values], dtype = "float64")
+
+        codes = numpy.empty(len(values), dtype = "int32")
+        for i, v in enumerate(values):
+            if v is None:
+                codes[i] = -1
+                continue
+            if not isinstance(v, basestring):
+                v = json.dumps(v, sort_keys = True, default = str)
+            if v not in self.codes:
+                self.codes[v] = len(self.categories)
+                self.categories.append(v)
+            codes[i] = self.codes[v]
+        return codes
+
+    def truncate(self, rows):
+        """Drop data past the first rows (left over by an interrupted refresh)."""
+
+        size = rows * numpy.dtype(dtypes[self.kind]).itemsize
+        with open(self.path(), "ab") as f:
+            f.truncate(size)
+
+    def append(self, values):
+        """Append values (of this column's kind) at the end of the column."""
+
+        with open(self.path(), "ab") as f:
+            f.write(self.encode(values).tostring())
+
+    def promote(self, kind, rows):
+        """Rewrite the column with a wider kind."""
+
+        old = [None if (self.kind == "float" and numpy.isnan(v)) else v for v in self.decode(rows).tolist()]
+        if self.kind == "int" and kind == "categorical":
+            old = [str(v) for v in old]
+        if self.kind == "float" and kind == "categorical":
+            old = [None if v is None else repr(v) for v in old]
+
+        self.kind = kind
+        data = self.encode(old)
+        with open(self.path() + ".tmp", "wb") as f:
+            f.write(data.tostring())
+        os.rename(self.path() + ".tmp", self.path())
+
+class ColumnarCache(object):
+    """Local columnar copy of the parameters and stats of a batch's experiments, one file per
+    column plus a JSON schema. It is refreshed incrementally, i.e. only experiments newer than
+    the high-water mark are fetched. The mark only covers experiments which are surely on the
+    database (see storage.settled), the newer ones which are cached are listed as recent."""
+
+    def __init__(self, directory):
+        """Open (or prepare) cache in a directory."""
+
+        self.directory = directory
+        self.schema_path = os.path.join(directory, "schema.json")
+
+        if os.path.exists(self.schema_path):
+            with open(self.schema_path, "r") as f:
+                self.schema = json.load(f)
+        else:
+            self.schema = { "rows": 0, "high_water": None, "recent": [], "columns": [] }
+
+        self.columns = [Column(directory, spec) for spec in self.schema["columns"]]
+        self.by_name = { c.name: c for c in self.columns }
+
+    @property
+    def rows(self):
+        return self.schema["rows"]
+
+    def names(self):
+        """Names of the columns (parameters.<name> and stats.<name>)."""
+        return [c.name for c in self.columns]
+
+    def __getitem__(self, name):
+        """Values of a column: memory-mapped for numeric columns, decoded for categorical ones."""
+        return self.by_name[name].decode(self.rows)
+
+    def codes(self, name):
+        """Memory-mapped codes of a categorical column (see categories)."""
+        return self.by_name[name].read(self.rows)
+
+    def categories(self, name):
+        """Categories of a categorical column."""
+        return self.by_name[name].categories
+
+    def save_schema(self):
+        """Write schema (atomically), it defines which rows are valid."""
+
+        self.schema["columns"] = [c.spec() for c in self.columns]
+        with open(self.schema_path + ".tmp", "w") as f:
+            json.dump(self.schema, f, indent = 1)
+        os.rename(self.schema_path + ".tmp", self.schema_path)
+
+    def column(self, name):
+        """Get a column, creating it (with missing values for the existing rows) if needed."""
+
+        if name not in self.by_name:
+            c = Column(self.directory, { "name": name, "kind": "int", "file": "%s.bin" % name.replace(os.sep, "_") })
+            open(c.path(), "wb").close()
+            self.columns.append(c)
+            self.by_name[name] = c
+            if self.rows:
+                c.kind = "float"
+                c.append([None] * self.rows)
+        return self.by_name[name]
+
+    def write(self, chunk):
+        """Append a chunk of experiments."""
+
+        names = set()
+        for e in chunk:
+            for field in ["parameters", "stats"]:
+                if field in e:
+                    names.update("%s.%s" % (field, k) for k in e[field])
+
+        for name in sorted(names) + [c.name for c in self.columns if c.name not in names]:
+
+            field, key = name.split(".", 1)
+            values = []
+            for e in chunk:
+                v = e[field][key] if field in e and key in e[field] else None
+
+                # flags (parameters without value) are set
+                if field == "parameters" and key in e.get(field, {}) and v is None:
+                    v = "true"
+                values.append(v)
+
+            c = self.column(name)
+            kinds = set(kind(v) for v in values)
+            missing = None in kinds
+            kinds.discard(None)
+
+            needed = widest(kinds | set([c.kind])) if kinds else c.kind
+            if needed == "int" and missing:
+                needed = "float"
+            if needed != c.kind and (needed == "categorical" or c.kind == "int"):
+                c.promote(needed, self.rows)
+
+            c.append(values)
+
+        self.schema["rows"] += len(chunk)
+
+    def refresh(self, batch_id, name = None, batch_size = 10000):
+        """Fetch experiments of a batch newer than the high-water mark, append them, return their number."""
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        if self.schema.get("batch") not in (None, str(batch_id)):
+            raise ValueError("Cache in %s belongs to another batch." % self.directory)
+
+        self.schema["batch"] = str(batch_id)
+        if name:
+            self.schema["name"] = name
+
+        # discard partially written rows
+        for c in self.columns:
+            c.truncate(self.rows)
+
+        # experiments past the mark, but those already cached
+        query = { "batch": batch_id }
+        high_water = ObjectId(self.schema["high_water"]) if self.schema["high_water"] else None
+        recent = set(self.schema.get("recent", []))
+        if high_water or recent:
+            query["_id"] = {}
+        if high_water:
+            query["_id"]["$gt"] = high_water
+        if recent:
+            query["_id"]["$nin"] = [ObjectId(r) for r in recent]
+
+        # the mark moves up to the experiments which are surely on the database
+        cutoff = settled()
+        if high_water is None or cutoff > high_water:
+            high_water = cutoff
+
+        fetched = 0
+        chunk = []
+        for e in Experiment.get(query, ["parameters", "stats"]).batch_size(batch_size):
+            chunk.append(e)
+            if e["_id"] > high_water:
+                recent.add(str(e["_id"]))
+
+            if len(chunk) == batch_size:
+                self.write(chunk)
+                fetched += len(chunk)
+                chunk = []
+
+        if chunk:
+            self.write(chunk)
+            fetched += len(chunk)
+
+        self.schema["high_water"] = str(high_water)
+        self.schema["recent"] = sorted(r for r in recent if ObjectId(r) > high_water)
+        self.save_schema()
+
+        log.info("Fetched %d new experiments, %d in cache." % (fetched, self.rows))
+        return fetched
+
+    def frame(self):
+        """Columns as a pandas data frame (categorical columns as pandas categoricals)."""
+
+        import pandas
+
+        data = {}
+        for c in self.columns:
+            if c.kind == "categorical":
+                data[c.name] = pandas.Categorical.from_codes(c.read(self.rows), c.categories)
+            else:
+                data[c.name] = c.read(self.rows)
+        return pandas.DataFrame(data, columns = self.names())
+
+    def convert(self, path, format = "parquet"):
+        """Write the cache as a Parquet or Feather file (needs pyarrow)."""
+
+        import pyarrow
+
+        arrays = []
+        for c in self.columns:
+            if c.kind == "categorical":
+                arrays.append(pyarrow.DictionaryArray.from_arrays(pyarrow.array(c.read(self.rows), mask = c.read(self.rows) < 0), pyarrow.array(c.categories)))
+            else:
+                arrays.append(pyarrow.array(c.read(self.rows)))
+        table = pyarrow.Table.from_arrays(arrays, self.names())
+
+        if format == "parquet":
+            import pyarrow.parquet
+            pyarrow.parquet.write_table(table, path)
+        else:
+            import pyarrow.feather
+            pyarrow.feather.write_feather(table, path)
+
+def load(directory):
+    """Open a columnar cache (columns are memory-mapped)."""
+    return ColumnarCache(directory)
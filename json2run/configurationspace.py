@@ -0,0 +1,102 @@
+from parameterexpression import *
+from operator import mul
+
+class ConfigurationSpace(object):
+    """A lazily indexed Cartesian product of factors, each factor being a list of parameter
+    lists. The i-th configuration is assembled on request (the last factor varies fastest,
+    as in And nodes), so the product is never materialised."""
+
+    def __init__(self, factors):
+        """Initializes the space from its factors."""
+
+        self.factors = factors
+        self.sizes = [len(f) for f in factors]
+        self.size = reduce(mul, self.sizes, 1)
+
+    def __len__(self):
+        """Number of configurations in the space."""
+        return self.size
+
+    def __getitem__(self, index):
+        """Get the index-th configuration as a parameter list."""
+
+        if index < 0:
+            index += self.size
+
+        if index < 0 or index >= self.size:
+            raise IndexError("Configuration %d out of range." % index)
+
+        # mixed radix decomposition of the index
+        digits = []
+        for size in reversed(self.sizes):
+            index, digit = divmod(index, size)
+            digits.append(digit)
+
+        parameters = ParameterList()
+        for factor, digit in zip(self.factors, reversed(digits)):
+            parameters.extend(factor[digit])
+
+        return parameters
+
+    def __iter__(self):
+        """Iterate over all configurations (in index order)."""
+        for index in xrange(self.size):
+            yield self[index]
+
+    @staticmethod
+    def factor(generator, parameter):
+        """Splits a parameter expression into the values of a parameter and the space of the
+        remaining configurations, without generating their product. Works if the parameter is
+        a leaf of a (possibly nested) and node without post-processors, returns None otherwise."""
+
+        # flatten nested and nodes
+        factors = []
+        pending = [generator]
+        while pending:
+            node = pending.pop(0)
+            if type(node) == And and not node.postprocessors:
+                pending = node.descendants + pending
+            else:
+                factors.append(node)
+
+        # look for the leaf generating the parameter
+        leaves = [f for f in factors if isinstance(f, Discrete) and f.name == parameter]
+        if len(leaves) != 1:
+            return None
+
+        values = list(leaves[0].values)
+
+        # generate the (independent) configurations of each other factor
+        space = []
+        for f in factors:
+            if f is leaves[0]:
+                continue
+
+            configurations = f.all()
+            if any(p.name == parameter for c in configurations for p in c):
+                return None
+
+            space.append(configurations)
+
+        return values, ConfigurationSpace(space)
+
+    @staticmethod
+    def enumerate(generator, parameter):
+        """Splits a parameter expression into the values of a parameter and the space of the
+        remaining configurations, by generating all the parameter lists."""
+
+        values = set()
+        configurations = set()
+
+        while generator.has_more():
+            n = ParameterList(generator.next())
+
+            # get value of the parameter
+            p = n[parameter]
+            values.add(p.value)
+
+            # rest of the parameter list is a configuration
+            n.remove(p)
+            configurations.add(n)
+
+        return list(values), ConfigurationSpace([list(configurations)])
@@ -0,0 +1,96 @@
+from threading import Thread
+from Queue import Queue, Empty
+import logging as log
+import itertools
+import atexit
+import json
+import time
+
+writer = None
+"""Writer of the event log, none if events aren't logged."""
+
+serials = itertools.count(1)
+"""Serial numbers of the experiments, to match their events."""
+
+class Writer(Thread):
+    """Writes events to a JSON Lines file, from a queue, in the background."""
+
+    def __init__(self, path):
+        super(Writer, self).__init__(name = "events")
+        self.setDaemon(True)
+        self.path = path
+        self.file = open(path, "a")
+        self.queue = Queue()
+
+    def run(self):
+
+        done = False
+        while not done:
+
+            # write what was queued in the meanwhile at once, then flush
+            events = [self.queue.get()]
+            try:
+                while len(events) < 1000:
+                    events.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            if None in events:
+                done = True
+                events = [e for e in events if e is not None]
+
+            try:
+                self.file.write("".join(json.dumps(e, separators = (",", ":"), default = str) + "\n" for e in events))
+                self.file.flush()
+            except Exception, e:
+                log.warning("Impossible to write events to %s: %s" % (self.path, e))
+
+        self.file.close()
+
+def start(path):
+    """Log events to a file (appended), until the end of the process."""
+
+    global writer
+
+    if writer:
+        return
+    writer = Writer(path)
+    writer.start()
+    atexit.register(stop)
+
+def stop():
+    """Write the events which are left, close the log."""
+
+    global writer
+
+    if writer:
+        w, writer = writer, None
+        w.queue.put(None)
+        w.join()
+
+def serial(experiment):
+    """Serial number of an experiment (assigned on its first event)."""
+
+    if experiment.serial is None:
+        experiment.serial = next(serials)
+    return experiment.serial
+
+def emit(event, batch, experiment = None, **fields):
+    """Log an event of a batch (possibly about one of its experiments), with a timestamp and
+    more fields. Does nothing, unless events are logged."""
+
+    if not writer:
+        return
+
+    record = { "time": time.time(), "event": event, "batch": batch["name"] }
+    if experiment is not None:
+        record["experiment"] = serial(experiment)
+        record["fingerprint"] = experiment["fingerprint"] if "fingerprint" in experiment else None
+        record["repetition"] = experiment["parameters"].get("repetition")
+        if experiment.iteration is not None:
+            record["iteration"] = experiment.iteration
+        if experiment.configuration is not None:
+            record["configuration"] = experiment.configuration
+    record.update(fields)
+
+    writer.queue.put(record)
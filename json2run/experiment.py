@@ -3,19 +3,29 @@ from threading import *
 from persistent import *
 from parameterexpression import *
 from time import sleep
+import time
 import random
 from datetime import datetime
+from affinity import pinner
+from storage import SQLiteDatabase, fingerprint
+import blobs
+import archive
+import events
 import logging as log
 
 
 class ExperimentRunner(Thread):
     """Experiment consumer, handles experiment launching and interruption."""
 
-    def __init__(self, batch):
-        """Saves reference to batch, for interrupt detection."""
+    def __init__(self, pool, cpus = None, slot = None):
+        """Saves reference to the pool it serves, and the (optional) CPU set and index of this slot."""
 
         super(ExperimentRunner, self).__init__()
-        self.batch = batch
+        self.pool = pool
+        self.slot = slot
+        self.batch = None
+        self.cpus = cpus
+        self.pin = pinner(cpus)
         self.out = None
         self.err = None
 
@@ -25,8 +35,9 @@ class ExperimentRunner(Thread):
         # until the queue is empty
         while True:
 
-            # get experiment from queue
-            self.current = self.batch.experiment_q.get()
+            # get experiment from the pool, it belongs to its own batch
+            self.current = self.pool.get()
+            self.batch = self.current.batch
             self.batch.experiment_started(self.current)
 
             # be nice with enqueuing thread
@@ -43,6 +54,8 @@ class ExperimentRunner(Thread):
             if self.current.interrupted:
 
                 # remove experiment from queue without executing it
+                events.emit("cancelled", self.batch, self.current, slot = self.slot)
+                self.pool.done(self.current)
                 self.batch.experiment_finished(self.current)
                 self.batch.experiment_q.task_done()
 
@@ -50,6 +63,12 @@ class ExperimentRunner(Thread):
 
                 # run experiment, record time, save output
                 self.current["date_started"] = datetime.utcnow()
+                started = time.time()
+                events.emit("started", self.batch, self.current, slot = self.slot, cpus = self.cpus)
+
+                # record CPU set onto which the experiment is pinned
+                if self.cpus:
+                    self.current["cpus"] = self.cpus
 
                 # Are we using slurm?
                 if self.batch["slurm_use"]:
@@ -67,11 +86,20 @@ class ExperimentRunner(Thread):
 
                 # open subprocess and wait for it to finish
                 try:
-                    # Run the command
-                    self.current.process = Persistent.run(cmd)
-                    # self.current.status = self.current.process.wait()
-                    (self.out, self.err) = self.current.process.communicate()
-                    self.current.status = self.current.process.returncode
+                    # Run the command (under lock, so that a concurrent kill either prevents or terminates it)
+                    self.current.lock()
+                    try:
+                        if not self.current.interrupted:
+                            with self.batch.profiler.phase("spawn"):
+                                self.current.process = Persistent.run(cmd, self.pin)
+                    finally:
+                        self.current.unlock()
+
+                    if self.current.process:
+                        # self.current.status = self.current.process.wait()
+                        with self.batch.profiler.phase("solver"):
+                            (self.out, self.err) = self.current.process.communicate()
+                        self.current.status = self.current.process.returncode
 
                 except Exception as e:
 
@@ -79,15 +107,25 @@ class ExperimentRunner(Thread):
                         print "Failed running experiment: ", e
 
                 self.current["date_stopped"] = datetime.utcnow()
+                self.current["duration_seconds"] = time.time() - started
 
                 # process output, save experiment (if valid)
                 self.terminate()
 
+                if not self.current.interrupted:
+                    events.emit("finished", self.batch, self.current, slot = self.slot, duration = self.current["duration_seconds"])
+                elif self.current.cancelled or self.batch.interrupted:
+                    events.emit("cancelled", self.batch, self.current, slot = self.slot, duration = self.current["duration_seconds"])
+                else:
+                    events.emit("failed", self.batch, self.current, slot = self.slot, duration = self.current["duration_seconds"], status = self.current.status)
+
                 # cleanup process information
                 self.current.clean()
 
-                # notify batch that experiment is over
-                self.batch.experiment_finished(self.current)
+                # notify pool (identical experiments) and batch that experiment is over
+                self.pool.done(self.current)
+                with self.batch.profiler.phase("progress"):
+                    self.batch.experiment_finished(self.current)
 
                 # task is done
                 self.batch.experiment_q.task_done()
@@ -97,31 +135,45 @@ class ExperimentRunner(Thread):
         try:
 
             # read from stdout
-            output = "".join(self.out)
-            errs = "".join(self.err)
+            output = "".join(self.out or [])
+            errs = "".join(self.err or [])
             self.out = None
             self.err = None
 
+            # if interrupted (or cancelled), discard partial results
+            if self.current.interrupted:
+                return
+
             # parse the JSON output, save results
             if self.current.status != 0:
                 log.error("Output: **%s**, status: %s, errs: %s" % (output, self.current.status, errs))
                 self.current.interrupted = True
-
-            # if interrupted or wrong
-            if self.current.interrupted:
                 return
 
             # parse stats, save result
-            json_output = json.loads(output)
+            with self.batch.profiler.phase("parse"):
+                json_output = json.loads(output)
+
+            with self.batch.profiler.phase("save"):
+
+                # if output includes an array of solutions, store it on the database
+                if "solutions" in json_output:
+                    self.current.set_solutions(json_output["solutions"])
+                    del(json_output["solutions"])
+
+                # consider the rest of information as stats
+                self.current["stats"].update(json_output)
+                self.current.touch("stats")
+                started = time.time()
+                self.current.save()
+                self.batch.metrics.writes.observe(time.time() - started)
 
-            # if output includes an array of solutions, store it on the database
-            if "solutions" in json_output:
-                self.current["solutions"] = json_output["solutions"]
-                del(json_output["solutions"])
+        except PersistenceError as e:
 
-            # consider the rest of information as stats
-            self.current["stats"].update(json_output)
-            self.current.save()
+            log.error("Failed saving experiment results: %s" % e)
+
+            # results are not on the database, don't count the experiment
+            self.current.interrupted = True
 
         except Exception as e:
 
@@ -143,13 +195,19 @@ class Experiment(Persistent):
         self.incremental = 0
         self.total = 0
         self.iteration = iteration
+        self.configuration = None
         self.interrupted = False
+        self.cancelled = False
+        self.existing = False
+        self.followers = []
+        self.serial = None
         self.batch = batch
         self.parameters = filter(lambda p: p.name != "repetition", params)
         self.executable = executable
         self["batch"] = batch.get_id()
         self["executable"] = executable
         self["parameters"] = { p.name: p.value for p in params }
+        self["fingerprint"] = fingerprint(self["parameters"])
         self["copy"] = False
         self["stats"] = {}
         self["solutions"] = []
@@ -170,6 +228,11 @@ class Experiment(Persistent):
                 self.process = None
         self.unlock()
 
+    def cancel(self):
+        """Kill an experiment whose result is no longer needed, its partial results are discarded."""
+        self.cancelled = True
+        self.kill()
+
     def clean(self):
         """Cleanup process execution."""
         #if self.process:
@@ -177,20 +240,53 @@ class Experiment(Persistent):
         #self.process.stderr.close()
         self.process = None
 
+    def set_solutions(self, solutions):
+        """Set solutions, large ones are stored (compressed) out of the document, which keeps a reference."""
+
+        if len(json.dumps(solutions, separators = (",", ":"))) > blobs.threshold:
+            self["solutions_blob"] = blobs.put(solutions)
+            self["solutions"] = []
+        else:
+            self["solutions"] = solutions
+
+    @staticmethod
+    def solutions_of(experiment):
+        """Solutions of an experiment (document), loaded from the blob store if stored out of the document."""
+
+        if "solutions_blob" in experiment:
+            return blobs.get(experiment["solutions_blob"])
+        return experiment["solutions"] if "solutions" in experiment else []
+
+    def key(self):
+        """Identifies identical experiments (same executable and parameters, repetition included)."""
+        return (self["executable"], json.dumps(self["parameters"], sort_keys = True))
+
     def set_incremental(self, incremental, total):
         """Incremental and total indices (for logging)."""
 
         self.incremental = incremental
         self.total = total
 
+    def similar(self):
+        """Query matching experiments with the same parameters (but repetition)."""
+
+        query = {}
+
+        # on local databases every experiment has a fingerprint, look it up (indexed)
+        if isinstance(Persistent.database, SQLiteDatabase):
+            query["fingerprint"] = fingerprint(self["parameters"])
+        else:
+            for p in self["parameters"]:
+                query["parameters.%s" % p] = self["parameters"][p]
+            del(query["parameters.repetition"])
+
+        return query
+
     def on_db(self):
         """Checks whether this experiment is already on the db, if greedy = false
         only checks if the experiment is in the current batch."""
 
-        query = {}
-        for p in self["parameters"]:
-            query["parameters.%s" % p] = self["parameters"][p]
-        del(query["parameters.repetition"])
+        query = self.similar()
         query["copy"] = False # we're not interested in copies
 
         return Experiment.exists(query)
@@ -204,18 +300,27 @@ class Experiment(Persistent):
         query["batch"] = self["batch"]
         return Experiment.exists(query)
 
+    def find_on_batch(self, fields = None):
+        """Get this experiment from the current batch (None if it's not there yet)."""
+
+        query = {}
+        query["parameters"] = self["parameters"]
+        query["batch"] = self["batch"]
+        return Experiment.find_one(query, fields)
+
     def get_similar(self):
         """Get list of similar (i.e. with same parameters and executable) experiments out of this batch."""
 
-        query = {}
-        for p in self["parameters"]:
-            query["parameters.%s" % p] = self["parameters"][p]
-        del(query["parameters.repetition"])
+        query = self.similar()
         query["copy"] = False # we're not interested in copies
         query["executable"] = self["executable"] # same executable
         query["batch"] = { "$nin": [ self["batch"] ] }
 
-        return Experiment.get(query)
+        # archived batches are looked up in the index of the archives
+        return archive.similar(Experiment.get(query), self["parameters"], self["executable"], self["batch"])
+
+    write_concern = Persistent.durable
+    """Results must not be lost."""
 
     @classmethod
     def collection(cls):
@@ -228,8 +333,12 @@ class Experiment(Persistent):
         new["parameters"]["repetition"] = repetition
         new["stats"] = self["stats"]
         new["solutions"] = self["solutions"]
+        if "solutions_blob" in self:
+            new["solutions_blob"] = self["solutions_blob"]
         new["date_started"] = self["date_started"]
         new["date_stopped"] = self["date_stopped"]
+        if "duration_seconds" in self:
+            new["duration_seconds"] = self["duration_seconds"]
         new["copy"] = True
 
         return new
@@ -0,0 +1,94 @@
+from persistent import *
+from experiment import Experiment
+import archive
+import csv
+import json
+import os
+import sys
+
+def experiments(batch_id, fields, batch_size = 10000):
+    """Experiments of a batch (restricted to some fields), read from its archive if it was archived."""
+
+    batch = Persistent.retry(Persistent.database["batches"].find_one, { "_id": batch_id }, ["archived"])
+    if batch and "archived" in batch:
+        return archive.experiments(batch, fields)
+    return Experiment.get({ "batch": batch_id }, fields).batch_size(batch_size)
+
+def discover(batch_id, parameters = True, stats = True, batch_size = 10000):
+    """Parameter and stat names used by the experiments of a batch (one pass over a projection
+    of the experiments, in constant memory)."""
+
+    fields = []
+    if parameters:
+        fields.append("parameters")
+    if stats:
+        fields.append("stats")
+
+    found = { "parameters": set(), "stats": set() }
+    for e in experiments(batch_id, fields, batch_size):
+        for f in fields:
+            if f in e:
+                found[f].update(e[f].keys())
+
+    return sorted(found["parameters"]), sorted(found["stats"])
+
+def text(value, flag = "true"):
+    """Textual representation of a value (None is used for flags, i.e. parameters without a value)."""
+
+    if value is None:
+        return flag
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+def export(batch_id, out, format = "csv", parameters = None, stats = None, batch_size = 10000, solutions = False):
+    """Stream the experiments of a batch to a file, one row per experiment, with the given
+    parameter and stat columns (discovered from the data if None). Only the needed fields
+    are read from the database, a batch of experiments at a time. JSON Lines rows can also
+    include the solutions of each experiment."""
+
+    if parameters is None or stats is None:
+        found_parameters, found_stats = discover(batch_id, parameters is None, stats is None, batch_size)
+        parameters = found_parameters if parameters is None else parameters
+        stats = found_stats if stats is None else stats
+
+    # projection, solutions are only read if requested
+    fields = ["parameters.%s" % p for p in parameters] + ["stats.%s" % s for s in stats]
+    if solutions and format == "jsonl":
+        fields += ["solutions", "solutions_blob"]
+    if not fields:
+        fields = ["_id"]
+
+    rows = experiments(batch_id, fields, batch_size)
+
+    count = 0
+    if format == "jsonl":
+        for e in rows:
+            p = e["parameters"] if "parameters" in e else {}
+            s = e["stats"] if "stats" in e else {}
+            row = { "parameters": p, "stats": s }
+            if solutions:
+                row["solutions"] = Experiment.solutions_of(e)
+            out.write(json.dumps(row, default = str))
+            out.write("\n")
+            count += 1
+    else:
+        writer = csv.writer(out, delimiter = "\t" if format == "tsv" else ",", lineterminator = "\n")
+        writer.writerow(parameters + stats)
+        for e in rows:
+            p = e["parameters"] if "parameters" in e else {}
+            s = e["stats"] if "stats" in e else {}
+            writer.writerow([text(p[h]) if h in p else "" for h in parameters] + [text(s[h], "") if h in s else "" for h in stats])
+            count += 1
+
+    out.flush()
+    return count
+
+def output(path = None, buffer_size = 1 << 20):
+    """Buffered binary output stream, on a file or on the standard output."""
+
+    if path:
+        return open(path, "wb", buffer_size)
+
+    sys.stdout.flush()
+    return os.fdopen(os.dup(sys.stdout.fileno()), "wb", buffer_size)
@@ -0,0 +1,77 @@
+import os
+import socket
+import getpass
+import platform
+from multiprocessing import cpu_count
+from affinity import allowed_cpus, read_cpu_list
+
+cache = {}
+"""Identity (user, host, system) and static hardware information, computed once per process."""
+
+def read_file(path):
+    """Contents of a (small) file, None if not available."""
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+def identity():
+    """User, host and system (as uname -sr) running this process."""
+
+    if "identity" not in cache:
+        try:
+            user = getpass.getuser()
+        except Exception:
+            user = str(os.getuid())
+        cache["identity"] = {
+            "user": user,
+            "host": socket.gethostname(),
+            "system": "%s %s" % (platform.system(), platform.release())
+        }
+    return cache["identity"]
+
+def cpu_model():
+    """Model name of the CPU."""
+
+    cpuinfo = read_file("/proc/cpuinfo") or ""
+    for line in cpuinfo.splitlines():
+        if line.startswith("model name") or line.startswith("Processor") or line.startswith("cpu model"):
+            return line.split(":", 1)[1].strip()
+    return platform.processor() or platform.machine()
+
+def physical_cores():
+    """Number of physical cores (hardware threads of the same core count once)."""
+
+    cores = set()
+    for cpu in allowed_cpus():
+        siblings = read_cpu_list("/sys/devices/system/cpu/cpu%d/topology/thread_siblings_list" % cpu)
+        cores.add(tuple(siblings) if siblings else (cpu,))
+    return len(cores) or cpu_count()
+
+def memory():
+    """Total physical memory, in MB."""
+    try:
+        return int(os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024))
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def hardware():
+    """Hardware of this machine, with the frequency governor and the load at the time of the call."""
+
+    if "hardware" not in cache:
+        cache["hardware"] = {
+            "cpu_model": cpu_model(),
+            "cpus": cpu_count(),
+            "cores": physical_cores(),
+            "memory_mb": memory()
+        }
+
+    info = dict(cache["hardware"])
+    info["governor"] = read_file("/sys/devices/system/cpu/cpu0/cpufreq/scaling_governor")
+    try:
+        info["load"] = list(os.getloadavg())
+    except OSError:
+        info["load"] = None
+
+    return info
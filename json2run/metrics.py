@@ -0,0 +1,230 @@
+from threading import Thread, Lock, Event
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import logging as log
+import tempfile
+import bisect
+import atexit
+import time
+import os
+
+path = None
+"""File where the metrics are written (e.g. in the directory of node-exporter's textfile collector)."""
+
+port = None
+"""Port of the local HTTP endpoint serving the metrics (on /metrics), none if not set."""
+
+interval = 15.0
+"""Seconds between writes of the metrics file."""
+
+duration_buckets = [0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0, 1800.0, 3600.0]
+"""Upper bounds (in seconds) of the buckets of the durations of experiments."""
+
+write_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0]
+"""Upper bounds (in seconds) of the buckets of the latency of database writes."""
+
+class Histogram(object):
+    """A (thread-safe) histogram of observed values, with cumulative buckets, sum and count."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.sync = Lock()
+
+    def observe(self, value):
+        """Add an observed value."""
+
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.sync:
+            self.counts[bucket] += 1
+            self.sum += value
+
+    def samples(self):
+        """Cumulative count of each bucket (upper bound, +Inf last), sum and count."""
+
+        with self.sync:
+            counts, total = list(self.counts), self.sum
+
+        cumulative = []
+        seen = 0
+        for bound, n in zip(self.buckets + [float("inf")], counts):
+            seen += n
+            cumulative.append((bound, seen))
+        return cumulative, total, seen
+
+class Metrics(object):
+    """Metrics of a batch which aren't in its document: durations of its experiments, latency
+    of their database writes and time of the last completion."""
+
+    def __init__(self):
+        self.durations = Histogram(duration_buckets)
+        self.writes = Histogram(write_buckets)
+        self.last_completion = None
+
+batches = []
+"""Batches whose metrics are exported (in the order they were run)."""
+
+registering = Lock()
+
+def register(batch):
+    """Export the metrics of a batch (once)."""
+
+    with registering:
+        if not any(b is batch for b in batches):
+            batches.append(batch)
+
+def label(value):
+    """Escape a label value."""
+    return unicode(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def number(value):
+    """Format a sample value."""
+
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def field(batch, name, default = 0):
+    return batch[name] if name in batch else default
+
+gauges = [
+    ("j2r_experiments_queued", "Experiments generated and waiting for a slot.", lambda b: len(b.enqueued)),
+    ("j2r_experiments_running", "Experiments running.", lambda b: len(b.running)),
+    ("j2r_slots", "Parallel slots of the batch.", lambda b: field(b, "threads")),
+    ("j2r_experiments_planned", "Experiments of the batch (expected).", lambda b: field(b, "total")),
+    ("j2r_throughput", "Experiments completed per second (recent window).", lambda b: field(b, "throughput", 0.0)),
+    ("j2r_last_completion_timestamp_seconds", "Time of the last completed experiment.", lambda b: b.metrics.last_completion or 0.0),
+    ("j2r_configurations_racing", "Configurations still racing (races only).", lambda b: field(b, "configurations_racing") if b.type() == "race" else None)
+]
+"""Gauges of each batch: name, help and value (None if not applicable)."""
+
+counters = [
+    ("j2r_experiments_done_total", "Experiments done (including those already on the batch).", lambda b: field(b, "done")),
+    ("j2r_experiments_failed_total", "Experiments failed.", lambda b: field(b, "failed"))
+]
+"""Counters of each batch: name, help and value."""
+
+histograms = [
+    ("j2r_experiment_duration_seconds", "Durations of the experiments.", lambda b: b.metrics.durations),
+    ("j2r_database_write_seconds", "Latency of the writes of experiments to the database.", lambda b: b.metrics.writes)
+]
+"""Histograms of each batch: name, help and histogram."""
+
+def render():
+    """Metrics of the registered batches, in the text exposition format."""
+
+    with registering:
+        exported = list(batches)
+
+    lines = []
+    for kind, families in [("gauge", gauges), ("counter", counters)]:
+        for name, description, value in families:
+            samples = [(b, value(b)) for b in exported]
+            samples = [(b, v) for (b, v) in samples if v is not None]
+            if not samples:
+                continue
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for b, v in samples:
+                lines.append("%s{batch=\"%s\"} %s" % (name, label(b["name"]), number(v)))
+
+    for name, description, histogram in histograms:
+        if not exported:
+            continue
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s histogram" % name)
+        for b in exported:
+            cumulative, total, count = histogram(b).samples()
+            for bound, n in cumulative:
+                lines.append("%s_bucket{batch=\"%s\",le=\"%s\"} %d" % (name, label(b["name"]), number(bound), n))
+            lines.append("%s_sum{batch=\"%s\"} %s" % (name, label(b["name"]), number(total)))
+            lines.append("%s_count{batch=\"%s\"} %d" % (name, label(b["name"]), count))
+
+    return (u"\n".join(lines) + u"\n").encode("utf-8")
+
+def write(destination):
+    """Write the metrics to a file atomically (a temporary file in the same directory, renamed)."""
+
+    directory = os.path.dirname(os.path.abspath(destination))
+    descriptor, temporary = tempfile.mkstemp(prefix = ".j2r-metrics", dir = directory)
+    try:
+        with os.fdopen(descriptor, "w") as f:
+            f.write(render())
+        os.chmod(temporary, 0644)
+        os.rename(temporary, destination)
+    except:
+        os.remove(temporary)
+        raise
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves the metrics on /metrics."""
+
+    def do_GET(self):
+
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class Exporter(Thread):
+    """Writes the metrics file every interval seconds, until stopped."""
+
+    def __init__(self):
+        super(Exporter, self).__init__(name = "metrics")
+        self.setDaemon(True)
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(interval):
+            try:
+                write(path)
+            except Exception, e:
+                log.warning("Impossible to write metrics to %s: %s" % (path, e))
+
+exporter = None
+server = None
+
+def start():
+    """Start writing the metrics file and serving the HTTP endpoint (as configured), the
+    metrics are written a last time at exit."""
+
+    global exporter, server
+
+    if path and not exporter:
+        exporter = Exporter()
+        exporter.start()
+
+    if port and not server:
+        server = HTTPServer(("127.0.0.1", port), Handler)
+        t = Thread(target = server.serve_forever, name = "metrics-http")
+        t.setDaemon(True)
+        t.start()
+        log.info("Serving metrics on http://127.0.0.1:%d/metrics" % port)
+
+    atexit.register(stop)
+
+def stop():
+    """Stop exporting, write the final metrics."""
+
+    global exporter, server
+
+    if exporter:
+        exporter.stopped.set()
+        exporter = None
+        try:
+            write(path)
+        except Exception, e:
+            log.warning("Impossible to write metrics to %s: %s" % (path, e))
+
+    if server:
+        server.shutdown()
+        server = None
@@ -1,9 +1,8 @@
-from pymongo.database import Database
-from pymongo.connection import Connection
 from threading import Lock
-from bson.objectid import ObjectId
+from machine import identity
 import sys
 import os
+import time
 from subprocess import *
 import logging as log
 
@@ -15,6 +14,9 @@ def synchronized(fun):
         self.unlock()
     return _synchronized_fun
 
+class PersistenceError(Exception):
+    """A write couldn't be performed on the database (even after retrying)."""
+    pass
 
 class Persistent(object):
     """An object which can be saved on the database."""
@@ -33,9 +35,18 @@ class Persistent(object):
         "port": 27017,
         "user": "j2r",
         "pass": "j2r",
-        "database": "j2r"
+        "database": "j2r",
+        "pool_size": 10,
+        "timeout": 10000,
+        "retries": 5
     }
-    """Default values for connection."""
+    """Default values for connection (timeout in milliseconds)."""
+
+    write_concern = { "w": 1 }
+    """Write concern of the collection (overridden by subclasses)."""
+
+    durable = { "w": 1, "j": True }
+    """Write concern for writes which must not be lost (acknowledged, journaled)."""
     
     def __init__(self, inner = None):
         """Initialize with empty object."""
@@ -47,6 +58,16 @@ class Persistent(object):
         else:
             self.inner = {}
 
+        # changes since last save (fields to set, nested fields to set, fields to increment)
+        self.changes = Lock()
+        self.clean_changes()
+
+    def clean_changes(self):
+        """Forget changes, i.e. the object is in sync with the database."""
+        self.dirty = set()
+        self.paths = {}
+        self.increments = {}
+
     def lock(self):
         """Acquire lock."""
         self.sync.acquire()    
@@ -74,24 +95,147 @@ class Persistent(object):
     def __setitem__(self, field, value):
         """Subscript setter."""
         self.inner[field] = value
+        self.touch(field)
+
+    def touch(self, field):
+        """Mark a field as changed (e.g. after modifying it in place), it's set as a whole (with
+        its nested fields) on the next save."""
+        self.changes.acquire()
+        self.dirty.add(field)
+        self.increments.pop(field, None)
+        self.drop_paths()
+        self.changes.release()
+
+    def drop_paths(self):
+        """Forget nested fields of fields which are set as a whole (they would conflict in the update)."""
+        for p in [p for p in self.paths if p.split(".")[0] in self.dirty]:
+            del(self.paths[p])
+
+    def set_path(self, path, value):
+        """Set a nested field (dot notation, e.g. "configurations.3.sum_of_ranks"), the container must exist."""
+
+        keys = path.split(".")
+        container = self.inner
+        for k in keys[:-1]:
+            container = container[int(k)] if isinstance(container, list) else container[k]
+        if isinstance(container, list):
+            container[int(keys[-1])] = value
+        else:
+            container[keys[-1]] = value
+
+        self.changes.acquire()
+        if keys[0] not in self.dirty:
+            self.paths[path] = value
+        self.changes.release()
+
+    def increment(self, field, amount = 1):
+        """Increment a (numeric) field, missing fields count as zero."""
+
+        self.changes.acquire()
+        self.inner[field] = self.inner.get(field, 0) + amount
+        if field not in self.dirty:
+            self.increments[field] = self.increments.get(field, 0) + amount
+        self.changes.release()
         
     def __contains__(self, field):
         """Checks whether container has item."""
         return field in self.inner
 
-    def save(self):
-        """Upsert inner object."""
+    def save(self, write_concern = None):
+        """Insert inner object, or update the fields which changed since the last save (with the
+        write concern of the collection, unless specified). Raises PersistenceError if the write
+        fails, changes are kept for the next save."""
         
-        database = Persistent.database
+        collection = Persistent.database[self.collection()]
+        write_concern = write_concern or self.write_concern
+
+        if "_id" not in self:
+            self["user"] = Persistent.user()
+            self["host"] = Persistent.host()
+            self["system"] = Persistent.platform()
+
+            # generate id on the client, so that retrying the insert is harmless
+            from bson.objectid import ObjectId
+            self.inner["_id"] = ObjectId()
+
+            # inserts are always acknowledged (later updates would silently miss a lost document)
+            if write_concern.get("w") == 0:
+                write_concern = dict(write_concern, w = 1)
+            try:
+                Persistent.retry(self.insert, collection, write_concern)
+            except PersistenceError:
+                del(self.inner["_id"])
+                raise
+            self.clean_changes()
+            return
+
+        # collect changes
+        self.changes.acquire()
         try:
-            if "_id" not in self:
-                self["user"] = Persistent.user()
-                self["host"] = Persistent.host()
-                self["system"] = Persistent.platform()
-        
-            self["_id"] = database[self.collection()].save(self.inner)
-        except Exception as e:
-            print "Failed saving on database: ", e
+            dirty, paths, increments = self.dirty, self.paths, self.increments
+            update = {}
+            fields = { f: self.inner[f] for f in dirty if f in self.inner }
+            fields.update(paths)
+            if fields:
+                update["$set"] = fields
+            if increments:
+                update["$inc"] = increments
+            self.clean_changes()
+        finally:
+            self.changes.release()
+
+        if not update:
+            return
+
+        try:
+            result = Persistent.retry(collection.update, { "_id": self["_id"] }, update, **write_concern)
+
+            # durable updates must reach the document
+            if (write_concern.get("j") or write_concern.get("fsync")) and isinstance(result, dict) and not result.get("n"):
+                raise PersistenceError("No document with id %s in %s" % (self["_id"], self.collection()))
+        except PersistenceError:
+
+            # put changes back (newer ones take precedence)
+            self.changes.acquire()
+            self.dirty.update(dirty)
+            for p in paths:
+                self.paths.setdefault(p, paths[p])
+            self.drop_paths()
+            for f in increments:
+                if f not in self.dirty:
+                    self.increments[f] = self.increments.get(f, 0) + increments[f]
+            self.changes.release()
+            raise
+
+    def insert(self, collection, write_concern):
+        """Insert inner object (if it's already there, a previous attempt went through)."""
+
+        from pymongo.errors import DuplicateKeyError
+        try:
+            collection.insert(self.inner, **write_concern)
+        except DuplicateKeyError:
+            if not collection.find_one({ "_id": self.inner["_id"] }, { "_id": 1 }):
+                raise
+
+    @staticmethod
+    def retry(operation, *args, **kwargs):
+        """Run a database operation, retrying with exponential backoff if the connection is lost."""
+
+        from pymongo.errors import AutoReconnect, PyMongoError
+
+        attempts = Persistent.config["retries"] if "retries" in Persistent.config else 5
+        delay = 0.5
+        for attempt in range(attempts + 1):
+            try:
+                return operation(*args, **kwargs)
+            except AutoReconnect as e:
+                if attempt == attempts:
+                    raise PersistenceError("Giving up after %d attempts: %s" % (attempts + 1, e))
+                log.warning("Lost connection to the database (%s), retrying in %.1f seconds." % (e, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, 30.0)
+            except PyMongoError as e:
+                raise PersistenceError(str(e))
 
     @classmethod
     def collection(cls):
@@ -110,42 +254,94 @@ class Persistent(object):
         """Remove matching persistents from database."""
         
         database = Persistent.database
-        database[cls.collection()].remove(query)
+        Persistent.retry(database[cls.collection()].remove, query)
     
     @staticmethod
     def connect(**kwargs):
-        """Connect to the database with the specified data."""
+        """Connect to the database with the specified data, with a (thread-safe) pool of
+        pool_size connections, and timeout milliseconds for connecting and for each operation.
+        If an url is given, sqlite:// ones open a local database (see storage), mongodb:// ones
+        replace host and port."""
         
-        config = kwargs
+        config = dict(Persistent.config)
+        config.update(kwargs)
         config["pass"] = kwargs["passw"]
         del(config["passw"])
         Persistent.config = config
+
+        url = config["url"] if "url" in config else None
             
         try:
-            Persistent.connection = Connection(config["host"], config["port"])
+            # local database
+            if url and url.startswith("sqlite:"):
+                from storage import open_url
+                Persistent.connection = open_url(url)
+                Persistent.database = Persistent.connection
+                return
+
+            from pymongo import MongoClient
+            Persistent.connection = MongoClient(url or config["host"], config["port"],
+                max_pool_size = config["pool_size"],
+                connectTimeoutMS = config["timeout"],
+                socketTimeoutMS = config["timeout"],
+                waitQueueTimeoutMS = config["timeout"])
             Persistent.database = Persistent.connection[config["database"]]
-            Persistent.database.authenticate(config["user"], config["pass"])
+            Persistent.retry(Persistent.database.authenticate, config["user"], config["pass"])
         except Exception, e:
-            print e
+            log.error("Impossible to connect to the database: %s" % e)
             sys.exit(1)
 
+        # experiments are looked up by batch and by parameters
+        try:
+            Persistent.database["experiments"].ensure_index("batch")
+            Persistent.database["experiments"].ensure_index("fingerprint")
+        except Exception, e:
+            log.warning("Impossible to create indices: %s" % e)
+
+    @staticmethod
+    def location():
+        """Identity of the current database, without credentials (i.e. sqlite:// and the
+        absolute path of local databases, mongodb:// with hosts and database name)."""
+
+        config = Persistent.config
+        url = config["url"] if "url" in config else None
+
+        if url and url.startswith("sqlite:"):
+            path = Persistent.database.path
+            return "sqlite://" + (os.path.abspath(path) if path != ":memory:" else "/:memory:")
+
+        if url and url.startswith("mongodb://"):
+            from pymongo.uri_parser import parse_uri
+            nodes = parse_uri(url)["nodelist"]
+        else:
+            nodes = [(url or config["host"], config["port"])]
+        return "mongodb://%s/%s" % (",".join("%s:%s" % n for n in sorted(nodes)), config["database"])
+
     @staticmethod
     def disconnect():
         """Disconnect from database."""
         
-        Persistent.connection.disconnect()
+        Persistent.connection.close()
         Persistent.database = None
 
     def load(self, obj):
         """Load object literal in object."""
         self.inner = obj
+        self.clean_changes()
     
+    @classmethod
+    def find_one(cls, query, fields = None):
+        """Get first matching persistent from database (None if there's none)."""
+
+        database = Persistent.database
+        return Persistent.retry(database[cls.collection()].find_one, query, fields)
+
     @classmethod
     def exists(cls, obj):
         """Checks if a document with the specified fields exists in the database."""
         
         database = Persistent.database
-        res =  database[cls.collection()].find_one(obj) 
+        res = Persistent.retry(database[cls.collection()].find_one, obj)
         return res != None
     
     def get_id(self):
@@ -166,9 +362,9 @@ class Persistent(object):
         return output
 
     @staticmethod
-    def run(cmd):
-        """Run """
-        return Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, close_fds=True) # close_fds doesn't seem to work properly
+    def run(cmd, preexec_fn = None):
+        """Run command on the shell, preexec_fn is called in the child before executing it."""
+        return Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, close_fds=True, preexec_fn=preexec_fn) # close_fds doesn't seem to work properly
         
     @staticmethod
     def revision():
@@ -184,16 +380,16 @@ class Persistent(object):
     def host():
         """Get current machine hostname."""
         
-        return Persistent.run_and_report("hostname")
+        return identity()["host"]
         
     @staticmethod
     def user():
         """Get current user."""
         
-        return Persistent.run_and_report("whoami")
+        return identity()["user"]
         
     @staticmethod
     def platform():
         """Get current platform."""
         
-        return Persistent.run_and_report("uname -sr")
+        return identity()["system"]
@@ -0,0 +1,228 @@
+from threading import *
+from Queue import Queue
+from collections import OrderedDict
+from experiment import ExperimentRunner, Experiment
+from affinity import cpu_slots
+from persistent import Persistent, PersistenceError
+import events
+import time
+import logging as log
+
+class ExperimentQueue(Queue):
+    """Specialization of Queue to have timed join, and to notify the pool it belongs to."""
+
+    def __init__(self, maxsize = 0, pool = None, weight = 1.0):
+        """Initializes queue, optionally registered to a pool with a fair-share weight."""
+
+        Queue.__init__(self, maxsize)
+        self.pool = pool
+        self.weight = float(weight)
+        self.virtual_time = 0.0
+
+    def put(self, item, block = True, timeout = None):
+        """Enqueue item, wake up a runner of the pool."""
+
+        Queue.put(self, item, block, timeout)
+        if self.pool:
+            self.pool.notify()
+
+    def join_with_timeout(self, timeout):
+        """Wait (at most timeout seconds) for all tasks to be done, raise NotFinished otherwise."""
+
+        self.all_tasks_done.acquire()
+        try:
+            endtime = time.time() + timeout
+            while self.unfinished_tasks:
+                remaining = endtime - time.time()
+                if remaining <= 0.0:
+                    raise NotFinished
+                self.all_tasks_done.wait(remaining)
+        finally:
+            self.all_tasks_done.release()
+
+class NotFinished(Exception):
+    pass
+
+copied = ["stats", "solutions", "solutions_blob", "date_started", "date_stopped", "duration_seconds"]
+"""Fields of an experiment copied to the identical ones."""
+
+remembered = 10000
+"""Completed experiments (the most recently used ones) whose results are kept for identical
+experiments of other batches."""
+
+class ExperimentPool(object):
+    """A pool of runners shared by one or more batches. Each batch enqueues its experiments in
+    its own queue, runners serve the queues in proportion to their weights (stride scheduling).
+    Experiments identical to one which is running or was completed for another batch are not
+    run, they get a copy of its results instead."""
+
+    queue_type = ExperimentQueue
+    """Type of the queues served by the pool."""
+
+    def __init__(self, thread_n, slurm = {"use": False}, affinity = {"mode": "none", "cpus": 1}):
+        """Spawn thread_n runners, pinning each one to its own CPU set if requested."""
+
+        self.available = Condition(Lock())
+        self.queues = []
+        self.leaders = {}
+        self.completed = OrderedDict()
+        self.requeued = []
+        self.thread_n = thread_n
+
+        slots = None
+        if not slurm["use"]:
+            slots = cpu_slots(affinity["mode"], thread_n, affinity["cpus"])
+        elif affinity["mode"] != "none":
+            log.info("Ignoring CPU affinity, placement is up to slurm.")
+
+        for ti in range(thread_n):
+            cpus = slots[ti] if slots else None
+            if cpus:
+                log.info("Slot %d pinned to CPUs %s" % (ti, ",".join(map(str, cpus))))
+            t = ExperimentRunner(self, cpus, ti)
+            t.setDaemon(True)
+            t.start()
+
+    def queue(self, maxsize = 0, weight = 1.0):
+        """Create a new queue served by this pool."""
+
+        q = self.queue_type(maxsize, self, weight)
+
+        self.available.acquire()
+        active = [o.virtual_time for o in self.queues if o.qsize() or o.unfinished_tasks]
+        q.virtual_time = min(active) if active else 0.0
+        self.queues.append(q)
+        self.available.release()
+
+        return q
+
+    def notify(self):
+        """Wake up a runner (something has been enqueued)."""
+
+        self.available.acquire()
+        self.available.notify()
+        self.available.release()
+
+    def wait(self, condition, timeout = None):
+        """Wait on a condition (whose lock is held by the caller) for the experiments of a batch
+        to make progress, at most timeout seconds."""
+
+        condition.wait(timeout)
+
+    def get(self):
+        """Get next experiment to run (blocking), from the queue which received the smallest
+        share of the pool so far (relative to its weight)."""
+
+        while True:
+
+            self.available.acquire()
+            try:
+                # followers of failed experiments (already taken from their queues) come first
+                if self.requeued:
+                    e = self.requeued.pop(0)
+                else:
+                    candidates = [q for q in self.queues if q.qsize()]
+                    if not candidates:
+                        # wait for something to be enqueued
+                        self.available.wait()
+                        continue
+
+                    q = min(candidates, key = lambda q: q.virtual_time)
+                    q.virtual_time += 1.0 / q.weight
+                    e = q.get_nowait()
+
+                # if an identical experiment is running for another batch, wait for its results
+                # (the follower is running as far as its batch is concerned)
+                key = e.key()
+                if key in self.leaders and self.leaders[key].batch is not e.batch and not e.interrupted:
+                    self.leaders[key].followers.append(e)
+                    e.batch.experiment_started(e)
+                    continue
+
+                # if an identical experiment was completed for another batch, copy its results (below)
+                if key in self.completed and self.completed[key][0] is not e.batch and not e.interrupted:
+                    source, results, original = self.completed.pop(key)
+                    self.completed[key] = (source, results, original)
+                else:
+                    if not e.interrupted:
+                        self.leaders[key] = e
+                    return e
+            finally:
+                self.available.release()
+
+            e.batch.experiment_started(e)
+            self.copy(e, source, results, original)
+
+    def done(self, experiment):
+        """Experiment is over, hand its results over to the identical ones (or let them run, if it failed)."""
+
+        results = None
+        if not experiment.interrupted:
+            results = { f: experiment[f] for f in copied if f in experiment }
+
+        self.available.acquire()
+        key = experiment.key()
+        if self.leaders.get(key) is experiment:
+            del(self.leaders[key])
+        if results is not None and len(self.queues) > 1:
+            self.remember(key, experiment, results)
+        followers = experiment.followers
+        experiment.followers = []
+
+        # leader failed or was cancelled, identical experiments must run on their own (they're
+        # handed back to the runners, the queues of their batches might be full)
+        requeued = [f for f in followers if experiment.interrupted and not f.interrupted]
+        if requeued:
+            self.requeued.extend(requeued)
+            self.available.notify(len(requeued))
+        self.available.release()
+
+        for f in followers:
+
+            if f in requeued:
+                events.emit("enqueued", f.batch, f)
+                continue
+
+            if not f.interrupted:
+                self.copy(f, experiment.batch, results)
+            else:
+                f.batch.experiment_finished(f)
+                f.batch.experiment_q.task_done()
+
+    def remember(self, key, experiment, results):
+        """Keep the results of a completed experiment for identical ones of other batches (only
+        when other batches share the pool), inline solutions are read back from the database."""
+
+        original = None
+        if results.get("solutions"):
+            if "_id" not in experiment:
+                return
+            original = experiment["_id"]
+            results = { f: results[f] for f in results if f != "solutions" }
+
+        self.completed.pop(key, None)
+        self.completed[key] = (experiment.batch, results, original)
+        while len(self.completed) > remembered:
+            self.completed.popitem(last = False)
+
+    def copy(self, experiment, batch, results, original = None):
+        """Complete an experiment with a copy of the results of an identical one of another batch
+        (whose inline solutions are read from the database, given the id of the original)."""
+
+        try:
+            if original is not None:
+                stored = Persistent.retry(Persistent.database[Experiment.collection()].find_one, { "_id": original }, ["solutions"])
+                results = dict(results, solutions = stored["solutions"] if stored and "solutions" in stored else [])
+
+            for field in results:
+                experiment[field] = results[field]
+            experiment["copy"] = True
+            experiment.save()
+            log.info("Copying results of an identical experiment to batch %s" % experiment.batch["name"])
+            events.emit("copied", experiment.batch, experiment, source = batch["name"])
+        except PersistenceError as e:
+            log.error("Failed copying experiment results: %s" % e)
+            experiment.interrupted = True
+
+        experiment.batch.experiment_finished(experiment)
+        experiment.batch.experiment_q.task_done()
@@ -0,0 +1,106 @@
+from threading import Lock
+import bisect
+import time
+
+enabled = False
+"""Whether the phases of batches are timed (j2r --profile), timers do nothing otherwise."""
+
+edges = [m * 10.0 ** e for e in range(-5, 3) for m in (1, 2, 5)]
+"""Upper bounds (in seconds, from 10 microseconds to 500 seconds) of the buckets of the
+histograms, the last bucket is unbounded."""
+
+phases = ["generate", "on_batch", "similar", "spawn", "solver", "parse", "save", "progress", "prune"]
+"""Timed phases (in the order of the report): generation of experiments, lookups of experiments
+already on the batch, of similar experiments (greedy), process spawn, solver run, parsing of its
+output, save of the experiment, progress update of the batch (pruning included) and pruning."""
+
+class Idle(object):
+    """A timer which does nothing (profiling disabled)."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+idle = Idle()
+
+class Timer(object):
+    """Times a phase, as a context manager."""
+
+    def __init__(self, profiler, phase):
+        self.profiler = profiler
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exception):
+        self.profiler.record(self.phase, time.time() - self.started)
+        return False
+
+class Profiler(object):
+    """Histograms of the durations of the phases of a batch (count, total, min, max and
+    number of durations in each bucket), possibly continuing those of previous runs."""
+
+    def __init__(self, document = None):
+        """Start from the histograms of a batch document (field profile), if any."""
+
+        self.sync = Lock()
+        self.histograms = {}
+        if document and document.get("edges") == edges:
+            for phase, h in document["phases"].items():
+                self.histograms[phase] = dict(h, buckets = list(h["buckets"]))
+
+    def phase(self, name):
+        """Timer of a phase (which does nothing, unless profiling is enabled)."""
+        return Timer(self, name) if enabled else idle
+
+    def record(self, phase, seconds):
+        """Add the duration of a phase."""
+
+        bucket = bisect.bisect_left(edges, seconds)
+        with self.sync:
+            if phase not in self.histograms:
+                self.histograms[phase] = { "count": 0, "total": 0.0, "min": seconds, "max": seconds, "buckets": [0] * (len(edges) + 1) }
+            h = self.histograms[phase]
+            h["count"] += 1
+            h["total"] += seconds
+            h["min"] = min(h["min"], seconds)
+            h["max"] = max(h["max"], seconds)
+            h["buckets"][bucket] += 1
+
+    def document(self):
+        """Histograms, as stored in the batch document."""
+
+        with self.sync:
+            return { "edges": list(edges), "phases": { p: dict(h, buckets = list(h["buckets"])) for p, h in self.histograms.items() } }
+
+def quantile(histogram, q):
+    """Upper bound of the bucket of the q-quantile of a histogram (its maximum for the last bucket)."""
+
+    rank = q * histogram["count"]
+    seen = 0
+    for bucket, n in enumerate(histogram["buckets"]):
+        seen += n
+        if n and seen >= rank:
+            return min(edges[bucket], histogram["max"]) if bucket < len(edges) else histogram["max"]
+    return histogram["max"]
+
+def milliseconds(seconds):
+    return "%.3f" % (seconds * 1000.0)
+
+def report(document):
+    """Rows of the report of a profile (phase, count, total seconds, mean, median, 95th
+    percentile and max in milliseconds, the percentiles are bucket upper bounds)."""
+
+    histograms = document["phases"] if document else {}
+    rows = []
+    for phase in phases + sorted(set(histograms) - set(phases)):
+        if phase not in histograms or not histograms[phase]["count"]:
+            continue
+        h = histograms[phase]
+        rows.append((phase, str(h["count"]), "%.3f" % h["total"], milliseconds(h["total"] / h["count"]),
+            milliseconds(quantile(h, 0.5)), milliseconds(quantile(h, 0.95)), milliseconds(h["max"])))
+    return rows
@@ -0,0 +1,110 @@
+from collections import deque
+from threading import Lock
+import time
+
+fields = ["name", "type", "date_started", "date_stopped", "threads", "total", "done", "failed", "sum_duration", "throughput", "configurations_racing", "configurations_total", "iterations_completed", "racing_history"]
+"""Fields of a batch needed to report its progress."""
+
+class Throughput(object):
+    """Throughput estimator over a sliding window of recent completions (at most size
+    completions, none older than window seconds)."""
+
+    def __init__(self, window = 600.0, size = 200):
+        """Initializes an empty window."""
+
+        self.window = window
+        self.completions = deque(maxlen = size)
+        self.sync = Lock()
+
+    def record(self, now = None):
+        """Record a completion."""
+
+        self.sync.acquire()
+        self.completions.append(now if now is not None else time.time())
+        self.sync.release()
+
+    def rate(self, now = None):
+        """Completions per second in the window (None if there are less than two)."""
+
+        now = now if now is not None else time.time()
+
+        self.sync.acquire()
+        try:
+            while self.completions and self.completions[0] < now - self.window:
+                self.completions.popleft()
+            if len(self.completions) < 2 or self.completions[-1] == self.completions[0]:
+                return None
+            return (len(self.completions) - 1) / (self.completions[-1] - self.completions[0])
+        finally:
+            self.sync.release()
+
+def survival_rate(history):
+    """Average fraction of configurations surviving an iteration, from the number of racing
+    configurations at each iteration (1.0 if none has been pruned yet)."""
+
+    if len(history) < 2 or not history[0]:
+        return 1.0
+    return (float(history[-1]) / history[0]) ** (1.0 / (len(history) - 1))
+
+def remaining(batch):
+    """Expected number of experiments left in a batch or race (from its document), None if
+    it was run by a version without progress counters. Races project the number of
+    configurations surviving each of the iterations left, at the rate observed so far."""
+
+    if "total" not in batch or "done" not in batch:
+        return None
+
+    if batch["type"] != "race":
+        return max(batch["total"] - batch["done"], 0)
+
+    racing = batch["configurations_racing"] if "configurations_racing" in batch else None
+    total = batch["configurations_total"] if "configurations_total" in batch else None
+    if racing is None or not total:
+        return None
+
+    iterations = int(batch["total"] / total) - (batch["iterations_completed"] if "iterations_completed" in batch else 0)
+    rate = survival_rate(batch["racing_history"] if "racing_history" in batch else [])
+
+    # a race is over when a single configuration is left
+    expected = 0.0
+    survivors = float(racing)
+    for i in range(iterations):
+        if survivors < 1.5:
+            break
+        expected += survivors
+        survivors *= rate
+
+    return int(round(expected))
+
+def eta(batch, threads = 1):
+    """Expected seconds to the end of a batch or race (from its document), from the recent
+    throughput if available, otherwise from the average duration of its experiments run in
+    parallel on threads. None if it can't be estimated."""
+
+    left = remaining(batch)
+    if left is None:
+        return None
+    if not left:
+        return 0.0
+
+    if "throughput" in batch and batch["throughput"]:
+        return left / batch["throughput"]
+
+    done = batch["done"]
+    if done and "sum_duration" in batch:
+        threads = batch["threads"] if "threads" in batch else threads
+        return left * (batch["sum_duration"] / done) / threads
+
+    return None
+
+def duration(seconds):
+    """Compact representation of a duration (e.g. 1d 3h 20m), empty if shorter than a minute."""
+
+    text = ""
+    if seconds >= 86400:
+        text += "%dd " % (seconds // 86400)
+    if (seconds % 86400) >= 3600:
+        text += "%dh " % ((seconds % 86400) // 3600)
+    if (seconds % 3600) >= 60:
+        text += "%dm " % ((seconds % 3600) // 60)
+    return text.strip()
@@ -0,0 +1,124 @@
+import numpy
+from math import sqrt
+
+def average_ranks(block):
+    """Rank each column of a 2D array (1 is best, ties share their average rank),
+    return ranks and, for each column, the tie correction term sum(t^3 - t)."""
+
+    k, m = block.shape
+    order = numpy.argsort(block, axis = 0, kind = "mergesort")
+    ordered = numpy.take_along_axis(block, order, axis = 0)
+    positions = numpy.arange(k).reshape(k, 1).repeat(m, axis = 1)
+
+    # mark first and last element of each group of tied values
+    first = numpy.ones((k, m), dtype = bool)
+    first[1:] = ordered[1:] != ordered[:-1]
+    last = numpy.ones((k, m), dtype = bool)
+    last[:-1] = first[1:]
+
+    # position of first and last element of the group each element belongs to
+    start = numpy.maximum.accumulate(numpy.where(first, positions, 0), axis = 0)
+    end = numpy.minimum.accumulate(numpy.where(last, positions, k)[::-1], axis = 0)[::-1]
+
+    # each element of a group of t ties contributes t^2 - 1, i.e. t^3 - t per group
+    size = (end - start + 1).astype(float)
+    ties = (size * size - 1.0).sum(axis = 0)
+
+    ranks = numpy.empty((k, m))
+    numpy.put_along_axis(ranks, order, (start + end) / 2.0 + 1.0, axis = 0)
+
+    return ranks, ties
+
+class RaceResults(object):
+    """Performance matrix of a race (configurations x iterations), with rank sums,
+    sums of squared ranks and tie corrections maintained incrementally over the
+    configurations which are still racing."""
+
+    def __init__(self, configurations, iterations, block = 16):
+        """Preallocate the matrix (a block of iterations at a time), nothing is ranked yet."""
+
+        self.iterations = iterations
+        self.values = numpy.empty((configurations, min(iterations, block)))
+        self.values.fill(numpy.nan)
+        self.racing = numpy.arange(configurations)
+        self.ranked = 0
+        self.sum_of_ranks = numpy.zeros(configurations)
+        self.sum_of_squared_ranks = 0.0
+        self.ties = 0.0
+
+    def record(self, configuration, iteration, value):
+        """Store the performance of a configuration on an iteration."""
+
+        # double the number of allocated iterations if needed
+        if iteration >= self.values.shape[1]:
+            columns = min(self.iterations, max(iteration + 1, 2 * self.values.shape[1]))
+            grown = numpy.empty((self.values.shape[0], columns))
+            grown.fill(numpy.nan)
+            grown[:, :self.values.shape[1]] = self.values
+            self.values = grown
+
+        self.values[configuration, iteration] = value
+
+    def has(self, configuration, iteration):
+        """Checks whether the performance of a configuration on an iteration is known."""
+        return iteration < self.values.shape[1] and not numpy.isnan(self.values[configuration, iteration])
+
+    def rank(self, iteration):
+        """Rank racing configurations on one more iteration, update statistics."""
+
+        if iteration != self.ranked:
+            raise ValueError("Iterations must be ranked in order (expected %d, got %d)." % (self.ranked, iteration))
+
+        ranks, ties = average_ranks(self.values[self.racing, iteration:iteration+1])
+        self.sum_of_ranks[self.racing] += ranks[:, 0]
+        self.sum_of_squared_ranks += float((ranks * ranks).sum())
+        self.ties += float(ties[0])
+        self.ranked += 1
+
+    def restrict(self, racing):
+        """Restrict statistics to a subset of the racing configurations, re-ranking the past iterations."""
+
+        racing = numpy.asarray(racing, dtype = int)
+        if len(racing) == len(self.racing) and (racing == self.racing).all():
+            return
+
+        self.racing = racing
+        self.sum_of_ranks[:] = 0.0
+        self.sum_of_squared_ranks = 0.0
+        self.ties = 0.0
+
+        if self.ranked and len(racing):
+            ranks, ties = average_ranks(self.values[racing, :self.ranked])
+            self.sum_of_ranks[racing] = ranks.sum(axis = 1)
+            self.sum_of_squared_ranks = float((ranks * ranks).sum())
+            self.ties = float(ties.sum())
+
+    def performance(self, configuration):
+        """Performance of a configuration over the ranked iterations."""
+        return self.values[configuration, :self.ranked]
+
+    def friedman(self):
+        """Friedman rank sum statistic (with ties correction) over racing configurations."""
+
+        n = float(self.ranked)
+        k = float(len(self.racing))
+        sum_of_ranks = self.sum_of_ranks[self.racing]
+
+        # sum of squares of ( sumOfRanks[treatment] - n * ( k + 1 ) / 2.0 )
+        r = float(((sum_of_ranks - n * (k + 1) / 2.0) ** 2).sum())
+
+        # ties correction
+        ties_correction = self.ties / (k - 1)
+
+        if (n * k * (k+1)) - ties_correction != 0:
+            return 12 * r / ((n * k * (k+1)) - ties_correction)
+        return float("inf")
+
+    def conover(self, quantile):
+        """Conover's critical difference between sums of ranks, given the t-student quantile."""
+
+        n = float(self.ranked)
+        k = float(len(self.racing))
+        sum_of_ranks = self.sum_of_ranks[self.racing]
+
+        return quantile * sqrt(2 * (n * self.sum_of_squared_ranks - float((sum_of_ranks ** 2).sum())) / ((n-1) * (k-1)))
@@ -0,0 +1,325 @@
+from threading import Thread, Condition, Lock
+from pool import ExperimentPool, ExperimentQueue
+from collections import OrderedDict
+from persistent import Persistent
+from storage import fingerprint
+import datetime
+import heapq
+import random
+import time
+
+overhead = 0.1
+"""Virtual seconds between the start of an experiment and the start of its process (the pause of
+the runners before each experiment, see ExperimentRunner.run)."""
+
+class Durations(object):
+    """Synthetic durations of experiments, from a distribution given as name:arguments, i.e.
+    fixed:seconds, uniform:low,high, exponential:mean, normal:mean,stdev (truncated at zero)
+    or lognormal:mu,sigma (of the logarithm of the seconds)."""
+
+    def __init__(self, spec):
+
+        name, _, arguments = spec.partition(":")
+        self.name = name
+        try:
+            self.arguments = [float(a) for a in arguments.split(",")] if arguments else []
+        except ValueError:
+            raise ValueError("Invalid duration distribution \"%s\"" % spec)
+
+        expected = { "fixed": 1, "uniform": 2, "exponential": 1, "normal": 2, "lognormal": 2 }
+        if name not in expected or len(self.arguments) != expected[name]:
+            raise ValueError("Invalid duration distribution \"%s\"" % spec)
+
+    def sample(self, generator):
+        """Sample a duration (in seconds)."""
+
+        a = self.arguments
+        if self.name == "fixed":
+            return a[0]
+        elif self.name == "uniform":
+            return generator.uniform(a[0], a[1])
+        elif self.name == "exponential":
+            return generator.expovariate(1.0 / a[0])
+        elif self.name == "normal":
+            return max(0.0, generator.normalvariate(a[0], a[1]))
+        return generator.lognormvariate(a[0], a[1])
+
+class Model(object):
+    """Durations and performance of simulated experiments. Each experiment draws its values from
+    a generator seeded by its parameters, so they don't depend on the order of the simulation.
+    Performance (the performance parameter, in races) is the quality of the configuration, uniform
+    in [0, 1], plus normal noise; experiments of a replayed batch (by parameters, repetition
+    included) keep their duration and stats, those which weren't run draw a duration among the
+    replayed ones."""
+
+    def __init__(self, durations = "exponential:60", noise = 0.5, seed = 0, replay = None):
+
+        self.durations = Durations(durations)
+        self.noise = noise
+        self.seed = seed
+        self.replay = replay or {}
+        self.replayed = [r[0] for r in self.replay.values()]
+
+    def sample(self, batch, experiment):
+        """Duration (seconds) and stats of an experiment of a batch."""
+
+        parameters = experiment["parameters"]
+        key = (fingerprint(parameters), parameters.get("repetition"))
+        if key in self.replay:
+            return self.replay[key]
+
+        generator = random.Random("%s-%s-%s" % (self.seed, key[0], key[1]))
+        duration = generator.choice(self.replayed) if self.replayed else self.durations.sample(generator)
+
+        stats = {}
+        if batch.type() == "race":
+            configuration = { p: parameters[p] for p in parameters if p != batch["instance_parameter"] }
+            quality = random.Random("%s-%s" % (self.seed, fingerprint(configuration))).random()
+            stats[batch["performance_parameter"]] = quality + generator.gauss(0.0, self.noise)
+
+        return duration, stats
+
+def replay(name):
+    """Durations and stats of the experiments of a batch on the database, by parameters and repetition."""
+
+    database = Persistent.database
+    batch = Persistent.retry(database["batches"].find_one, { "name": name })
+    if not batch:
+        raise ValueError("No batch named %s" % name)
+
+    experiments = {}
+    for e in Persistent.retry(database["experiments"].find, { "batch": batch["_id"] }, ["parameters", "stats", "duration_seconds", "date_started", "date_stopped"]):
+        if "duration_seconds" in e:
+            duration = e["duration_seconds"]
+        elif "date_started" in e and "date_stopped" in e:
+            duration = (e["date_stopped"] - e["date_started"]).total_seconds()
+        else:
+            continue
+        experiments[(fingerprint(e["parameters"]), e["parameters"].get("repetition"))] = (duration, e["stats"] if "stats" in e else {})
+
+    return experiments
+
+class SimulatedQueue(ExperimentQueue):
+    """Queue of a simulated pool: the coordinator waits on it through the pool, which lets the
+    simulator move on only while the coordinator is blocked."""
+
+    def put(self, item, block = True, timeout = None):
+        """Enqueue item, waiting for the simulator to take experiments while the queue is full."""
+
+        self.not_full.acquire()
+        try:
+            while self.maxsize > 0 and self._qsize() == self.maxsize:
+                self.pool.wait(self.not_full)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        finally:
+            self.not_full.release()
+
+    def join_with_timeout(self, timeout):
+        """Wait for all tasks to be done (no timeout, the virtual clock only moves while waiting)."""
+
+        self.all_tasks_done.acquire()
+        try:
+            while self.unfinished_tasks:
+                self.pool.wait(self.all_tasks_done)
+        finally:
+            self.all_tasks_done.release()
+
+class SimulatedPool(ExperimentPool):
+    """A pool of thread_n virtual slots: experiments aren't run, their durations and stats come
+    from a model, and they complete in order of (virtual) time, through the same notifications
+    as real ones (so batches and races schedule, prune and cancel as usual). The simulator and
+    the coordinator (the thread running the batch) take turns: the simulator only starts or
+    completes an experiment while the coordinator is blocked (on a full queue, or waiting for
+    experiments to finish), so a simulation doesn't depend on the speed of the machine."""
+
+    queue_type = SimulatedQueue
+
+    def __init__(self, thread_n, model):
+
+        # no runners, a single simulator thread
+        self.available = Condition(Lock())
+        self.queues = []
+        self.leaders = {}
+        self.completed = OrderedDict()
+        self.requeued = []
+        self.thread_n = thread_n
+        self.model = model
+
+        self.now = 0.0
+        self.origin = datetime.datetime.utcnow()
+        self.busy = [0.0] * thread_n
+        self.started = 0
+        self.succeeded = 0
+        self.cancelled = 0
+        self.stopped = False
+
+        # whether the coordinator is blocked (i.e. it's the simulator's turn)
+        self.turn = Condition(Lock())
+        self.blocked = False
+
+        self.simulator = Thread(target = self.simulate, name = "simulator")
+        self.simulator.setDaemon(True)
+        self.simulator.start()
+
+    def clock(self):
+        """Current virtual time (as a date)."""
+        return self.origin + datetime.timedelta(seconds = self.now)
+
+    def wait(self, condition, timeout = None):
+        """Block the coordinator on a condition (whose lock it holds) for a step of the simulator,
+        the coordinator checks again what it's waiting for afterwards."""
+
+        self.turn.acquire()
+        self.blocked = True
+        self.turn.notify()
+        condition.release()
+        while self.blocked and not self.stopped:
+            self.turn.wait()
+        self.turn.release()
+        condition.acquire()
+
+    def take(self):
+        """Next experiment to start (by fair share of the queues, handed back ones first), None if nothing is enqueued."""
+
+        self.available.acquire()
+        try:
+            if self.requeued:
+                return self.requeued.pop(0)
+
+            candidates = [q for q in self.queues if q.qsize()]
+            if not candidates:
+                return None
+
+            q = min(candidates, key = lambda q: q.virtual_time)
+            q.virtual_time += 1.0 / q.weight
+            return q.get_nowait()
+        finally:
+            self.available.release()
+
+    def simulate(self):
+        """Whenever the coordinator is blocked, start an experiment if there are free slots and
+        enqueued experiments, otherwise complete the first one to finish (cancelled ones free
+        their slot at once), then wake the coordinator up."""
+
+        running = []
+        free = range(self.thread_n)
+        sequence = 0
+
+        while True:
+
+            self.turn.acquire()
+            while not self.blocked and not self.stopped:
+                self.turn.wait()
+            self.turn.release()
+            if self.stopped:
+                break
+
+            e = self.take() if free else None
+            if e is not None:
+                sequence += 1
+                slot = free.pop(0)
+                if not self.start(e, slot, sequence, running):
+                    free.append(slot)
+
+            elif running:
+                finish, s, slot, begin, e, stats = heapq.heappop(running)
+                self.now = max(self.now, finish)
+                self.finish(e, slot, begin, stats)
+                free.append(slot)
+
+                # experiments cancelled by the completion (e.g. pruned) stop now
+                for entry in [r for r in running if r[4].interrupted]:
+                    running.remove(entry)
+                    self.finish(entry[4], entry[2], entry[3], None)
+                    free.append(entry[2])
+                heapq.heapify(running)
+
+            # coordinator's turn
+            self.turn.acquire()
+            self.blocked = False
+            self.turn.notify()
+            self.turn.release()
+
+    def start(self, e, slot, sequence, running):
+        """Start an experiment on a slot, returns False if it was dropped (interrupted while queued)."""
+
+        batch = e.batch
+        batch.experiment_started(e)
+
+        if e.interrupted:
+            self.cancelled += 1
+            self.done(e)
+            batch.experiment_finished(e)
+            batch.experiment_q.task_done()
+            return False
+
+        duration, stats = self.model.sample(batch, e)
+        e["date_started"] = self.clock()
+        self.started += 1
+
+        heapq.heappush(running, (self.now + overhead + duration, sequence, slot, self.now, e, stats))
+        return True
+
+    def finish(self, e, slot, begin, stats):
+        """Complete an experiment at the current time, with its stats (None if cancelled)."""
+
+        batch = e.batch
+        self.busy[slot] += self.now - begin
+        e["date_stopped"] = self.clock()
+        e["duration_seconds"] = self.now - begin
+
+        if e.interrupted or stats is None:
+            e.interrupted = True
+            self.cancelled += 1
+        else:
+            e["stats"].update(stats)
+            e.touch("stats")
+            e.save()
+            self.succeeded += 1
+
+        self.done(e)
+        batch.experiment_finished(e)
+        batch.experiment_q.task_done()
+
+    def stop(self):
+        self.turn.acquire()
+        self.stopped = True
+        self.turn.notify()
+        self.turn.release()
+        self.simulator.join()
+
+def simulate(batch, thread_n, model, **arguments):
+    """Run a batch or race (on the current, disposable, database) on thread_n virtual slots,
+    return the makespan (virtual seconds), the utilisation of the slots, the experiments
+    started, completed and cancelled and, for races, the experiments used and the winners."""
+
+    pool = SimulatedPool(thread_n, model)
+    batch.clock = pool.clock
+
+    started = time.time()
+    if batch.type() == "race":
+        batch.run({ "use": False, "cmd": "" }, thread_n, False, arguments.get("alpha", 0.05), { "mode": "none", "cpus": 1 },
+            arguments.get("lookahead", 1), arguments.get("budget", 0), pool)
+    else:
+        batch.run({ "use": False, "cmd": "" }, thread_n, False, { "mode": "none", "cpus": 1 }, pool)
+    pool.stop()
+
+    report = {
+        "slots": thread_n,
+        "makespan": pool.now,
+        "utilisation": sum(pool.busy) / (thread_n * pool.now) if pool.now else 0.0,
+        "busy": sum(pool.busy),
+        "started": pool.started,
+        "completed": pool.succeeded,
+        "cancelled": pool.cancelled,
+        "elapsed": time.time() - started
+    }
+
+    if batch.type() == "race":
+        report["experiments_used"] = batch["experiments_used"] if "experiments_used" in batch else pool.started
+        report["iterations"] = batch.iterations_completed
+        report["winners"] = [{ p.name: p.value for p in batch.configurations[c] } for c in batch.racing]
+
+    return report
@@ -0,0 +1,523 @@
+from bson import json_util
+from bson.objectid import ObjectId
+from threading import RLock, Thread
+import sqlite3
+import hashlib
+import json
+import re
+import time
+from datetime import datetime, timedelta
+import logging as log
+
+margin = 600.0
+"""Seconds after which an experiment is surely on the database. Ids are generated by the
+clients before inserting (and retrying), so experiments may appear out of order, within
+this margin (clock differences between machines included)."""
+
+def decode(text):
+    """Decode a document from extended JSON (dates are naive UTC, as with pymongo)."""
+    return json.loads(text, object_hook = naive)
+
+def naive(dct):
+    """Extended JSON object hook, drops the timezone of (UTC) dates."""
+
+    value = json_util.object_hook(dct)
+    if isinstance(value, datetime) and value.tzinfo:
+        return value.replace(tzinfo = None)
+    return value
+
+def fingerprint(parameters):
+    """Fingerprint of a set of parameters (repetition excluded), identifies similar experiments."""
+
+    parameters = { p: parameters[p] for p in parameters if p != "repetition" }
+    return hashlib.sha1(json.dumps(parameters, sort_keys = True, default = str)).hexdigest()
+
+def settled():
+    """Largest id of the experiments which are surely on the database (generated more than
+    margin seconds ago), those with larger ids might still appear with smaller ones."""
+    return ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds = margin))
+
+def lookup(document, path):
+    """Values found at a dotted path of a document (lists are traversed), empty if missing."""
+
+    values = [document]
+    for key in path.split("."):
+        found = []
+        for v in values:
+            if isinstance(v, dict):
+                if key in v:
+                    found.append(v[key])
+            elif isinstance(v, list):
+                if key.isdigit() and int(key) < len(v):
+                    found.append(v[int(key)])
+                else:
+                    found.extend(e[key] for e in v if isinstance(e, dict) and key in e)
+        values = found
+    return values
+
+def matches(document, query):
+    """Checks whether a document matches a (MongoDB-like) query."""
+
+    for field, condition in query.items():
+
+        if field == "$and":
+            if not all(matches(document, q) for q in condition):
+                return False
+            continue
+
+        if field == "$or":
+            if not any(matches(document, q) for q in condition):
+                return False
+            continue
+
+        values = lookup(document, field)
+
+        # operators
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            for op, arg in condition.items():
+                if not satisfies(values, op, arg):
+                    return False
+
+        # equality (with any element of an array)
+        elif not any(v == condition or (isinstance(v, list) and condition in v) for v in values):
+            return False
+
+    return True
+
+def comparable(a, b):
+    """Checks whether two values can be compared by order (as in MongoDB, only within a type)."""
+
+    numbers = (int, long, float)
+    if isinstance(a, bool) or isinstance(b, bool):
+        return isinstance(a, bool) and isinstance(b, bool)
+    if isinstance(a, numbers):
+        return isinstance(b, numbers)
+    if isinstance(a, basestring):
+        return isinstance(b, basestring)
+    return type(a) == type(b)
+
+def satisfies(values, op, arg):
+    """Checks whether the values found at a path satisfy an operator (arrays, as a whole or
+    by any of their elements)."""
+
+    if op == "$exists":
+        return bool(values) == bool(arg)
+
+    values = values + [e for v in values if isinstance(v, list) for e in v]
+    if op == "$in":
+        return any(v in arg for v in values)
+    if op == "$nin":
+        return not any(v in arg for v in values)
+    if op == "$ne":
+        return not any(v == arg for v in values)
+    if op == "$regex":
+        pattern = re.compile(arg)
+        return any(isinstance(v, basestring) and pattern.search(v) for v in values)
+    if op == "$gt":
+        return any(comparable(v, arg) and v > arg for v in values)
+    if op == "$gte":
+        return any(comparable(v, arg) and v >= arg for v in values)
+    if op == "$lt":
+        return any(comparable(v, arg) and v < arg for v in values)
+    if op == "$lte":
+        return any(comparable(v, arg) and v <= arg for v in values)
+
+    from pymongo.errors import OperationFailure
+    raise OperationFailure("Unsupported query operator %s" % op)
+
+def project(document, fields):
+    """Restrict a document to some (dotted) fields, _id is always included."""
+
+    if fields is None:
+        return document
+
+    if isinstance(fields, dict):
+        fields = [f for f in fields if fields[f]]
+
+    projected = { "_id": document["_id"] }
+    for path in fields:
+        keys = path.split(".")
+        source = document
+        target = projected
+        for k in keys[:-1]:
+            if not isinstance(source, dict) or k not in source:
+                source = None
+                break
+            source = source[k]
+            target = target.setdefault(k, {})
+        if isinstance(source, dict) and keys[-1] in source:
+            target[keys[-1]] = source[keys[-1]]
+
+    return projected
+
+def assign(document, path, value = None, increment = False):
+    """Set (or increment) a dotted path of a document, creating intermediate objects."""
+
+    keys = path.split(".")
+    container = document
+    for k in keys[:-1]:
+        if isinstance(container, list):
+            container = container[int(k)]
+        else:
+            container = container.setdefault(k, {})
+
+    key = int(keys[-1]) if isinstance(container, list) else keys[-1]
+    if increment:
+        container[key] = (container[key] if isinstance(container, list) or key in container else 0) + value
+    else:
+        container[key] = value
+
+def failure(error):
+    """Database error corresponding to a SQLite one (a locked database is retried)."""
+
+    from pymongo.errors import AutoReconnect, OperationFailure
+    return AutoReconnect(str(error)) if "locked" in str(error) else OperationFailure(str(error))
+
+class SQLiteDatabase(object):
+    """A MongoDB-like database stored in a single SQLite file, offers (the subset of) the
+    pymongo API used by json2run. Documents are stored as extended JSON, with indexed columns
+    for the batch and the fingerprint of the parameters. Writes are grouped in transactions,
+    committed every batch writes or interval seconds, or straight away for durable writes."""
+
+    def __init__(self, path, batch = 500, interval = 1.0):
+        """Open (or create) database, ":memory:" for an in-memory one."""
+
+        self.path = path
+        self.lock = RLock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.collections = {}
+        self.batch = batch
+        self.interval = interval
+        self.pending = 0
+        self.last_commit = time.time()
+        self.closed = False
+
+        # commit pending writes in the background
+        if interval:
+            flusher = Thread(target = self.flush_periodically)
+            flusher.setDaemon(True)
+            flusher.start()
+
+    def __getitem__(self, name):
+        """Get (create) collection."""
+
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = SQLiteCollection(self, name)
+            return self.collections[name]
+
+    def execute(self, sql, arguments = (), durable = False):
+        """Run a write statement in the current transaction, commit if needed."""
+
+        with self.lock:
+            try:
+                self.connection.execute(sql, arguments)
+            except sqlite3.IntegrityError as e:
+                from pymongo.errors import DuplicateKeyError
+                raise DuplicateKeyError(str(e))
+            except sqlite3.OperationalError as e:
+                raise failure(e)
+
+            self.pending += 1
+            if durable or self.pending >= self.batch or time.time() - self.last_commit >= self.interval:
+                self.commit()
+
+    def query(self, sql, arguments = ()):
+        """Run a read statement, get all rows."""
+
+        with self.lock:
+            try:
+                return self.connection.execute(sql, arguments).fetchall()
+            except sqlite3.OperationalError as e:
+                raise failure(e)
+
+    def commit(self):
+        """Commit the current transaction."""
+
+        with self.lock:
+            if self.pending:
+                self.connection.commit()
+                self.pending = 0
+            self.last_commit = time.time()
+
+    def flush_periodically(self):
+        """Commit pending writes every interval seconds."""
+
+        while not self.closed:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.closed:
+                    self.commit()
+
+    def close(self):
+        """Commit and close database."""
+
+        with self.lock:
+            if not self.closed:
+                self.commit()
+                self.closed = True
+                self.connection.close()
+
+    def authenticate(self, user, password):
+        """No authentication on local databases."""
+        return True
+
+class SQLiteCollection(object):
+    """A collection of documents in a SQLite table."""
+
+    def __init__(self, database, name):
+        """Create table and indices if needed."""
+
+        self.database = database
+        self.name = name
+        self.table = "\"%s\"" % name.replace("\"", "")
+        database.execute("CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, batch TEXT, fingerprint TEXT, document TEXT)" % self.table)
+        database.execute("CREATE INDEX IF NOT EXISTS \"%s_batch\" ON %s (batch)" % (name, self.table))
+        database.execute("CREATE INDEX IF NOT EXISTS \"%s_fingerprint\" ON %s (fingerprint)" % (name, self.table))
+        database.commit()
+
+    def row(self, document):
+        """Column values of a document."""
+
+        batch = str(document["batch"]) if "batch" in document else None
+        fp = None
+        if isinstance(document.get("parameters"), dict):
+            fp = document["fingerprint"] if "fingerprint" in document else fingerprint(document["parameters"])
+        return (str(document["_id"]), batch, fp, json_util.dumps(document))
+
+    def plan(self, query):
+        """Translate the indexed part of a query into a SQL condition."""
+
+        conditions = []
+        arguments = []
+
+        for field, column in [("_id", "id"), ("batch", "batch"), ("fingerprint", "fingerprint")]:
+            if field not in query:
+                continue
+
+            condition = query[field]
+            if isinstance(condition, dict) and condition.keys() == ["$in"]:
+                if not condition["$in"]:
+                    conditions.append("0")
+                else:
+                    conditions.append("%s IN (%s)" % (column, ",".join("?" * len(condition["$in"]))))
+                    arguments.extend(str(v) for v in condition["$in"])
+            elif not isinstance(condition, (dict, list)):
+                conditions.append("%s = ?" % column)
+                arguments.append(str(condition))
+
+        # equality on the whole set of parameters implies equality of fingerprints
+        if "fingerprint" not in query and isinstance(query.get("parameters"), dict):
+            conditions.append("fingerprint = ?")
+            arguments.append(fingerprint(query["parameters"]))
+
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), arguments
+
+    def documents(self, query, page = 1000):
+        """Matching documents, read a page at a time (in insertion order)."""
+
+        where, arguments = self.plan(query)
+        where = where + (" AND " if where else " WHERE ") + "rowid > ?"
+        last = 0
+
+        while True:
+            rows = self.database.query("SELECT rowid, document FROM %s%s ORDER BY rowid LIMIT %d" % (self.table, where, page), arguments + [last])
+            for rowid, text in rows:
+                document = decode(text)
+                if matches(document, query):
+                    yield document
+            if len(rows) < page:
+                break
+            last = rows[-1][0]
+
+    def insert(self, documents, **write_concern):
+        """Insert one or more documents, return id(s)."""
+
+        single = isinstance(documents, dict)
+        if single:
+            documents = [documents]
+
+        for d in documents:
+            if "_id" not in d:
+                d["_id"] = ObjectId()
+            self.database.execute("INSERT INTO %s (id, batch, fingerprint, document) VALUES (?, ?, ?, ?)" % self.table, self.row(d), durable(write_concern))
+
+        return documents[0]["_id"] if single else [d["_id"] for d in documents]
+
+    def save(self, document, **write_concern):
+        """Insert or replace a document."""
+
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        self.database.execute("INSERT OR REPLACE INTO %s (id, batch, fingerprint, document) VALUES (?, ?, ?, ?)" % self.table, self.row(document), durable(write_concern))
+        return document["_id"]
+
+    def update(self, spec, document, upsert = False, multi = False, **write_concern):
+        """Update matching documents with $set/$unset/$inc operators (or replace them), atomically."""
+
+        with self.database.lock:
+            return self.apply(spec, document, upsert, multi, write_concern)
+
+    def apply(self, spec, document, upsert, multi, write_concern):
+        """Update matching documents (under database lock)."""
+
+        targets = []
+        for d in self.documents(spec):
+            targets.append(d)
+            if not multi:
+                break
+
+        inserted = not targets and upsert
+        if inserted:
+            targets = [{ k: v for k, v in spec.items() if not isinstance(v, dict) }]
+
+        for d in targets:
+
+            if any(k.startswith("$") for k in document):
+                for path, value in document.get("$set", {}).items():
+                    assign(d, path, value)
+                for path, value in document.get("$inc", {}).items():
+                    assign(d, path, value, increment = True)
+                for path in document.get("$unset", {}):
+                    keys = path.split(".")
+                    container = lookup(d, ".".join(keys[:-1])) if len(keys) > 1 else [d]
+                    for c in container:
+                        if isinstance(c, dict):
+                            c.pop(keys[-1], None)
+            else:
+                replacement = dict(document)
+                if "_id" in d:
+                    replacement["_id"] = d["_id"]
+                d = replacement
+
+            # updated documents keep their place (in insertion order)
+            if inserted:
+                self.save(d, **write_concern)
+            else:
+                (id, batch, fp, text) = self.row(d)
+                self.database.execute("UPDATE %s SET batch = ?, fingerprint = ?, document = ? WHERE id = ?" % self.table, (batch, fp, text, id), durable(write_concern))
+
+        return { "n": len(targets), "updatedExisting": bool(targets) }
+
+    def remove(self, spec = None, **write_concern):
+        """Remove matching documents."""
+
+        ids = [str(d["_id"]) for d in self.documents(spec or {})]
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            self.database.execute("DELETE FROM %s WHERE id IN (%s)" % (self.table, ",".join("?" * len(chunk))), chunk, durable(write_concern))
+
+    def find(self, spec = None, fields = None, **kwargs):
+        """Get a cursor over matching documents."""
+        return SQLiteCursor(self, spec or {}, fields)
+
+    def find_one(self, spec = None, fields = None, **kwargs):
+        """Get first matching document (None if there's none)."""
+
+        if spec is not None and not isinstance(spec, dict):
+            spec = { "_id": spec }
+        for d in self.documents(spec or {}, page = 100):
+            return project(d, fields)
+        return None
+
+    def count(self):
+        """Number of documents in the collection."""
+        return self.database.query("SELECT COUNT(*) FROM %s" % self.table)[0][0]
+
+    def ensure_index(self, *args, **kwargs):
+        """Batch and fingerprint are always indexed."""
+        pass
+
+    create_index = ensure_index
+
+    def aggregate(self, pipeline, **kwargs):
+        """Aggregation pipelines are not supported by local databases."""
+        from pymongo.errors import OperationFailure
+        raise OperationFailure("Aggregation is not supported by SQLite databases.")
+
+class SQLiteCursor(object):
+    """Lazy cursor over the matching documents of a collection, supports sort, skip, limit, count and rewind."""
+
+    def __init__(self, collection, spec, fields):
+
+        self.collection = collection
+        self.spec = spec
+        self.fields = fields
+        self.order = None
+        self.skipped = 0
+        self.limited = 0
+        self.iterator = None
+
+    def sort(self, key, direction = 1):
+        """Sort by one or more keys (read all the matching documents)."""
+
+        self.order = [(key, direction)] if isinstance(key, basestring) else list(key)
+        return self
+
+    def skip(self, n):
+        self.skipped = n
+        return self
+
+    def limit(self, n):
+        self.limited = n
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def generate(self):
+        """Matching documents, in order."""
+
+        documents = self.collection.documents(self.spec)
+
+        if self.order:
+            documents = list(documents)
+            for key, direction in reversed(self.order):
+                documents.sort(key = lambda d: (lookup(d, key) or [None])[0], reverse = direction < 0)
+
+        for n, d in enumerate(documents):
+            if n < self.skipped:
+                continue
+            if self.limited and n >= self.skipped + self.limited:
+                break
+            yield project(d, self.fields)
+
+    def __iter__(self):
+        if self.iterator is None:
+            self.iterator = self.generate()
+        return self.iterator
+
+    def next(self):
+        return iter(self).next()
+
+    def rewind(self):
+        self.iterator = None
+        return self
+
+    def count(self, with_limit_and_skip = False):
+        """Number of matching documents."""
+
+        n = sum(1 for d in self.collection.documents(self.spec))
+        if with_limit_and_skip:
+            n = max(0, n - self.skipped)
+            if self.limited:
+                n = min(n, self.limited)
+        return n
+
+def durable(write_concern):
+    """Whether a write concern requires the write to be committed straight away."""
+    return bool(write_concern.get("j") or write_concern.get("fsync"))
+
+def open_url(url):
+    """Open a local database from its URL, i.e. sqlite:///relative/path, sqlite:////absolute/path
+    or sqlite:// (in memory)."""
+
+    if not url.startswith("sqlite://"):
+        raise ValueError("Unsupported database URL %s" % url)
+
+    path = url[len("sqlite://"):]
+    if path.startswith("/"):
+        path = path[1:]
+    return SQLiteDatabase(path or ":memory:")
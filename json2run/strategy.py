@@ -0,0 +1,188 @@
+from math import ceil, floor, log as logarithm
+import logging as log
+import random
+
+def reduction(eta):
+    """Checks the reduction factor of successive halving (at least 2, else rungs never end)."""
+
+    if int(eta) < 2:
+        raise ValueError("Invalid reduction factor %s, eta must be at least 2" % eta)
+    return int(eta)
+
+class RaceStrategy(object):
+    """Decides which configurations are raced (in one or more brackets, each one starting from
+    the first instance) and which of them survive after each iteration."""
+
+    single_winner = False
+    """Whether a single winner is kept among the survivors of the brackets."""
+
+    @staticmethod
+    def from_race(race):
+        """Generates the strategy stored in a race (F-Race for races predating strategies)."""
+
+        name = race["strategy"] if "strategy" in race else "frace"
+        eta = race["eta"] if "eta" in race else 2
+
+        if name == "frace":
+            return FRace()
+        elif name == "halving":
+            return SuccessiveHalving(eta)
+        elif name == "hyperband":
+            return Hyperband(eta)
+        else:
+            raise ValueError("Unrecognized race strategy \"%s\"" % name)
+
+    def brackets(self, race):
+        """Generates the sets of configurations to race, one race after the other (default: all at once)."""
+        yield range(len(race.configurations))
+
+    def prune(self, race, n):
+        """Returns the configurations surviving after n iterations (default: all)."""
+        return race.racing
+
+class FRace(RaceStrategy):
+    """Prune configurations according to Friedman (and Conover) or Wilcoxon tests, after initial_block iterations."""
+
+    def prune(self, race, n):
+
+        racing = race.racing
+        results = race.results
+        sum_of_ranks = results.sum_of_ranks
+
+        # if it's not time to prune yet
+        if n < race["initial_block"]:
+            return racing
+
+        # SciPy is only needed (and imported) once pruning starts
+        from scipy.stats import chi2, t as tstudent, wilcoxon
+
+        n = float(n)
+        k = float(len(racing))
+
+        log.info("Checking null hypothesis against %d configurations on %d samples ..." % (k, n))
+
+        if k > 2:
+            # use friedman
+            log.info("Running Friedman rank sum test")
+
+            statistic = results.friedman()
+
+            log.info("Statistic: %f" % statistic)
+
+            p_value = 1 - chi2.cdf(statistic, k-1)
+
+            race["p_value"] = p_value
+
+            log.info("P-value: %f" % p_value)
+
+            if p_value <= race.alpha:
+
+                t_student = results.conover(tstudent.ppf(1-race.alpha/2, (n-1)*(k-1)))
+                best_sum = sum_of_ranks[racing].min()
+
+                log.info("t: %f" % (t_student))
+
+                if log.getLogger().isEnabledFor(log.DEBUG):
+                    for c in racing:
+                        log.debug("%d: (%f - %f = %f) vs. %f" % (c, sum_of_ranks[c], best_sum, abs(sum_of_ranks[c] - best_sum), t_student))
+
+                return [c for c in racing if abs(sum_of_ranks[c] - best_sum) <= t_student]
+
+        else:
+
+            # wilcoxon
+            log.info("Running Wilcoxon signed-rank test")
+
+            if n < 10:
+                log.info("Sample size too small for Wilcoxon signed-rank test")
+            else:
+                p_value = wilcoxon(*[results.performance(c) for c in racing])[1]
+
+                race["p_value"] = p_value
+
+                log.info("P-value: %s" % p_value)
+
+                if p_value <= race.alpha:
+
+                    log.info("Old racing: %s" % (racing))
+
+                    if sum_of_ranks[racing[0]] < sum_of_ranks[racing[1]]:
+                        return [racing[0]]
+                    else:
+                        return [racing[1]]
+
+        return racing
+
+class SuccessiveHalving(RaceStrategy):
+    """Keep the best 1/eta of the configurations (by sum of ranks) each time the number of
+    iterations reaches a rung, i.e. initial_block * eta^i."""
+
+    def __init__(self, eta = 2, first_rung = None):
+        """Sets the reduction factor and (optionally) the first rung, initial_block otherwise."""
+        self.eta = reduction(eta)
+        self.first_rung = first_rung
+
+    def rung(self, race, n):
+        """Checks whether n iterations make a rung."""
+
+        rung = self.first_rung or race["initial_block"]
+        while rung < n:
+            rung *= self.eta
+        return rung == n
+
+    def prune(self, race, n):
+
+        racing = race.racing
+        if not self.rung(race, n):
+            return racing
+
+        keep = max(1, len(racing) // self.eta)
+        log.info("Rung at %d iterations, keeping best %d out of %d configurations" % (n, keep, len(racing)))
+
+        sum_of_ranks = race.results.sum_of_ranks
+        best = sorted(racing, key = lambda c: (sum_of_ranks[c], c))[:keep]
+
+        # keep racing order
+        best = set(best)
+        return [c for c in racing if c in best]
+
+class Hyperband(RaceStrategy):
+    """Run brackets of successive halving, from many configurations on few iterations to few
+    configurations on all the iterations, each one on configurations sampled with the race's seed.
+    The winner is the best of the winners of the brackets, on the instances all of them raced."""
+
+    single_winner = True
+
+    def __init__(self, eta = 3):
+        """Sets the reduction factor."""
+        self.eta = reduction(eta)
+        self.halving = None
+
+    def schedule(self, race):
+        """Computes (configurations, first rung) of each bracket."""
+
+        iterations = race.inst_generator.count()
+        minimum = max(1, int(race["initial_block"]))
+        s_max = int(floor(logarithm(max(1.0, float(iterations) / minimum), self.eta) + 1e-9))
+
+        schedule = []
+        for s in range(s_max, -1, -1):
+            n = int(ceil(float(s_max + 1) / (s + 1) * self.eta ** s))
+            r = max(1, int(iterations * self.eta ** (-s)))
+            schedule.append((min(n, len(race.configurations)), r))
+
+        return schedule
+
+    def brackets(self, race):
+
+        configurations = len(race.configurations)
+        for (b, (n, r)) in enumerate(self.schedule(race)):
+
+            log.info("Hyperband bracket %d: %d configurations, first rung at %d iterations" % (b, n, r))
+
+            self.halving = SuccessiveHalving(self.eta, r)
+            sampler = random.Random(int(race["seed"]) + b)
+            yield sorted(sampler.sample(xrange(configurations), n))
+
+    def prune(self, race, n):
+        return self.halving.prune(race, n)
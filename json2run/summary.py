@@ -0,0 +1,177 @@
+from persistent import *
+from experiment import Experiment
+from storage import fingerprint, settled
+from math import sqrt
+import datetime
+import logging as log
+
+class Summary(Persistent):
+    """Summary statistics of the experiments of a batch with the same configuration (i.e. the
+    same fingerprint), one document per configuration. The values of the summarized stats are
+    kept, so that the summary can be updated with new experiments only."""
+
+    write_concern = Persistent.durable
+
+    @classmethod
+    def collection(cls):
+        return "summaries"
+
+def numeric(value):
+    """Whether a stat value can be summarized."""
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool) and value == value
+
+def describe(values, alpha = 0.05):
+    """Count, mean, median, (sample) standard deviation, min, max and the 1-alpha confidence
+    interval of the mean (Student's t) of a list of values."""
+
+    from scipy.stats import t as tstudent
+
+    n = len(values)
+    if not n:
+        return { "count": 0 }
+
+    ordered = sorted(values)
+    mean = sum(ordered) / float(n)
+    median = ordered[n / 2] if n % 2 else (ordered[n / 2 - 1] + ordered[n / 2]) / 2.0
+    stdev = sqrt(sum((v - mean) ** 2 for v in ordered) / (n - 1)) if n > 1 else 0.0
+    half = tstudent.ppf(1 - alpha / 2, n - 1) * stdev / sqrt(n) if n > 1 else 0.0
+
+    return {
+        "count": n,
+        "mean": mean,
+        "median": median,
+        "stdev": stdev,
+        "min": ordered[0],
+        "max": ordered[-1],
+        "ci": [mean - half, mean + half]
+    }
+
+def grouped(match, stats):
+    """Experiments matching a query grouped by fingerprint (here, from a projection)."""
+
+    found = {}
+    fields = ["fingerprint", "parameters"] + ["stats.%s" % s for s in stats]
+    for e in Experiment.get(match, fields).batch_size(10000):
+
+        # experiments run by older versions have no fingerprint
+        key = e["fingerprint"] if "fingerprint" in e else fingerprint(e["parameters"])
+        if key not in found:
+            found[key] = { "fingerprint": key, "parameters": e["parameters"], "experiments": 0, "values": { s: [] for s in stats } }
+
+        row = found[key]
+        row["experiments"] += 1
+        for s in stats:
+            if "stats" in e and s in e["stats"] and numeric(e["stats"][s]):
+                row["values"][s].append(e["stats"][s])
+
+    return found.values()
+
+def groups(match, stats):
+    """Experiments matching a query, grouped by fingerprint, with the values of the given
+    stats. Grouping happens on the database, where supported, so that only one row per
+    configuration is transferred."""
+
+    group = {
+        "_id": "$fingerprint",
+        "parameters": { "$first": "$parameters" },
+        "experiments": { "$sum": 1 }
+    }
+    for i, s in enumerate(stats):
+        group["values_%d" % i] = { "$push": "$stats.%s" % s }
+
+    fingerprinted = dict(match)
+    fingerprinted["fingerprint"] = { "$exists": True }
+
+    from pymongo.errors import OperationFailure
+    try:
+        rows = list(Persistent.database[Experiment.collection()].aggregate([{ "$match": fingerprinted }, { "$group": group }], cursor = {}))
+    except OperationFailure as e:
+        log.info("Grouping experiments locally (%s)." % e)
+        return grouped(match, stats)
+
+    found = [{
+        "fingerprint": row["_id"],
+        "parameters": row["parameters"],
+        "experiments": row["experiments"],
+        "values": { s: [v for v in row["values_%d" % i] if numeric(v)] for i, s in enumerate(stats) }
+    } for row in rows]
+
+    # merge with experiments without fingerprint
+    match["fingerprint"] = { "$exists": False }
+    merged = { row["fingerprint"]: row for row in found }
+    for row in grouped(match, stats):
+        if row["fingerprint"] not in merged:
+            merged[row["fingerprint"]] = row
+            continue
+        other = merged[row["fingerprint"]]
+        other["experiments"] += row["experiments"]
+        for s in stats:
+            other["values"][s].extend(row["values"][s])
+
+    return merged.values()
+
+def summarize(batch, stats, alpha = 0.05):
+    """Update the summary of a batch with the experiments added since the last update (or
+    rebuild it if the stats changed), return the summaries of all its configurations. The
+    high-water mark only covers experiments which are surely on the database (see
+    storage.settled), the newer ones which are summarized are listed as recent."""
+
+    batch_id = batch["_id"]
+    meta = batch["summary"] if "summary" in batch else None
+    if not meta or meta["stats"] != stats or meta["alpha"] != alpha:
+        Summary.remove({ "batch": batch_id })
+        meta = { "stats": stats, "alpha": alpha, "high_water": None, "recent": [] }
+
+    high_water = meta["high_water"]
+    recent = meta["recent"] if "recent" in meta else []
+    cutoff = settled()
+
+    # experiments past the mark which might still appear with smaller ids: a snapshot of
+    # those on the database now (the others are summarized next time)
+    newer = { "batch": batch_id, "_id": { "$gt": max(high_water, cutoff) if high_water else cutoff } }
+    if recent:
+        newer["_id"]["$nin"] = recent
+    fresh = [e["_id"] for e in Experiment.get(newer, ["_id"])]
+    ranges = [{ "_id": { "$in": fresh } }] if fresh else []
+
+    # experiments past the mark which are surely on the database, but those already summarized
+    if not high_water or cutoff > high_water:
+        older = { "$lte": cutoff }
+        if high_water:
+            older["$gt"] = high_water
+        if recent:
+            older["$nin"] = recent
+        ranges.append({ "_id": older })
+        high_water = cutoff
+
+    updated = 0
+    for row in groups({ "batch": batch_id, "$or": ranges }, stats) if ranges else []:
+
+        summary = Summary()
+        existing = Summary.find_one({ "batch": batch_id, "fingerprint": row["fingerprint"] }) if meta["high_water"] else None
+        if existing:
+            summary.load(existing)
+        else:
+            summary["batch"] = batch_id
+            summary["fingerprint"] = row["fingerprint"]
+            summary["parameters"] = { p: row["parameters"][p] for p in row["parameters"] if p != "repetition" }
+            summary["experiments"] = 0
+            summary["values"] = { s: [] for s in stats }
+
+        summary["experiments"] += row["experiments"]
+        for s in stats:
+            summary["values"][s].extend(row["values"][s])
+        summary.touch("values")
+        summary["stats"] = { s: describe(summary["values"][s], alpha) for s in stats }
+        summary.save()
+
+        updated += 1
+
+    meta["high_water"] = high_water
+    meta["recent"] = [r for r in recent + fresh if r > high_water]
+    meta["date"] = datetime.datetime.utcnow()
+    batch["summary"] = meta
+    batch.save(Persistent.durable)
+
+    log.info("Updated %d configurations." % updated)
+    return list(Summary.get({ "batch": batch_id }, ["fingerprint", "parameters", "experiments", "stats"]))
@@ -0,0 +1,99 @@
+# Check that ConfigurationSpace yields the configurations of a race as the generator does
+# Run with: python test/test_configurationspace.py
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json2run.parameterexpression import ParameterExpression
+from json2run.parameter import ParameterList
+from json2run.configurationspace import ConfigurationSpace
+
+def discrete(name, values):
+    return { "type": "discrete", "name": name, "values": values }
+
+def node(kind, descendants, postprocessors = None):
+    n = { "type": kind, "descendants": descendants }
+    if postprocessors:
+        n["postprocessors"] = postprocessors
+    return n
+
+def key(configuration):
+    """Order-insensitive identity of a configuration."""
+    return tuple(sorted((p.name, str(p.value)) for p in configuration))
+
+def generated(expression, parameter):
+    """Values of the parameter and configurations (by first appearance), as generated by
+    while has_more() enumeration."""
+
+    generator = ParameterExpression.from_obj(expression)
+    values, configurations, seen = [], [], set()
+    while generator.has_more():
+        n = ParameterList(generator.next())
+        p = n[parameter]
+        if p.value not in values:
+            values.append(p.value)
+        n.remove(p)
+        if key(n) not in seen:
+            seen.add(key(n))
+            configurations.append(key(n))
+    return values, configurations
+
+renaming = { "type": "renaming", "old": "c", "new": "d" }
+expression = { "type": "expression", "match": "a|b", "result": "e", "expression": "a.value * 10 + b.value" }
+
+factored = {
+    "and": node("and", [discrete("a", [1, 2, 3]), discrete("inst", ["x", "y"]), discrete("b", [4, 5])]),
+    "nested_and": node("and", [node("and", [discrete("a", [1, 2]), discrete("inst", ["x", "y", "z"])]),
+        node("and", [discrete("b", [3, 4]), discrete("c", [5, 6, 7])])]),
+    "or_sibling": node("and", [discrete("inst", ["x", "y"]), node("or", [discrete("a", [1, 2]), discrete("b", [3, 4, 5])]),
+        discrete("c", [6, 7])]),
+    "and_postprocessed_sibling": node("and", [discrete("inst", ["x", "y"]), node("and", [discrete("a", [1, 2]), discrete("b", [3, 4])], [expression]),
+        discrete("c", [8, 9])]),
+    "or_postprocessed_sibling": node("and", [node("or", [discrete("a", [1, 2]), discrete("c", [3, 4])], [renaming]), discrete("inst", ["x", "y", "z"])])
+}
+"""Trees the instances can be factored out of (the instance leaf is in a chain of and nodes
+without post-processors)."""
+
+enumerated = {
+    "postprocessed_and": node("and", [discrete("a", [1, 2]), discrete("b", [3, 4]), discrete("inst", ["x", "y"])], [expression]),
+    "instance_in_or": node("or", [node("and", [discrete("inst", ["x", "y"]), discrete("a", [1, 2])]),
+        node("and", [discrete("b", [3, 4]), discrete("inst", ["x", "y"])])]),
+    "instance_under_postprocessor": node("and", [discrete("c", [1, 2]), node("and", [discrete("inst", ["x", "y"]), discrete("a", [3, 4])], [renaming])])
+}
+"""Trees whose experiments must be generated to separate the instances."""
+
+class TestConfigurationSpace(unittest.TestCase):
+
+    def test_factored(self):
+
+        for name, tree in sorted(factored.items()):
+            values, configurations = generated(tree, "inst")
+            result = ConfigurationSpace.factor(ParameterExpression.from_obj(tree), "inst")
+            self.assertTrue(result is not None, name)
+
+            instances, space = result
+            self.assertEqual(instances, values, name)
+            self.assertEqual(len(space), len(configurations), name)
+            self.assertEqual([key(c) for c in space], configurations, name)
+            self.assertEqual([key(space[i]) for i in range(-len(space), 0)], configurations, name)
+
+    def test_enumerated(self):
+
+        for name, tree in sorted(enumerated.items()):
+            values, configurations = generated(tree, "inst")
+            self.assertTrue(ConfigurationSpace.factor(ParameterExpression.from_obj(tree), "inst") is None, name)
+
+            instances, space = ConfigurationSpace.enumerate(ParameterExpression.from_obj(tree), "inst")
+            self.assertEqual(sorted(instances), sorted(values), name)
+            self.assertEqual(sorted(key(c) for c in space), sorted(configurations), name)
+
+    def test_range(self):
+
+        instances, space = ConfigurationSpace.factor(ParameterExpression.from_obj(factored["and"]), "inst")
+        self.assertRaises(IndexError, space.__getitem__, len(space))
+        self.assertRaises(IndexError, space.__getitem__, -len(space) - 1)
+
+if __name__ == "__main__":
+    unittest.main()
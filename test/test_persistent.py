@@ -0,0 +1,168 @@
+# Check the dirty tracking of Persistent: updates sent on save, and changes kept when a save fails
+# Run with: python test/test_persistent.py
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json2run.persistent import Persistent, PersistenceError
+from pymongo.errors import OperationFailure
+
+class Collection(object):
+    """Records the updates, fails them on request."""
+
+    def __init__(self):
+        self.updates = []
+        self.inserts = []
+        self.fail = False
+        self.missing = False
+
+    def insert(self, document, **write_concern):
+        self.inserts.append(write_concern)
+
+    def update(self, query, update, **write_concern):
+        if self.fail:
+            raise OperationFailure("update failed")
+        if self.missing:
+            return { "n": 0, "updatedExisting": False }
+        self.updates.append(update)
+        return { "n": 1, "updatedExisting": True }
+
+class Document(Persistent):
+
+    @classmethod
+    def collection(cls):
+        return "documents"
+
+class TestDirtyTracking(unittest.TestCase):
+
+    def setUp(self):
+
+        self.collection = Collection()
+        self.database = Persistent.database
+        Persistent.database = { "documents": self.collection }
+
+        # a document which is already on the database
+        self.document = Document({ "_id": 1, "name": "a", "done": 3, "configurations": [{ "sum": 0 }, { "sum": 0 }] })
+
+    def tearDown(self):
+        Persistent.database = self.database
+
+    def saved(self):
+        """The update sent by a save."""
+
+        self.document.save()
+        return self.collection.updates.pop() if self.collection.updates else None
+
+    def test_nothing(self):
+        self.assertEqual(self.saved(), None)
+
+    def test_set(self):
+
+        self.document["name"] = "b"
+        self.document["configurations"][0]["sum"] = 5
+        self.document.touch("configurations")
+        self.assertEqual(self.saved(), { "$set": { "name": "b", "configurations": [{ "sum": 5 }, { "sum": 0 }] } })
+        self.assertEqual(self.saved(), None)
+
+    def test_inc(self):
+
+        self.document.increment("done")
+        self.document.increment("done", 2)
+        self.document.increment("failed")
+        self.assertEqual(self.saved(), { "$inc": { "done": 3, "failed": 1 } })
+        self.assertEqual(self.document["done"], 6)
+
+        # setting a field overrides its increments
+        self.document.increment("done")
+        self.document["done"] = 10
+        self.assertEqual(self.saved(), { "$set": { "done": 10 } })
+
+        # increments of a field which is set are applied to the value set
+        self.document["done"] = 0
+        self.document.increment("done")
+        self.assertEqual(self.saved(), { "$set": { "done": 1 } })
+
+    def test_paths(self):
+
+        self.document.set_path("configurations.1.sum", 7)
+        self.document.increment("done")
+        self.assertEqual(self.document["configurations"][1]["sum"], 7)
+        self.assertEqual(self.saved(), { "$set": { "configurations.1.sum": 7 }, "$inc": { "done": 1 } })
+
+    def test_path_then_touch(self):
+
+        # touching a field drops its pending nested fields (a single $set of the whole field)
+        self.document.set_path("configurations.1.sum", 7)
+        self.document.set_path("name", "c")
+        self.document.touch("configurations")
+        self.assertEqual(self.saved(), { "$set": { "name": "c", "configurations": [{ "sum": 0 }, { "sum": 7 }] } })
+
+    def test_touch_then_path(self):
+
+        # nested fields of a field which is set as a whole are not set on their own
+        self.document.touch("configurations")
+        self.document.set_path("configurations.0.sum", 2)
+        self.assertEqual(self.saved(), { "$set": { "configurations": [{ "sum": 2 }, { "sum": 0 }] } })
+
+    def test_failed_save(self):
+
+        self.document["name"] = "b"
+        self.document.set_path("configurations.0.sum", 1)
+        self.document.increment("done", 2)
+
+        self.collection.fail = True
+        self.assertRaises(PersistenceError, self.document.save)
+
+        # changes made in the meanwhile take precedence, or add up
+        self.document.set_path("configurations.0.sum", 4)
+        self.document.increment("done")
+        self.collection.fail = False
+        self.assertEqual(self.saved(), { "$set": { "name": "b", "configurations.0.sum": 4 }, "$inc": { "done": 3 } })
+        self.assertEqual(self.saved(), None)
+
+    def test_failed_save_then_touch(self):
+
+        self.document.set_path("configurations.0.sum", 1)
+        self.collection.fail = True
+        self.assertRaises(PersistenceError, self.document.save)
+
+        # the restored nested field would conflict with the whole field
+        self.document.touch("configurations")
+        self.collection.fail = False
+        self.assertEqual(self.saved(), { "$set": { "configurations": [{ "sum": 1 }, { "sum": 0 }] } })
+
+    def test_touch_then_failed_save(self):
+
+        self.document.touch("configurations")
+        self.collection.fail = True
+        self.assertRaises(PersistenceError, self.document.save)
+
+        # nested fields set in the meanwhile are covered by the restored field
+        self.document.set_path("configurations.1.sum", 9)
+        self.collection.fail = False
+        self.assertEqual(self.saved(), { "$set": { "configurations": [{ "sum": 0 }, { "sum": 9 }] } })
+
+    def test_missing_document(self):
+
+        # durable updates which don't reach the document fail (and keep the changes)
+        self.collection.missing = True
+        self.document["name"] = "b"
+        self.document.save()
+        self.document["name"] = "c"
+        self.assertRaises(PersistenceError, self.document.save, Persistent.durable)
+
+        self.collection.missing = False
+        self.assertEqual(self.saved(), { "$set": { "name": "c" } })
+
+    def test_acknowledged_insert(self):
+
+        document = Document({ "name": "n" })
+        document.write_concern = { "w": 0 }
+        document.save()
+        self.assertEqual(self.collection.inserts, [{ "w": 1 }])
+        self.assertTrue("_id" in document)
+
+if __name__ == "__main__":
+    unittest.main()
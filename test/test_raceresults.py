@@ -0,0 +1,100 @@
+# Check the incremental statistics of RaceResults against SciPy, on data with ties
+# Run with: python test/test_raceresults.py
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json2run.raceresults import RaceResults, average_ranks
+from scipy.stats import rankdata, friedmanchisquare
+from math import sqrt
+import numpy
+
+def reference_ranks(values):
+    """Ranks of each column (configurations x iterations) with SciPy."""
+    return numpy.column_stack([rankdata(values[:, j]) for j in range(values.shape[1])])
+
+def reference_conover(values, quantile):
+    """Conover's critical difference, straight from its definition."""
+
+    k, n = values.shape
+    ranks = reference_ranks(values)
+    sums = ranks.sum(axis = 1)
+    return quantile * sqrt(2 * (n * (ranks ** 2).sum() - (sums ** 2).sum()) / ((n - 1) * (k - 1)))
+
+class TestRaceResults(unittest.TestCase):
+
+    def setUp(self):
+
+        # few distinct values, so that most iterations have ties
+        generator = numpy.random.RandomState(1)
+        self.values = generator.randint(0, 4, size = (6, 20)).astype(float)
+        self.results = RaceResults(6, 20, block = 4)
+        for i in range(20):
+            for c in range(6):
+                self.results.record(c, i, self.values[c, i])
+
+    def rank(self, iterations):
+        for i in range(iterations):
+            self.results.rank(i)
+
+    def check(self, racing, iterations):
+        """Statistics of the results against those computed from scratch by SciPy."""
+
+        values = self.values[racing, :iterations]
+        ranks = reference_ranks(values)
+
+        numpy.testing.assert_allclose(self.results.sum_of_ranks[racing], ranks.sum(axis = 1))
+        self.assertAlmostEqual(self.results.sum_of_squared_ranks, (ranks ** 2).sum())
+
+        statistic, p = friedmanchisquare(*values)
+        self.assertAlmostEqual(self.results.friedman(), statistic)
+        self.assertAlmostEqual(self.results.conover(2.0), reference_conover(values, 2.0))
+
+    def test_average_ranks(self):
+
+        ranks, ties = average_ranks(self.values)
+        numpy.testing.assert_allclose(ranks, reference_ranks(self.values))
+
+        for j in range(self.values.shape[1]):
+            counts = numpy.unique(self.values[:, j], return_counts = True)[1].astype(float)
+            self.assertAlmostEqual(ties[j], (counts ** 3 - counts).sum())
+
+    def test_incremental(self):
+
+        racing = range(6)
+        for i in range(20):
+            self.results.rank(i)
+            if i >= 1:
+                self.check(racing, i + 1)
+
+    def test_restrict(self):
+
+        self.rank(10)
+        racing = [0, 2, 3, 5]
+        self.results.restrict(racing)
+        self.check(racing, 10)
+
+        # further iterations keep the statistics of the subset
+        for i in range(10, 15):
+            self.results.rank(i)
+        self.check(racing, 15)
+
+        self.results.restrict([2, 5, 3])
+        self.check([2, 3, 5], 15)
+
+    def test_growth(self):
+
+        # iterations beyond the first block are allocated on demand
+        self.assertTrue(self.results.has(5, 19))
+        self.assertFalse(RaceResults(3, 10, block = 2).has(0, 5))
+        self.assertEqual(self.results.performance(0).shape, (0,))
+        self.rank(3)
+        numpy.testing.assert_allclose(self.results.performance(4), self.values[4, :3])
+
+    def test_order(self):
+        self.assertRaises(ValueError, self.results.rank, 1)
+
+if __name__ == "__main__":
+    unittest.main()
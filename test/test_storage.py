@@ -0,0 +1,161 @@
+# Check the SQLite backend against MongoDB semantics (and against mongomock, if installed)
+# Run with: python test/test_storage.py
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json2run.storage import SQLiteDatabase
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+documents = [
+    { "_id": 1, "batch": "b1", "name": "a", "n": 1, "x": 1.5, "tags": ["p", "q"],
+      "parameters": { "a": 1, "b": "u", "repetition": 0 }, "stats": { "cost": 3 } },
+    { "_id": 2, "batch": "b1", "name": "b", "n": 2, "tags": ["q"],
+      "parameters": { "a": 2, "b": "v", "repetition": 0 }, "stats": { "cost": 1 } },
+    { "_id": 3, "batch": "b2", "name": "c", "n": "3",
+      "parameters": { "a": 1, "b": "u", "repetition": 1 }, "configurations": [{ "sum": 0 }, { "sum": 1 }] }
+]
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+
+        self.backends = [("sqlite", SQLiteDatabase(":memory:", interval = 0)["experiments"])]
+        if mongomock:
+            self.backends.append(("mongomock", mongomock.MongoClient().db["experiments"]))
+
+        for name, collection in self.backends:
+            for d in documents:
+                collection.insert(dict(d))
+
+    def ids(self, query):
+        """Ids of the matching documents, on each backend."""
+        return [(name, sorted(d["_id"] for d in collection.find(query))) for (name, collection) in self.backends]
+
+    def check(self, query, expected):
+        for name, ids in self.ids(query):
+            self.assertEqual(ids, expected, "%s: %s gives %s instead of %s" % (name, query, ids, expected))
+
+    def test_equality(self):
+
+        self.check({ "name": "a" }, [1])
+        self.check({ "_id": 2 }, [2])
+        self.check({ "batch": "b1" }, [1, 2])
+        self.check({ "parameters.a": 1 }, [1, 3])
+        self.check({ "parameters": { "a": 1, "b": "u", "repetition": 0 } }, [1])
+        self.check({ "stats.cost": 1 }, [2])
+        self.check({ "configurations.sum": 1 }, [3])
+
+        # arrays match any of their elements
+        self.check({ "tags": "q" }, [1, 2])
+        self.check({ "tags": ["q"] }, [2])
+
+    def test_comparison(self):
+
+        # only values of the same type are compared (the string "3" is not greater than 1)
+        self.check({ "n": { "$gt": 1 } }, [2])
+        self.check({ "n": { "$gte": 1, "$lt": 2 } }, [1])
+        self.check({ "n": { "$lte": 2 } }, [1, 2])
+        self.check({ "n": { "$gte": "3" } }, [3])
+        self.check({ "stats.cost": { "$lt": 2 } }, [2])
+        self.check({ "tags": { "$gt": "p" } }, [1, 2])
+
+    def test_sets(self):
+
+        self.check({ "name": { "$in": ["a", "c"] } }, [1, 3])
+        self.check({ "tags": { "$in": ["p"] } }, [1])
+        self.check({ "tags": { "$nin": ["p"] } }, [2, 3])
+        self.check({ "tags": { "$ne": "q" } }, [3])
+        self.check({ "batch": { "$in": ["b2"] } }, [3])
+        self.check({ "batch": { "$in": [] } }, [])
+        self.check({ "batch": { "$nin": ["b1"] } }, [3])
+        self.check({ "_id": { "$in": [1, 3] } }, [1, 3])
+
+    def test_exists_and_regex(self):
+
+        self.check({ "x": { "$exists": True } }, [1])
+        self.check({ "x": { "$exists": False } }, [2, 3])
+        self.check({ "stats.cost": { "$exists": True } }, [1, 2])
+        self.check({ "name": { "$regex": "^[ab]" } }, [1, 2])
+        self.check({ "tags": { "$regex": "p" } }, [1])
+
+    def test_logical(self):
+
+        self.check({ "$or": [{ "name": "a" }, { "n": 2 }] }, [1, 2])
+        self.check({ "$and": [{ "parameters.a": 1 }, { "batch": "b2" }] }, [3])
+        self.check({ "batch": "b1", "$or": [{ "tags": "p" }, { "n": { "$gt": 5 } }] }, [1])
+
+    def test_projection(self):
+
+        for name, collection in self.backends:
+            self.assertEqual(collection.find_one({ "_id": 1 }, ["name", "parameters.a"]), { "_id": 1, "name": "a", "parameters": { "a": 1 } }, name)
+            self.assertEqual(collection.find_one({ "_id": 2 }, { "stats": True }), { "_id": 2, "stats": { "cost": 1 } }, name)
+            self.assertEqual(list(collection.find({ "batch": "b2" }, ["missing"])), [{ "_id": 3 }], name)
+            self.assertEqual(collection.find_one({ "name": "z" }), None, name)
+
+    def test_sort(self):
+
+        for name, collection in self.backends:
+            order = lambda cursor: [d["_id"] for d in cursor]
+
+            # missing values come first, numbers before strings
+            self.assertEqual(order(collection.find().sort("n")), [1, 2, 3], name)
+            self.assertEqual(order(collection.find().sort("n", -1)), [3, 2, 1], name)
+            self.assertEqual(order(collection.find().sort("stats.cost")), [3, 2, 1], name)
+            self.assertEqual(order(collection.find().sort("stats.cost", -1)), [1, 2, 3], name)
+            self.assertEqual(order(collection.find().sort([("batch", 1), ("n", -1)])), [2, 1, 3], name)
+
+    def test_count(self):
+
+        for name, collection in self.backends:
+            self.assertEqual(collection.count(), 3, name)
+            self.assertEqual(collection.find({ "batch": "b1" }).count(), 2, name)
+
+            cursor = collection.find().sort("n").skip(1).limit(1)
+            self.assertEqual([d["_id"] for d in cursor], [2], name)
+            self.assertEqual(cursor.count(), 3, name)
+            self.assertEqual(cursor.count(True), 1, name)
+
+    def test_update(self):
+
+        for name, collection in self.backends:
+
+            # nested paths, in objects and arrays, missing ones are created
+            collection.update({ "_id": 3 }, { "$inc": { "configurations.1.sum": 2, "stats.runs": 1, "n_inc": 5 } })
+            collection.update({ "_id": 3 }, { "$inc": { "stats.runs": 1 }, "$set": { "parameters.b": "w", "configurations.0.sum": 7 } })
+            d = collection.find_one({ "_id": 3 })
+            self.assertEqual(d["configurations"], [{ "sum": 7 }, { "sum": 3 }], name)
+            self.assertEqual(d["stats"], { "runs": 2 }, name)
+            self.assertEqual(d["n_inc"], 5, name)
+            self.assertEqual(d["parameters"], { "a": 1, "b": "w", "repetition": 1 }, name)
+
+            # unset
+            collection.update({ "_id": 1 }, { "$unset": { "stats.cost": "", "x": "" } })
+            self.assertEqual(collection.find_one({ "_id": 1 }, ["stats", "x"]), { "_id": 1, "stats": {} }, name)
+
+            # single and multiple documents
+            collection.update({ "batch": "b1" }, { "$inc": { "n": 10 } })
+            self.assertEqual(sorted(d["n"] for d in collection.find({ "batch": "b1" })), [2, 11], name)
+            collection.update({ "batch": "b1" }, { "$set": { "flag": True } }, multi = True)
+            self.assertEqual(collection.find({ "flag": True }).count(), 2, name)
+
+            # replacement keeps the id, upsert inserts
+            collection.update({ "_id": 2 }, { "name": "r" })
+            self.assertEqual(collection.find_one({ "_id": 2 }), { "_id": 2, "name": "r" }, name)
+            collection.update({ "name": "new" }, { "$set": { "n": 0 } }, upsert = True)
+            self.assertEqual(collection.find_one({ "name": "new" }, ["n"])["n"], 0, name)
+
+    def test_remove(self):
+
+        for name, collection in self.backends:
+            collection.remove({ "batch": "b1" })
+            self.assertEqual([d["_id"] for d in collection.find()], [3], name)
+
+if __name__ == "__main__":
+    unittest.main()